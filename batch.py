@@ -0,0 +1,478 @@
+"""
+乳腺钼靶图像批量分析命令行工具(无界面)
+
+遍历目录或文件列表，在进程池中调用 utils.read_image + processing.analyze_mammo_image，
+结果以 JSONL 或 CSV 逐行流式写出；中断后重新运行会跳过已成功处理的图像。
+
+用法示例:
+    python batch.py D:/films -o results.jsonl --workers 8
+    python batch.py --file-list films.txt -o results.csv --format csv -k 4
+    python batch.py D:/dicom -o results.jsonl --modality MG --view CC --laterality L
+    python batch.py D:/films -o results.jsonl --store features.db
+"""
+import argparse
+import csv
+import io
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import store
+from store import LESION_FIELDS
+
+# 注意: 本模块顶层不导入 numpy/cv2/sklearn(store也不导入)，子进程需在导入前先限制线程数
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.dcm', '.dicom')
+
+# 每个工作进程内的 BLAS/OpenMP 线程数限制，避免 N 个进程 × M 个线程的超额订阅
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+IMAGE_FIELDS = ['path', 'status', 'error', 'width', 'height',
+                'lesion_percentage', 'lesion_count', 'cache_hit', 'elapsed']
+
+_worker_params = None
+_worker_cache = None
+_worker_workspace = None
+_thread_limiter = None
+
+
+def limit_threads(threads):
+    """限制当前进程中 OpenCV、BLAS 与 OpenMP 的线程数"""
+    global _thread_limiter
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+    import cv2
+    cv2.setNumThreads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        _thread_limiter = threadpool_limits(limits=threads)
+    except ImportError:
+        pass
+
+
+def _init_worker(threads, params, cache_dir):
+    """工作进程初始化：先限制线程数，再记录分析参数、打开结果缓存并创建分析工作区"""
+    global _worker_params, _worker_cache, _worker_workspace
+    # 线程数环境变量在BLAS/OpenMP库加载时读取，须在导入分析模块之前设置
+    limit_threads(threads)
+    import processing
+
+    _worker_params = params
+    _worker_cache = _open_cache(cache_dir)
+    # 同一批次的图像尺寸通常相同，进程内依次分析时复用整幅图像大小的缓冲区
+    _worker_workspace = processing.AnalysisWorkspace()
+
+
+def _open_cache(cache_dir):
+    if cache_dir is None:
+        return None
+    import cache
+    return cache.AnalysisCache(cache_dir)
+
+
+def lesion_to_row(lesion):
+    """将单个病灶特征转换为可序列化的扁平字典"""
+    min_row, min_col, max_row, max_col = lesion['bounding_box']
+    return {
+        'area': int(lesion['area']),
+        'perimeter': float(lesion['perimeter']),
+        'circularity': float(lesion['circularity']),
+        'major_axis_length': float(lesion['major_axis_length']),
+        'minor_axis_length': float(lesion['minor_axis_length']),
+        'eccentricity': float(lesion['eccentricity']),
+        'solidity': float(lesion['solidity']),
+        'bbox_min_row': int(min_row),
+        'bbox_min_col': int(min_col),
+        'bbox_max_row': int(max_row),
+        'bbox_max_col': int(max_col),
+        'centroid_row': float(lesion['centroid'][0]),
+        'centroid_col': float(lesion['centroid'][1]),
+    }
+
+
+def analyze_file(path, params, analysis_cache=None, workspace=None):
+    """
+    分析单个图像文件，返回一条结果记录
+
+    参数:
+        path: 图像文件路径
+        params: 传给 processing.analyze_mammo_image 的关键字参数
+        analysis_cache: 可选的 cache.AnalysisCache，命中时跳过分析
+        workspace: 可选的 processing.AnalysisWorkspace，连续分析时复用中间缓冲区
+
+    返回:
+        dict: 包含路径、状态、病灶占比、病灶数量及各病灶特征；出错时记录错误信息
+    """
+    import utils
+    import processing
+    import cache
+
+    start = time.perf_counter()
+    try:
+        img = utils.read_image(path)
+        # 像素哈希同时用作缓存键和特征库中的图像标识
+        digest = cache.image_digest(img)
+        tile_size = processing.default_tile_size(img.shape)
+        cache_hit = False
+        if analysis_cache is not None:
+            hits = analysis_cache.hits
+            result = analysis_cache.analyze(img, digest, workspace, tile_size=tile_size, **params)
+            cache_hit = analysis_cache.hits > hits
+        else:
+            result = processing.analyze_mammo_image(img, tile_size=tile_size, workspace=workspace,
+                                                    **params)
+        # 缓存的结果可能只含前几个病灶的形态特征，输出前补算
+        processing.complete_shape_features(result)
+        record = {
+            'path': path,
+            'status': 'ok',
+            'image_digest': digest,
+            'width': int(img.shape[1]),
+            'height': int(img.shape[0]),
+            'lesion_percentage': float(result['lesion_percentage']),
+            'lesion_count': int(result['lesion_count']),
+            'lesions': [lesion_to_row(lesion) for lesion in result['lesion_features']],
+            'cache_hit': cache_hit,
+        }
+    except Exception as e:
+        record = {'path': path, 'status': 'error', 'error': str(e)}
+    record['elapsed'] = round(time.perf_counter() - start, 4)
+    return record
+
+
+def _analyze_in_worker(path):
+    return analyze_file(path, _worker_params, _worker_cache, _worker_workspace)
+
+
+def collect_inputs(inputs, file_list=None, recursive=True):
+    """收集待处理图像路径(绝对路径，去重并排序)"""
+    paths = []
+    sources = list(inputs)
+    if file_list:
+        with open(file_list, encoding='utf-8') as f:
+            sources.extend(line.strip() for line in f if line.strip())
+
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.append(os.path.join(root, name))
+                if not recursive:
+                    break
+        else:
+            paths.append(source)
+
+    return sorted(set(os.path.abspath(p) for p in paths))
+
+
+def filter_dicom_inputs(paths, **filters):
+    """只保留文件头满足筛选条件的DICOM文件(只读文件头，不解码像素)"""
+    import dicom_io
+
+    selected = []
+    for path in paths:
+        if not dicom_io.is_dicom_file(path):
+            continue
+        try:
+            header = dicom_io.read_header(path)
+        except ValueError as e:
+            print(f"跳过: {e}", file=sys.stderr)
+            continue
+        if dicom_io.header_matches(header, **filters):
+            selected.append(path)
+    return selected
+
+
+class JsonlResultWriter:
+    """JSONL结果写入器：每张图像一行"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def finished_paths(self):
+        """读取已成功处理的输入路径(忽略中断时写了一半的行)"""
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('status') == 'ok':
+                    done.add(record['path'])
+        return done
+
+    def open(self):
+        _terminate_partial_line(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CsvResultWriter:
+    """
+    CSV结果写入器：每个病灶一行，无病灶或出错的图像各占一行
+
+    同一图像的各行一次写出；续跑时只有行数与病灶数一致的图像才算已完成，
+    中断时写了一半的图像的残余行在打开时删除，重新分析后再写入。
+    """
+
+    fieldnames = IMAGE_FIELDS + ['lesion_index'] + LESION_FIELDS
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.writer = None
+
+    def _read_rows(self):
+        """读取已有结果行，丢弃中断时写了一半的末行；返回(行列表, 是否有残行)"""
+        with open(self.path, newline='', encoding='utf-8') as f:
+            text = f.read()
+        torn = bool(text) and not text.endswith('\n')
+        if torn:
+            text = text[:text.rfind('\n') + 1]
+        return list(csv.DictReader(io.StringIO(text, newline=''))), torn
+
+    @staticmethod
+    def _complete_paths(rows):
+        """行数与病灶数一致(无病灶时为一行)的成功图像路径"""
+        counts = {}
+        expected = {}
+        for row in rows:
+            if row.get('status') != 'ok':
+                continue
+            path = row['path']
+            counts[path] = counts.get(path, 0) + 1
+            try:
+                expected[path] = max(int(row['lesion_count']), 1)
+            except (TypeError, ValueError):
+                expected[path] = -1
+        return {path for path, count in counts.items() if count == expected[path]}
+
+    def finished_paths(self):
+        """读取已完整写出的成功图像路径"""
+        if not os.path.exists(self.path):
+            return set()
+        return self._complete_paths(self._read_rows()[0])
+
+    def open(self):
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        if not write_header:
+            self._drop_partial_rows()
+        self.file = open(self.path, 'a', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, extrasaction='ignore')
+        if write_header:
+            self.writer.writeheader()
+
+    def _drop_partial_rows(self):
+        """删除未完整写出的图像的行和残行(经临时文件原子替换)"""
+        rows, torn = self._read_rows()
+        complete = self._complete_paths(rows)
+        kept = [row for row in rows if row.get('status') != 'ok' or row['path'] in complete]
+        if len(kept) == len(rows) and not torn:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=self.fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(kept)
+        os.replace(tmp_path, self.path)
+
+    def write(self, record):
+        base = {k: record.get(k, '') for k in IMAGE_FIELDS}
+        lesions = record.get('lesions') or [{}]
+        buffer = io.StringIO(newline='')
+        writer = csv.DictWriter(buffer, fieldnames=self.fieldnames, extrasaction='ignore')
+        for i, lesion in enumerate(lesions):
+            row = dict(base)
+            if lesion:
+                row['lesion_index'] = i + 1
+                row.update(lesion)
+            writer.writerow(row)
+        # 同一图像的各行一次写出，减少中断时只写出部分病灶的可能
+        self.file.write(buffer.getvalue())
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+RESULT_WRITERS = {'jsonl': JsonlResultWriter, 'csv': CsvResultWriter}
+
+
+def _terminate_partial_line(path):
+    """若上次运行在写一半时中断，先补齐换行，避免新记录拼接到残行上"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            f.write(b'\n')
+
+
+def run_batch(paths, writer, params, workers=None, threads_per_worker=1, cache_dir=None,
+              feature_store=None):
+    """
+    并行分析图像并流式写出结果
+
+    参数:
+        paths: 待处理图像路径列表
+        writer: 结果写入器(JsonlResultWriter 或 CsvResultWriter)
+        params: 分析参数
+        workers: 工作进程数，默认使用全部CPU核心
+        threads_per_worker: 每个工作进程内的线程数上限
+        cache_dir: 结果缓存目录，None表示不使用缓存
+        feature_store: 可选的store.FeatureStore，成功的结果按批写入特征库
+
+    返回:
+        tuple: (成功数, 失败数, 缓存命中数)
+    """
+    workers = workers or os.cpu_count() or 1
+    ok_count = error_count = hit_count = 0
+    start = time.perf_counter()
+
+    writer.open()
+    try:
+        if workers == 1:
+            limit_threads(threads_per_worker)
+            import processing
+            analysis_cache = _open_cache(cache_dir)
+            workspace = processing.AnalysisWorkspace()
+            records = (analyze_file(path, params, analysis_cache, workspace) for path in paths)
+            pool = None
+        else:
+            # spawn 保证子进程在导入 numpy/cv2 之前完成线程数限制
+            ctx = mp.get_context('spawn')
+            pool = ctx.Pool(workers, initializer=_init_worker,
+                            initargs=(threads_per_worker, params, cache_dir))
+            records = pool.imap_unordered(_analyze_in_worker, paths)
+
+        try:
+            for i, record in enumerate(records, 1):
+                writer.write(record)
+                if record['status'] == 'ok':
+                    if feature_store is not None:
+                        feature_store.add(store.entry_from_record(record, params))
+                    ok_count += 1
+                    hit_count += record['cache_hit']
+                else:
+                    error_count += 1
+                    print(f"分析失败: {record['path']}: {record['error']}", file=sys.stderr)
+                elapsed = time.perf_counter() - start
+                print(f"[{i}/{len(paths)}] {elapsed:.1f}s {i / elapsed:.2f} 张/秒", file=sys.stderr)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    finally:
+        writer.close()
+        if feature_store is not None:
+            feature_store.flush()
+
+    return ok_count, error_count, hit_count
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="乳腺钼靶图像批量分析")
+    parser.add_argument('inputs', nargs='*', help="图像文件或目录")
+    parser.add_argument('--file-list', help="每行一个路径的文件列表")
+    parser.add_argument('-o', '--output', required=True, help="结果文件路径")
+    parser.add_argument('--format', choices=sorted(RESULT_WRITERS),
+                        help="输出格式，默认根据输出文件扩展名判断")
+    parser.add_argument('--workers', type=int, default=None, help="工作进程数(默认CPU核心数)")
+    parser.add_argument('--threads-per-worker', type=int, default=1, help="每个进程的线程数上限")
+    parser.add_argument('--no-recursive', action='store_true', help="不递归遍历子目录")
+    parser.add_argument('--no-resume', action='store_true', help="不跳过已处理的图像(覆盖已有结果文件)")
+    parser.add_argument('--cache-dir', default=None, help="结果缓存目录(默认使用用户目录下的缓存)")
+    parser.add_argument('--no-cache', action='store_true', help="不使用结果缓存")
+    parser.add_argument('--store', help="同时将图像摘要和病灶特征写入该SQLite特征库")
+    parser.add_argument('--modality', help="只处理该检查类型的DICOM图像，如MG")
+    parser.add_argument('--view', help="只处理该体位的DICOM图像，如CC、MLO")
+    parser.add_argument('--laterality', help="只处理该侧别的DICOM图像，L或R")
+    parser.add_argument('-k', type=int, default=3, help="聚类数量")
+    parser.add_argument('--dark-lesion', action='store_true', help="病灶表现为较暗区域")
+    parser.add_argument('--morph-kernel-size', type=int, default=5, help="形态学操作核大小")
+    parser.add_argument('--min-lesion-size', type=int, default=100, help="最小病灶面积(像素)")
+    parser.add_argument('--crop-foreground', action='store_true', help="只分析乳房区域(裁剪背景)")
+    parser.add_argument('--mask-pectoral', action='store_true',
+                        help="与--crop-foreground同时使用，胸大肌区按背景处理")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.file_list:
+        parser.error("请指定图像文件、目录或 --file-list")
+    if args.mask_pectoral and not args.crop_foreground:
+        parser.error("--mask-pectoral 需与 --crop-foreground 同时使用")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fmt = args.format or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+    writer = RESULT_WRITERS[fmt](args.output)
+    params = {
+        'k': args.k,
+        'lesion_is_bright': not args.dark_lesion,
+        'morph_kernel_size': (args.morph_kernel_size, args.morph_kernel_size),
+        'min_lesion_size': args.min_lesion_size,
+    }
+    if args.crop_foreground:
+        params['crop_foreground'] = True
+        params['mask_pectoral'] = args.mask_pectoral
+
+    paths = collect_inputs(args.inputs, args.file_list, recursive=not args.no_recursive)
+    if args.modality or args.view or args.laterality:
+        paths = filter_dicom_inputs(paths, modality=args.modality, view=args.view,
+                                    laterality=args.laterality)
+    if args.no_resume:
+        if os.path.exists(args.output):
+            os.remove(args.output)
+    else:
+        done = writer.finished_paths()
+        if done:
+            print(f"跳过已处理的 {len(done & set(paths))} 张图像", file=sys.stderr)
+        paths = [p for p in paths if p not in done]
+
+    if not paths:
+        print("没有需要处理的图像", file=sys.stderr)
+        return 0
+
+    if args.no_cache:
+        cache_dir = None
+    else:
+        import cache
+        cache_dir = args.cache_dir or cache.DEFAULT_CACHE_DIR
+    feature_store = store.FeatureStore(args.store) if args.store else None
+    try:
+        ok_count, error_count, hit_count = run_batch(paths, writer, params, args.workers,
+                                                     args.threads_per_worker, cache_dir,
+                                                     feature_store)
+    finally:
+        if feature_store is not None:
+            feature_store.close()
+    print(f"完成: 成功 {ok_count} 张, 失败 {error_count} 张, 结果已写入 {args.output}", file=sys.stderr)
+    if feature_store is not None:
+        print(f"特征库: {args.store}", file=sys.stderr)
+    if cache_dir is not None:
+        print(f"结果缓存: 命中 {hit_count} 次, 未命中 {ok_count - hit_count} 次", file=sys.stderr)
+    return 1 if error_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
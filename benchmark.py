@@ -0,0 +1,736 @@
+"""
+分析流水线基准测试(无界面)
+
+在合成体模(phantom.py)上逐阶段测量 processing 流水线的耗时和内存峰值，
+并测量 extract_lesion_features 与显示准备(utils.prepare_image_for_display 等)；结果保存为JSON，
+可用 compare 子命令比较两次结果，任一阶段退化超过阈值时返回非零退出码。
+startup 子命令在子进程中测量界面模块导入和主窗口创建耗时，超出预算或启动时
+提前导入了scipy/scikit-learn等重型模块时返回非零退出码。
+responsiveness 子命令测量分析期间界面事件循环的延迟(线程分析与分析进程池两种模式)。
+coarse 子命令比较粗到细模式(降采样预览 + 候选区域细化)与整图模式的耗时和病灶数量/面积差异。
+workspace 子命令连续分析一组相同尺寸的体模，比较使用与不使用processing.AnalysisWorkspace时的
+耗时、工作区缓冲区分配次数和每次分析新增分配的内存峰值，并核对同一流水线交替运行整图、
+预览和粗到细模式时结果与不使用工作区时一致，不一致时返回非零退出码。
+batch 子命令以不同工作进程数运行批量分析(batch.run_batch)，报告吞吐量、加速比和并行效率。
+
+用法示例:
+    python benchmark.py run -o bench_base.json --sizes 512 1024 2048 4096 --k 2 3 4
+    python benchmark.py compare bench_base.json bench_new.json --threshold 0.2
+    python benchmark.py startup --budget 1.0
+    python benchmark.py responsiveness --size 4096 --budget-ms 50
+    python benchmark.py coarse --sizes 2048 4096 --seeds 0 1 2 --images film1.png film2.png
+    python benchmark.py workspace --sizes 1024 4096 --count 5
+    python benchmark.py batch --workers 1 2 4 --count 16 --size 2048
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+import phantom
+import processing
+import utils
+
+BENCHMARK_FORMAT = 1
+
+# 比较时忽略的小耗时/小内存波动(绝对值)
+MIN_SECONDS = 0.002
+MIN_BYTES = 1024 * 1024
+
+# 显示基准使用的目标尺寸(像素)
+DISPLAY_SIZE = (800, 800)
+
+# 启动时不应导入的重型模块(由界面在后台预热或首次分析时导入)
+HEAVY_MODULES = ('processing', 'sklearn', 'scipy', 'skimage')
+
+# 在子进程中执行: 导入界面模块并创建主窗口，输出各阶段耗时
+_STARTUP_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+import gui
+from PyQt5.QtWidgets import QApplication
+imported = time.perf_counter()
+app = QApplication(sys.argv)
+window = gui.MammoAnalysisApp()
+window.show()
+heavy = sorted(name for name in %r if name in sys.modules)
+app.processEvents()
+ready = time.perf_counter()
+print(json.dumps({'import_s': imported - start, 'window_s': ready - start, 'heavy_modules': heavy}))
+sys.stdout.flush()
+# 后台预热线程仍在运行，直接退出
+os._exit(0)
+""" % (HEAVY_MODULES,)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _stage_calls(pipeline: processing.AnalysisPipeline, params: Dict):
+    """按流水线顺序返回(阶段名, 调用)；记忆机制保证每次调用只计算该阶段本身"""
+    k, bright = params['k'], params['lesion_is_bright']
+    kernel, min_size = params['morph_kernel_size'], params['min_lesion_size']
+    method = params['cluster_method']
+    calls = [('enhance', pipeline.enhance), ('smooth', pipeline.smooth)]
+    if method == 'histogram':
+        calls.append(('histogram', pipeline.histogram))
+    calls += [
+        ('cluster', lambda: pipeline.cluster(k, method)),
+        ('mask', lambda: pipeline.mask(k, bright, method)),
+        ('morphology', lambda: pipeline.morphology(k, bright, kernel, method)),
+        ('filter', lambda: pipeline.filter(k, bright, kernel, min_size, method)),
+        ('features', lambda: pipeline.features(k, bright, kernel, min_size, method)),
+    ]
+    return calls
+
+
+def _measure(calls, repeat: int, trace_memory: bool) -> Dict[str, Dict]:
+    """
+    测量一组调用的耗时和内存峰值
+
+    calls为返回[(名称, 调用)]的工厂函数(每次重复重新创建，避免记忆命中)；
+    先预热一次(排除首次调用的初始化开销)，耗时取多次重复的最小值；内存峰值在
+    单独一次tracemalloc运行中测量(为各调用期间新增分配的峰值，含numpy数组，
+    不含OpenCV内部临时缓冲区)。
+    """
+    for _, call in calls():
+        call()
+    wall = {}
+    for _ in range(repeat):
+        for name, call in calls():
+            t = time.perf_counter()
+            call()
+            elapsed = time.perf_counter() - t
+            wall[name] = min(wall.get(name, elapsed), elapsed)
+    stats = {name: {'wall_s': seconds} for name, seconds in wall.items()}
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            for name, call in calls():
+                base = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                call()
+                stats[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+    return stats
+
+
+def benchmark_case(img: np.ndarray, params: Dict, repeat: int, trace_memory: bool) -> Dict:
+    """单个图像尺寸和k的基准测试: 整图模式逐阶段，分块模式只测整体"""
+    tile_size = processing.default_tile_size(img.shape)
+    if tile_size:
+        def calls():
+            return [('tiled', lambda: processing.analyze_mammo_image_tiled(
+                img, params['k'], params['lesion_is_bright'], params['morph_kernel_size'],
+                params['min_lesion_size'], tile_size=tile_size))]
+    else:
+        def calls():
+            return _stage_calls(processing.AnalysisPipeline(img), params)
+    stages = _measure(calls, repeat, trace_memory)
+    result = processing.analyze_mammo_image(img, tile_size=tile_size, **params)
+    return {
+        'stages': stages,
+        'total_s': sum(stage['wall_s'] for stage in stages.values()),
+        'lesion_count': result.lesion_count,
+        'lesion_percentage': float(result.lesion_percentage),
+        'result': result,
+    }
+
+
+def run_benchmark(sizes: List[int], k_values: List[int], repeat: int = 3,
+                  trace_memory: bool = True, seed: int = 0, n_lesions: int = 12,
+                  cluster_method: str = 'histogram', log=None) -> Dict:
+    """
+    运行基准测试
+
+    参数:
+        sizes: 体模图像高度列表(像素)
+        k_values: 聚类数量列表
+        repeat: 每项重复次数(耗时取最小值)
+        trace_memory: 是否用tracemalloc测量内存峰值
+        seed, n_lesions: 体模随机种子和病灶数量
+        cluster_method: 聚类后端
+        log: 进度输出函数(默认输出到stderr)
+
+    返回:
+        dict: 可直接保存为JSON的结果，cases按"{高度}px/k{k}"或"{高度}px/{函数名}"索引
+    """
+    log = log or (lambda msg: print(msg, file=sys.stderr))
+    report = {
+        'format': BENCHMARK_FORMAT,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'pipeline_version': processing.PIPELINE_VERSION,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'config': {'sizes': sizes, 'k_values': k_values, 'repeat': repeat, 'seed': seed,
+                   'n_lesions': n_lesions, 'cluster_method': cluster_method,
+                   'trace_memory': trace_memory},
+        'cases': {},
+    }
+    for size in sizes:
+        img, _ = phantom.make_phantom(size, n_lesions, seed=seed)
+        for k in k_values:
+            params = {'k': k, 'lesion_is_bright': True, 'morph_kernel_size': (5, 5),
+                      'min_lesion_size': 100, 'cluster_method': cluster_method}
+            case = benchmark_case(img, params, repeat, trace_memory)
+            result = case.pop('result')
+            report['cases'][f"{size}px/k{k}"] = case
+            log(f"{size}px k={k}: {case['total_s'] * 1000:.1f} ms, {case['lesion_count']} 个病灶")
+
+        # 特征提取与显示准备(使用最后一个k的掩码)
+        mask_img = result.mask_img
+        pyramid = utils.DisplayPyramid(img)
+        extra = _measure(lambda: [
+            ('extract_lesion_features', lambda: processing.extract_lesion_features(mask_img)),
+            # 列式特征表: 全部连通域的矩，形态特征只算报告用到的前3个
+            ('extract_lesion_table', lambda: processing.extract_lesion_table(mask_img, shape_top_n=3)),
+            ('prepare_image_for_display', lambda: utils.prepare_image_for_display(img)),
+            # 显示: 首次(含构建多分辨率层级)与层级已缓存时的重绘
+            ('render_for_display', lambda: utils.render_for_display(
+                utils.DisplayPyramid(img), *DISPLAY_SIZE)),
+            ('redisplay', lambda: utils.render_for_display(pyramid, *DISPLAY_SIZE)),
+        ], repeat, trace_memory)
+        for name, stats in extra.items():
+            report['cases'][f"{size}px/{name}"] = {'stages': {name: stats}, 'total_s': stats['wall_s']}
+            log(f"{size}px {name}: {stats['wall_s'] * 1000:.1f} ms")
+    return report
+
+
+def measure_startup(repeat: int = 3) -> Dict:
+    """
+    在独立子进程中测量冷启动: 界面模块导入耗时、主窗口创建并显示的耗时
+
+    返回:
+        dict: import_s/window_s取多次重复的最小值，process_s为含解释器启动的子进程总耗时，
+        heavy_modules为主窗口显示前已导入的重型模块
+    """
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT], cwd=package_dir, env=env,
+                              capture_output=True, text=True)
+        elapsed = time.perf_counter() - t
+        if proc.returncode != 0:
+            raise RuntimeError(f"启动测量失败: {proc.stderr.strip()}")
+        stats = json.loads(proc.stdout.strip().splitlines()[-1])
+        stats['process_s'] = elapsed
+        if best is None:
+            best = stats
+        else:
+            for key in ('import_s', 'window_s', 'process_s'):
+                best[key] = min(best[key], stats[key])
+            best['heavy_modules'] = sorted(set(best['heavy_modules']) | set(stats['heavy_modules']))
+    return best
+
+
+# 在子进程中执行: 先分析一张小图像完成预热，再在分析体模期间测量界面事件循环延迟
+_RESPONSIVENESS_SCRIPT = """
+import json, sys, time
+import gui
+from PyQt5.QtCore import QEventLoop
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv)
+window = gui.MammoAnalysisApp()
+window.show()
+app.processEvents()
+window.start_warm_up()
+
+def analyze(path):
+    window.load_image(path)
+    loop = QEventLoop()
+    start = time.perf_counter()
+    window.process_image()
+    window.analysis_thread.finished.connect(loop.quit)
+    loop.exec_()
+    return time.perf_counter() - start
+
+analyze(sys.argv[1])
+analysis_s = analyze(sys.argv[2])
+print(json.dumps({'analysis_s': analysis_s, 'latency': window.analysis_latency}))
+sys.stdout.flush()
+window.close()
+"""
+
+
+def measure_responsiveness(size: int = 4096, seed: int = 0, lesions: int = 12) -> Dict:
+    """
+    在独立子进程中分析体模，测量分析期间界面事件循环的延迟
+
+    分别测量界面进程内线程分析(MAMMO_ANALYSIS_WORKERS=0)与分析进程池两种模式，
+    两种模式各使用独立的空结果缓存
+
+    返回:
+        dict: 模式('thread'/'process') -> {analysis_s, latency: {samples, p50_ms, p95_ms, max_ms}}
+    """
+    import tempfile
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        small, large = os.path.join(tmp, 'small.png'), os.path.join(tmp, 'large.png')
+        cv2.imwrite(small, phantom.make_phantom(256, lesions, seed=seed)[0])
+        cv2.imwrite(large, phantom.make_phantom(size, lesions, seed=seed)[0])
+        for mode, workers in (('thread', '0'), ('process', '1')):
+            env = dict(os.environ, MAMMO_ANALYSIS_WORKERS=workers,
+                       MAMMO_CACHE_DIR=os.path.join(tmp, f'cache_{mode}'))
+            env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+            proc = subprocess.run([sys.executable, '-c', _RESPONSIVENESS_SCRIPT, small, large],
+                                  cwd=package_dir, env=env, capture_output=True, text=True)
+            if proc.returncode != 0:
+                raise RuntimeError(f"响应性测量失败({mode}): {proc.stderr.strip()}")
+            report[mode] = json.loads(proc.stdout.strip().splitlines()[-1])
+    return report
+
+
+def _timed(call, repeat: int):
+    """重复调用call()，返回(最后一次的结果, 最短耗时)"""
+    best, value = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = call()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return value, best
+
+
+def coarse_case(img: np.ndarray, params: Dict, coarse_factor: int, repeat: int = 3) -> Dict:
+    """
+    在一幅图像上比较整图模式与粗到细模式(每次使用新的流水线，不复用中间结果)
+
+    返回:
+        dict: 整图/预览/细化的耗时(秒，细化不含预览)、病灶数量和总面积，
+        以及细化结果中与整图结果完全相同(边界框与全部特征一致)的病灶数量
+    """
+    full, full_s = _timed(lambda: processing.AnalysisPipeline(img).run(**params), repeat)
+
+    def coarse():
+        pipeline = processing.AnalysisPipeline(img)
+        start = time.perf_counter()
+        preview = pipeline.preview(coarse_factor=coarse_factor, **params)
+        preview_s = time.perf_counter() - start
+        refined = pipeline.run(coarse_factor=coarse_factor, **params)
+        return preview, refined, preview_s, time.perf_counter() - start - preview_s
+
+    times = []
+    for _ in range(repeat):
+        preview, refined, preview_s, refine_s = coarse()
+        times.append((preview_s, refine_s))
+    preview_s, refine_s = min(t[0] for t in times), min(t[1] for t in times)
+
+    fields = [name for name in full.lesion_table.dtype.names if name not in ('bounding_box', 'centroid')]
+    by_box = {tuple(row['bounding_box']): row for row in full.lesion_table}
+    matched = 0
+    for row in refined.lesion_table:
+        other = by_box.get(tuple(row['bounding_box']))
+        if other is not None and all(np.isclose(row[f], other[f], equal_nan=True) for f in fields):
+            matched += 1
+
+    def summary(result, seconds):
+        return {'seconds': seconds, 'lesion_count': int(result.lesion_count),
+                'lesion_area': float(result.lesion_table['area'].sum())}
+
+    return {
+        'shape': list(img.shape),
+        'full': summary(full, full_s),
+        'preview': summary(preview, preview_s),
+        'refine': dict(summary(refined, refine_s), matched=matched),
+    }
+
+
+def measure_coarse(sizes: List[int], seeds: List[int], images: List[str], lesions: int = 12,
+                   coarse_factor: int = processing.DEFAULT_COARSE_FACTOR, repeat: int = 3,
+                   shape_top_n: Optional[int] = 3) -> List[Dict]:
+    """在体模(各尺寸、各种子)和给定的图像文件上运行coarse_case，返回各项结果(含name)"""
+    params = {'shape_top_n': shape_top_n}
+    cases = []
+    for size in sizes:
+        for seed in seeds:
+            img = phantom.make_phantom(size, lesions, seed=seed)[0]
+            cases.append(dict(coarse_case(img, params, coarse_factor, repeat),
+                              name=f"phantom {size} seed={seed}"))
+    for path in images:
+        img = utils.read_image(path)
+        cases.append(dict(coarse_case(img, params, coarse_factor, repeat), name=path))
+    return cases
+
+
+def format_coarse(cases: List[Dict]) -> str:
+    lines = [f"{'图像':<28}{'整图 s':>8}{'预览 s':>8}{'细化 s':>8}{'加速':>7}  "
+             f"{'病灶数 整图/预览/细化(一致)':<28}{'面积差 预览/细化':>18}"]
+    for case in cases:
+        full, preview, refine = case['full'], case['preview'], case['refine']
+        total = preview['seconds'] + refine['seconds']
+        area = full['lesion_area'] or 1.0
+        counts = (f"{full['lesion_count']}/{preview['lesion_count']}/"
+                  f"{refine['lesion_count']}({refine['matched']})")
+        lines.append(f"{case['name']:<28}{full['seconds']:>8.3f}{preview['seconds']:>8.3f}"
+                     f"{refine['seconds']:>8.3f}{full['seconds'] / total:>6.2f}x  {counts:<28}"
+                     f"{(preview['lesion_area'] - full['lesion_area']) / area:>+9.2%}"
+                     f"{(refine['lesion_area'] - full['lesion_area']) / area:>+9.2%}")
+    return "\n".join(lines)
+
+
+def workspace_case(images: List[np.ndarray], params: Dict) -> Dict:
+    """
+    依次分析一组相同尺寸的图像，比较不使用与使用AnalysisWorkspace的情况
+
+    先不跟踪内存依次分析一遍(记录耗时和每次分析新分配的工作区缓冲区数量)，
+    再在tracemalloc下依次分析一遍，记录每次分析期间新增分配的峰值(已分配的工作区
+    缓冲区不计入)。
+
+    返回:
+        dict: 'plain'与'workspace'两项，各含每次分析的seconds、peak_bytes，
+        以及workspace项的allocations(每次分析新分配的缓冲区数)和buffer_bytes
+    """
+    report = {'shape': list(images[0].shape)}
+    for mode in ('plain', 'workspace'):
+        workspace = processing.AnalysisWorkspace() if mode == 'workspace' else None
+        seconds, allocations, peaks = [], [], []
+        for img in images:
+            before = workspace.allocations if workspace is not None else 0
+            start = time.perf_counter()
+            processing.analyze_mammo_image(img, workspace=workspace, **params)
+            seconds.append(time.perf_counter() - start)
+            allocations.append(workspace.allocations - before if workspace is not None else None)
+        tracemalloc.start()
+        try:
+            for img in images:
+                base = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                processing.analyze_mammo_image(img, workspace=workspace, **params)
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        finally:
+            tracemalloc.stop()
+        report[mode] = {'seconds': seconds, 'peak_bytes': peaks}
+        if workspace is not None:
+            report[mode].update(allocations=allocations, buffer_bytes=workspace.nbytes)
+    return report
+
+
+# 核对工作区复用时依次运行的模式: (方法, 额外参数)
+WORKSPACE_SEQUENCE = [('run', {}), ('preview', {}), ('run', {}), ('run', {'coarse_factor': 4}),
+                      ('run', {})]
+
+
+def workspace_consistency(img: np.ndarray, params: Dict) -> List[str]:
+    """
+    在使用工作区的同一流水线上依次运行WORKSPACE_SEQUENCE，与不使用工作区的新流水线逐次比较掩码
+
+    返回:
+        list: 掩码不一致的步骤描述，为空表示一致
+    """
+    pipeline = processing.AnalysisPipeline(img, processing.AnalysisWorkspace())
+    mismatches = []
+    for step, (method, extra) in enumerate(WORKSPACE_SEQUENCE):
+        expected = getattr(processing.AnalysisPipeline(img), method)(**params, **extra).mask_img
+        actual = getattr(pipeline, method)(**params, **extra).mask_img
+        if not np.array_equal(actual, expected):
+            mismatches.append(f"第{step + 1}步 {method}({', '.join(f'{k}={v}' for k, v in extra.items())})")
+    return mismatches
+
+
+def measure_workspace(sizes: List[int], count: int = 5, lesions: int = 12,
+                      params: Optional[Dict] = None) -> List[Dict]:
+    """各尺寸生成count幅体模(种子0..count-1)并运行workspace_case"""
+    cases = []
+    for size in sizes:
+        images = [phantom.make_phantom(size, lesions, seed=seed)[0] for seed in range(count)]
+        cases.append(dict(workspace_case(images, params or {}), name=f"phantom {size} x{count}",
+                          mismatches=workspace_consistency(images[0], params or {})))
+    return cases
+
+
+def format_workspace(cases: List[Dict]) -> str:
+    """耗时和峰值均取首次之后各次分析的最大值；峰值同时以整幅图像(每像素1字节)的倍数表示"""
+    lines = [f"{'图像':<22}{'模式':<11}{'首次 s':>8}{'后续 s':>8}{'峰值 MB':>9}{'整幅倍数':>9}"
+             f"{'缓冲区分配(首次/后续)':>24}"]
+    for case in cases:
+        pixels = case['shape'][0] * case['shape'][1]
+        for mode in ('plain', 'workspace'):
+            stats = case[mode]
+            rest = stats['seconds'][1:] or stats['seconds']
+            peak = max(stats['peak_bytes'][1:] or stats['peak_bytes'])
+            allocations = stats.get('allocations')
+            buffers = (f"{allocations[0]}/{sum(allocations[1:])}" if allocations else "-")
+            lines.append(f"{case['name']:<22}{mode:<11}{stats['seconds'][0]:>8.3f}{max(rest):>8.3f}"
+                         f"{peak / 2 ** 20:>9.1f}{peak / pixels:>9.2f}{buffers:>24}")
+        if case.get('mismatches'):
+            lines.append(f"  结果与不使用工作区时不一致: {'; '.join(case['mismatches'])}")
+    return "\n".join(lines)
+
+
+def batch_scaling(worker_counts: List[int], count: int = 16, size: int = 2048, lesions: int = 12,
+                  threads_per_worker: int = 1) -> Dict:
+    """
+    以不同工作进程数批量分析同一组体模(PNG文件，不使用结果缓存)
+
+    耗时为run_batch的总耗时，含进程池启动、读图和结果写出，与命令行批量分析一致。
+
+    返回:
+        dict: cpu_count、images、size，以及runs(各工作进程数的seconds、throughput、
+        speedup(相对第一项)和efficiency(加速比 / 进程数))
+    """
+    import contextlib
+    import io
+    import tempfile
+
+    import batch
+
+    params = {'k': 3, 'lesion_is_bright': True, 'morph_kernel_size': (5, 5), 'min_lesion_size': 100}
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for seed in range(count):
+            path = os.path.join(directory, f"phantom{seed:03d}.png")
+            cv2.imwrite(path, phantom.make_phantom(size, lesions, seed=seed)[0])
+            paths.append(path)
+        for workers in worker_counts:
+            output = os.path.join(directory, f"workers{workers}.jsonl")
+            start = time.perf_counter()
+            # 逐张进度输出不计入结果
+            with contextlib.redirect_stderr(io.StringIO()):
+                ok_count, error_count, _ = batch.run_batch(paths, batch.JsonlResultWriter(output), params,
+                                                           workers, threads_per_worker)
+            seconds = time.perf_counter() - start
+            if error_count:
+                raise RuntimeError(f"批量分析失败 {error_count} 张")
+            runs.append({'workers': workers, 'seconds': seconds, 'throughput': ok_count / seconds})
+    for run in runs:
+        run['speedup'] = runs[0]['seconds'] / run['seconds']
+        run['efficiency'] = run['speedup'] * runs[0]['workers'] / run['workers']
+    return {'cpu_count': os.cpu_count(), 'images': count, 'size': size, 'runs': runs}
+
+
+def format_batch_scaling(report: Dict) -> str:
+    lines = [f"{report['images']} 幅 {report['size']} 像素体模, CPU核心数 {report['cpu_count']}",
+             f"{'进程数':>6}{'耗时 s':>10}{'张/秒':>9}{'加速比':>9}{'效率':>8}"]
+    for run in report['runs']:
+        lines.append(f"{run['workers']:>6}{run['seconds']:>10.2f}{run['throughput']:>9.2f}"
+                     f"{run['speedup']:>9.2f}{run['efficiency']:>8.0%}")
+    return "\n".join(lines)
+
+
+def compare_reports(baseline: Dict, current: Dict, threshold: float = 0.2,
+                    memory_threshold: Optional[float] = None) -> List[str]:
+    """
+    比较两次基准测试结果
+
+    参数:
+        baseline, current: run_benchmark的结果
+        threshold: 耗时允许增长的比例(0.2表示20%)
+        memory_threshold: 内存峰值允许增长的比例，默认与threshold相同
+
+    返回:
+        list: 退化项描述，为空表示没有退化
+    """
+    if memory_threshold is None:
+        memory_threshold = threshold
+    regressions = []
+    for case_name, base_case in baseline['cases'].items():
+        case = current['cases'].get(case_name)
+        if case is None:
+            continue
+        for stage, base in base_case['stages'].items():
+            stats = case['stages'].get(stage)
+            if stats is None:
+                continue
+            old, new = base['wall_s'], stats['wall_s']
+            if new > old * (1 + threshold) and new - old > MIN_SECONDS:
+                regressions.append(f"{case_name} {stage}: 耗时 {old * 1000:.1f} ms -> "
+                                   f"{new * 1000:.1f} ms (+{(new / old - 1) * 100:.0f}%)")
+            if 'peak_bytes' in base and 'peak_bytes' in stats:
+                old, new = base['peak_bytes'], stats['peak_bytes']
+                if new > old * (1 + memory_threshold) and new - old > MIN_BYTES:
+                    regressions.append(f"{case_name} {stage}: 内存峰值 {old / 2 ** 20:.1f} MB -> "
+                                       f"{new / 2 ** 20:.1f} MB")
+    return regressions
+
+
+def format_report(report: Dict) -> str:
+    """生成逐阶段耗时/内存表格"""
+    lines = []
+    for case_name, case in report['cases'].items():
+        lines.append(f"{case_name}  总计 {case['total_s'] * 1000:.1f} ms")
+        for stage, stats in case['stages'].items():
+            line = f"    {stage:<26}{stats['wall_s'] * 1000:>10.2f} ms"
+            if 'peak_bytes' in stats:
+                line += f"{stats['peak_bytes'] / 2 ** 20:>10.1f} MB"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="乳腺钼靶分析流水线基准测试")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help="运行基准测试并保存JSON")
+    run.add_argument('-o', '--output', help="结果JSON路径(默认只打印)")
+    run.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096],
+                     help="体模图像高度(像素)")
+    run.add_argument('-k', '--k', type=int, nargs='+', default=[2, 3, 4], help="聚类数量")
+    run.add_argument('--repeat', type=int, default=3, help="重复次数(耗时取最小值)")
+    run.add_argument('--lesions', type=int, default=12, help="体模病灶数量")
+    run.add_argument('--seed', type=int, default=0, help="体模随机种子")
+    run.add_argument('--cluster-method', choices=processing.CLUSTER_METHODS, default='histogram')
+    run.add_argument('--no-memory', action='store_true', help="不测量内存峰值")
+    run.add_argument('--baseline', help="运行后与该基准结果比较")
+    run.add_argument('--threshold', type=float, default=0.2, help="允许的退化比例")
+
+    startup = sub.add_parser('startup', help="测量冷启动耗时并检查预算")
+    startup.add_argument('--budget', type=float, default=1.0, help="主窗口显示耗时预算(秒)")
+    startup.add_argument('--import-budget', type=float, default=0.5, help="界面模块导入耗时预算(秒)")
+    startup.add_argument('--repeat', type=int, default=3, help="重复次数(取最小值)")
+
+    responsiveness = sub.add_parser('responsiveness', help="测量分析期间的界面事件循环延迟")
+    responsiveness.add_argument('--size', type=int, default=4096, help="体模图像高度(像素)")
+    responsiveness.add_argument('--lesions', type=int, default=12, help="体模病灶数量")
+    responsiveness.add_argument('--seed', type=int, default=0, help="体模随机种子")
+    responsiveness.add_argument('--budget-ms', type=float, default=50.0,
+                                help="分析进程池模式下延迟p95的预算(毫秒)")
+
+    coarse = sub.add_parser('coarse', help="比较粗到细模式与整图模式")
+    coarse.add_argument('--sizes', type=int, nargs='+', default=[2048, 4096], help="体模图像高度(像素)")
+    coarse.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2], help="体模随机种子")
+    coarse.add_argument('--lesions', type=int, default=12, help="体模病灶数量")
+    coarse.add_argument('--images', nargs='*', default=[], help="另外测量的图像文件(如典型胶片)")
+    coarse.add_argument('--factor', type=int, default=processing.DEFAULT_COARSE_FACTOR,
+                        help="降采样倍数")
+    coarse.add_argument('--repeat', type=int, default=3, help="重复次数(耗时取最小值)")
+    coarse.add_argument('-o', '--output', help="结果JSON路径(默认只打印)")
+
+    workspace = sub.add_parser('workspace', help="比较复用工作区与每次新分配的内存和耗时")
+    workspace.add_argument('--sizes', type=int, nargs='+', default=[1024, 4096], help="体模图像高度(像素)")
+    workspace.add_argument('--count', type=int, default=5, help="每个尺寸连续分析的体模数量")
+    workspace.add_argument('--lesions', type=int, default=12, help="体模病灶数量")
+    workspace.add_argument('-o', '--output', help="结果JSON路径(默认只打印)")
+
+    batch_parser = sub.add_parser('batch', help="测量批量分析吞吐量随工作进程数的扩展")
+    batch_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="工作进程数")
+    batch_parser.add_argument('--count', type=int, default=16, help="体模数量")
+    batch_parser.add_argument('--size', type=int, default=2048, help="体模图像高度(像素)")
+    batch_parser.add_argument('--lesions', type=int, default=12, help="体模病灶数量")
+    batch_parser.add_argument('--threads-per-worker', type=int, default=1, help="每个进程的线程数上限")
+    batch_parser.add_argument('-o', '--output', help="结果JSON路径(默认只打印)")
+
+    compare = sub.add_parser('compare', help="比较两次基准测试结果")
+    compare.add_argument('baseline', help="基准结果JSON")
+    compare.add_argument('current', help="新结果JSON")
+    compare.add_argument('--threshold', type=float, default=0.2, help="耗时允许的退化比例")
+    compare.add_argument('--memory-threshold', type=float, help="内存峰值允许的退化比例")
+    return parser.parse_args(argv)
+
+
+def _load(path: str) -> Dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _check(baseline: Dict, current: Dict, threshold: float, memory_threshold=None) -> int:
+    regressions = compare_reports(baseline, current, threshold, memory_threshold)
+    for line in regressions:
+        print(f"退化: {line}", file=sys.stderr)
+    if regressions:
+        print(f"共 {len(regressions)} 项退化超过阈值", file=sys.stderr)
+        return 1
+    print("未发现超过阈值的退化", file=sys.stderr)
+    return 0
+
+
+def _check_startup(args) -> int:
+    stats = measure_startup(args.repeat)
+    print(f"界面模块导入 {stats['import_s']:.3f} s, 主窗口显示 {stats['window_s']:.3f} s, "
+          f"进程总计 {stats['process_s']:.3f} s", file=sys.stderr)
+    failures = []
+    if stats['import_s'] > args.import_budget:
+        failures.append(f"界面模块导入超出预算 {args.import_budget:.3f} s")
+    if stats['window_s'] > args.budget:
+        failures.append(f"主窗口显示超出预算 {args.budget:.3f} s")
+    if stats['heavy_modules']:
+        failures.append(f"启动时已导入重型模块: {', '.join(stats['heavy_modules'])}")
+    for line in failures:
+        print(f"退化: {line}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def _check_responsiveness(args) -> int:
+    report = measure_responsiveness(args.size, args.seed, args.lesions)
+    for mode, stats in report.items():
+        latency = stats['latency']
+        print(f"{mode:<8} 分析 {stats['analysis_s']:.2f} s, 界面延迟 p50 {latency['p50_ms']:.1f} ms, "
+              f"p95 {latency['p95_ms']:.1f} ms, 最大 {latency['max_ms']:.1f} ms "
+              f"({latency['samples']} 次采样)", file=sys.stderr)
+    p95 = report['process']['latency']['p95_ms']
+    if p95 > args.budget_ms:
+        print(f"退化: 分析期间界面延迟p95 {p95:.1f} ms 超出预算 {args.budget_ms:.1f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'startup':
+        return _check_startup(args)
+    if args.command == 'responsiveness':
+        return _check_responsiveness(args)
+    if args.command == 'coarse':
+        cases = measure_coarse(args.sizes, args.seeds, args.images, args.lesions, args.factor,
+                               args.repeat)
+        print(format_coarse(cases))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(cases, f, ensure_ascii=False, indent=2)
+        return 0
+    if args.command == 'workspace':
+        cases = measure_workspace(args.sizes, args.count, args.lesions)
+        print(format_workspace(cases))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(cases, f, ensure_ascii=False, indent=2)
+        return 1 if any(case['mismatches'] for case in cases) else 0
+    if args.command == 'batch':
+        report = batch_scaling(args.workers, args.count, args.size, args.lesions,
+                               args.threads_per_worker)
+        print(format_batch_scaling(report))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return 0
+    if args.command == 'compare':
+        return _check(_load(args.baseline), _load(args.current), args.threshold,
+                      args.memory_threshold)
+
+    report = run_benchmark(args.sizes, args.k, args.repeat, not args.no_memory, args.seed,
+                           args.lesions, args.cluster_method)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    if args.baseline:
+        return _check(_load(args.baseline), report, args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+分析结果的磁盘缓存
+
+以图像像素内容的哈希 + 全部分析参数 + 流水线版本号为键(内容寻址)，
+在磁盘上保存紧凑的掩码和病灶特征；总容量超过上限时按最近最少使用(LRU)淘汰。
+多个进程可共享同一缓存目录，写入采用临时文件 + 原子替换。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from typing import Dict, Optional
+
+import numpy as np
+
+from result import AnalysisResult
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'MAMMO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.mammo_analysis_cache'))
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1GB
+
+# 影响分析结果的参数及其默认值(tile_size只影响内存占用，shape_top_n只决定预先计算
+# 形态特征的病灶数，缺少的特征可按需补算，二者不参与缓存键)
+CACHE_PARAMS = {
+    'k': 3,
+    'lesion_is_bright': True,
+    'morph_kernel_size': (5, 5),
+    'min_lesion_size': 100,
+    'cluster_method': 'histogram',
+}
+
+_CACHE_SUFFIX = '.npz'
+
+
+def image_digest(img: np.ndarray) -> str:
+    """计算图像像素内容(含形状和数据类型)的哈希"""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{img.shape}|{img.dtype}".encode())
+    h.update(memoryview(np.ascontiguousarray(img)).cast('B'))
+    return h.hexdigest()
+
+
+def normalize_params(params: Dict) -> Dict:
+    """补全默认值并统一类型，得到参与缓存键的参数字典"""
+    unknown = (set(params) - set(CACHE_PARAMS) -
+               {'tile_size', 'shape_top_n', 'coarse_factor', 'crop_foreground', 'mask_pectoral'})
+    if unknown:
+        raise ValueError(f"未知的分析参数: {', '.join(sorted(unknown))}")
+    normalized = dict(CACHE_PARAMS)
+    normalized.update({k: v for k, v in params.items() if k in CACHE_PARAMS})
+    normalized['k'] = int(normalized['k'])
+    normalized['lesion_is_bright'] = bool(normalized['lesion_is_bright'])
+    normalized['morph_kernel_size'] = tuple(int(v) for v in normalized['morph_kernel_size'])
+    normalized['min_lesion_size'] = int(normalized['min_lesion_size'])
+    # 粗到细模式可能漏掉微小病灶，结果与整图模式分开缓存；未启用时不加入，已有缓存键不变
+    if params.get('coarse_factor'):
+        normalized['coarse_factor'] = int(params['coarse_factor'])
+    # 裁剪到乳房区域同样只在启用时加入；屏蔽胸肌只在裁剪时生效
+    if params.get('crop_foreground'):
+        normalized['crop_foreground'] = True
+        normalized['mask_pectoral'] = bool(params.get('mask_pectoral'))
+    return normalized
+
+
+def make_key(digest: str, params: Dict) -> str:
+    """由图像哈希、分析参数和流水线版本生成缓存键"""
+    # 延迟导入分析模块(依赖scipy/scikit-image)，界面启动时无需加载
+    import processing
+
+    payload = json.dumps({'image': digest, 'params': normalize_params(params),
+                          'version': processing.PIPELINE_VERSION}, sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+
+class AnalysisCache:
+    """
+    内容寻址的分析结果磁盘缓存
+
+    参数:
+        cache_dir: 缓存目录
+        max_bytes: 缓存总容量上限(字节)，超出时淘汰最久未访问的条目
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 本进程估算的缓存总大小，None表示需要重新扫描目录
+        self._total_bytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + _CACHE_SUFFIX)
+
+    def get(self, key: str, original_img: np.ndarray) -> Optional[AnalysisResult]:
+        """读取缓存结果，未命中返回None；命中时刷新访问时间用于LRU"""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = AnalysisResult.from_arrays(original_img, data)
+            os.utime(path)
+        except (ValueError, KeyError, zipfile.BadZipFile, EOFError):
+            # 文件损坏(如写入中断)视为未命中，并删除坏文件以便重新写入
+            self._discard(path)
+            with self._lock:
+                self.misses += 1
+            return None
+        except OSError:
+            # 不存在或已被其他进程淘汰
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def _discard(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._total_bytes = None
+
+    def record_lookup(self, hit: bool) -> None:
+        """计入在其他进程中完成的一次查询(如分析工作进程)，使命中统计包含全部查询"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key: str, result: AnalysisResult) -> None:
+        """写入缓存结果(已存在则只刷新访问时间)，并按容量上限淘汰旧条目"""
+        path = self._path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **result.to_arrays())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += os.path.getsize(path)
+            need_scan = self._total_bytes is None or self._total_bytes > self.max_bytes
+        if need_scan:
+            self.evict()
+
+    def _entries(self):
+        """列出全部缓存条目: [(访问时间, 大小, 路径)]"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(_CACHE_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self) -> int:
+        """淘汰最久未访问的条目直到总容量不超过上限，返回淘汰数量"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._total_bytes = total
+        return removed
+
+    def clear(self) -> None:
+        """清空缓存"""
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._total_bytes = 0
+
+    def stats(self) -> Dict:
+        """命中/未命中次数及当前条目数和总大小"""
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+    def analyze(self, img: np.ndarray, digest: Optional[str] = None, workspace=None,
+                **params) -> AnalysisResult:
+        """
+        带缓存的 processing.analyze_mammo_image
+
+        参数:
+            img: 灰度图像
+            digest: 预先计算的图像哈希(可选，避免重复哈希)
+            workspace: 可选的processing.AnalysisWorkspace，未命中时用于分析(不影响缓存键)
+            **params: 传给 analyze_mammo_image 的参数
+
+        返回:
+            AnalysisResult: 分析结果
+        """
+        import processing
+
+        key = make_key(digest or image_digest(img), params)
+        result = self.get(key, img)
+        if result is None:
+            result = processing.analyze_mammo_image(img, workspace=workspace, **params)
+            self.put(key, result)
+        return result
@@ -0,0 +1,143 @@
+"""
+分析过程的逐阶段诊断记录
+
+记录每个阶段的墙钟时间、CPU时间、可选的内存分配峰值(tracemalloc)以及连通域/
+病灶数量等计数。默认不启用：未传入Diagnostics对象时，流水线只多一次属性查找。
+"""
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+class Diagnostics:
+    """
+    单次分析的诊断记录
+
+    参数:
+        trace_memory: 是否用tracemalloc记录各阶段的内存分配峰值
+            (只统计经Python/numpy分配的内存，且会明显降低速度)
+
+    属性:
+        records: 按阶段开始顺序排列的记录列表，每项包含name、wall_s、cpu_s，
+            启用内存跟踪时还包含peak_bytes，以及add_counts添加的计数；
+            嵌套子阶段(如morphology中的label)的耗时包含在父阶段内
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.records: List[Dict] = []
+        self._stack: List[Dict] = []
+        self._started_tracing = False
+        self._switched = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def close(self) -> None:
+        """停止由本对象启动的内存跟踪"""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str, **counts):
+        """记录一个阶段；counts为附加的计数(如components=12)"""
+        record = self.begin(name, **counts)
+        try:
+            yield record
+        finally:
+            self.end()
+
+    def switch(self, name: Optional[str], **counts) -> None:
+        """结束上一个由switch开始的阶段并开始新阶段(name为None时只结束)，用于顺序执行的多个阶段"""
+        if self._switched:
+            self.end()
+            self._switched = False
+        if name is not None:
+            self.begin(name, **counts)
+            self._switched = True
+
+    def begin(self, name: str, **counts) -> Dict:
+        """开始一个阶段，必须与end配对"""
+        record = {'name': name}
+        record.update(counts)
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # 子阶段会重置峰值，先把父阶段至今的峰值记下
+            if self._stack:
+                parent = self._stack[-1]
+                parent['_peak'] = max(parent['_peak'], peak)
+            tracemalloc.reset_peak()
+            record['_base'] = record['_peak'] = current
+        self._stack.append(record)
+        self.records.append(record)
+        record['_wall'], record['_cpu'] = time.perf_counter(), time.process_time()
+        return record
+
+    def end(self) -> Dict:
+        """结束最近开始的阶段并保存记录"""
+        record = self._stack.pop()
+        record['wall_s'] = time.perf_counter() - record.pop('_wall')
+        # 进程CPU时间，包含OpenCV/BLAS工作线程
+        record['cpu_s'] = time.process_time() - record.pop('_cpu')
+        if '_base' in record:
+            peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = peak - record.pop('_base')
+            if self._stack:
+                parent = self._stack[-1]
+                parent['_peak'] = max(parent['_peak'], peak)
+        return record
+
+    def add_counts(self, **counts) -> None:
+        """为当前阶段添加计数"""
+        if self._stack:
+            self._stack[-1].update(counts)
+
+    def finished_records(self) -> List[Dict]:
+        """已结束的阶段记录"""
+        return [record for record in self.records if 'wall_s' in record]
+
+    def extend(self, other: Optional['Diagnostics']) -> None:
+        """追加另一个诊断对象的记录(如图像读取阶段)"""
+        if other is not None:
+            self.records.extend(dict(record) for record in other.finished_records())
+
+    @property
+    def total_wall_s(self) -> float:
+        """顶层阶段的墙钟时间合计"""
+        return sum(record['wall_s'] for record in self.finished_records() if '/' not in record['name'])
+
+    def to_dict(self) -> Dict:
+        return {'trace_memory': self.trace_memory,
+                'records': [dict(record) for record in self.finished_records()]}
+
+    def format_text(self) -> str:
+        """生成逐阶段诊断表格文本"""
+        records = self.finished_records()
+        has_memory = any('peak_bytes' in record for record in records)
+        lines = ["阶段诊断 (墙钟 / CPU" + (" / 内存峰值" if has_memory else "") + ")"]
+        for record in records:
+            line = f"  {record['name']:<18}{record['wall_s'] * 1000:>9.1f} ms{record['cpu_s'] * 1000:>9.1f} ms"
+            if 'peak_bytes' in record:
+                line += f"{record['peak_bytes'] / 2 ** 20:>8.1f} MB"
+            extra = {k: v for k, v in record.items()
+                     if k not in ('name', 'wall_s', 'cpu_s', 'peak_bytes')}
+            if extra:
+                line += "  " + ", ".join(f"{k}={v}" for k, v in extra.items())
+            lines.append(line)
+        lines.append(f"  合计 {self.total_wall_s * 1000:.1f} ms")
+        return "\n".join(lines)
+
+
+@contextmanager
+def _null_stage():
+    yield None
+
+
+def stage(diagnostics: Optional[Diagnostics], name: str, **counts):
+    """diagnostics为None时返回空上下文，便于在可选诊断的代码中统一使用with"""
+    if diagnostics is None:
+        return _null_stage()
+    return diagnostics.stage(name, **counts)
@@ -0,0 +1,357 @@
+"""
+DICOM乳腺钼靶图像读取
+
+- 只读文件头的快速扫描(不解码像素)，可按检查类型、体位、侧别和尺寸筛选目录中的图像
+- 未压缩传输语法的像素数据直接内存映射(np.memmap)，按需读入
+- 窗宽窗位转换为8位灰度：先为全部存储值生成查找表(位屏蔽、符号、重标定、窗宽窗位
+  和MONOCHROME1反相一次完成)，再按固定大小的分块查表，不生成整幅浮点临时数组
+
+用法示例:
+    python dicom_io.py D:/films --modality MG --view CC --laterality L
+"""
+import argparse
+import os
+import struct
+import sys
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DICOM_EXTENSIONS = ('.dcm', '.dicom')
+# 窗宽窗位转换每个分块的像素数
+CHUNK_PIXELS = 1 << 20
+
+_PIXEL_DATA_TAG = 0x7FE00010
+# 显式VR中使用4字节长度字段的VR
+_LONG_VRS = (b'OB', b'OW', b'OF', b'OD', b'OL', b'OV', b'UN', b'UT', b'UC', b'UR', b'SQ')
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def _pydicom():
+    try:
+        import pydicom
+    except ImportError:
+        raise ValueError("读取DICOM图像需要安装pydicom") from None
+    return pydicom
+
+
+def is_dicom_file(path: str) -> bool:
+    """按扩展名或文件前导区后的'DICM'标记判断是否为DICOM文件"""
+    if path.lower().endswith(DICOM_EXTENSIONS):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            f.seek(128)
+            return f.read(4) == b'DICM'
+    except OSError:
+        return False
+
+
+def _first_value(value):
+    """多值元素(如多个窗宽窗位)取第一个值"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except TypeError:
+        return float(value[0]) if len(value) else None
+
+
+def _transfer_syntax(ds):
+    """数据集的传输语法，缺少文件元信息时按隐式VR小端处理"""
+    meta = getattr(ds, 'file_meta', None)
+    transfer_syntax = meta.get('TransferSyntaxUID') if meta is not None else None
+    return transfer_syntax or _pydicom().uid.ImplicitVRLittleEndian
+
+
+def read_header(path: str) -> Dict:
+    """
+    只读取DICOM文件头(在像素数据之前停止)
+
+    参数:
+        path: DICOM文件路径
+
+    返回:
+        dict: path、modality、view(ViewPosition)、laterality、rows、columns、frames、
+        bits_allocated、bits_stored、signed、photometric、transfer_syntax、
+        window_center、window_width、rescale_slope、rescale_intercept，
+        以及pixel_offset(未压缩像素数据在文件中的偏移，无法内存映射时为None)和big_endian
+    """
+    pydicom = _pydicom()
+    try:
+        with open(path, 'rb') as f:
+            ds = pydicom.dcmread(f, stop_before_pixels=True)
+            pixel_offset = _pixel_data_offset(f, ds)
+    except (OSError, pydicom.errors.InvalidDicomError) as e:
+        raise ValueError(f"无法读取DICOM文件: {path} ({e})") from None
+
+    transfer_syntax = _transfer_syntax(ds)
+    laterality = ds.get('ImageLaterality') or ds.get('Laterality') or ''
+    return {
+        'path': path,
+        'modality': str(ds.get('Modality', '')),
+        'view': str(ds.get('ViewPosition', '')),
+        'laterality': str(laterality),
+        'rows': int(ds.get('Rows', 0)),
+        'columns': int(ds.get('Columns', 0)),
+        'frames': int(ds.get('NumberOfFrames', 1) or 1),
+        'samples_per_pixel': int(ds.get('SamplesPerPixel', 1)),
+        'bits_allocated': int(ds.get('BitsAllocated', 16)),
+        'bits_stored': int(ds.get('BitsStored', ds.get('BitsAllocated', 16))),
+        'signed': int(ds.get('PixelRepresentation', 0)) == 1,
+        'photometric': str(ds.get('PhotometricInterpretation', 'MONOCHROME2')),
+        'transfer_syntax': str(transfer_syntax),
+        'window_center': _first_value(ds.get('WindowCenter')),
+        'window_width': _first_value(ds.get('WindowWidth')),
+        'rescale_slope': _first_value(ds.get('RescaleSlope')) or 1.0,
+        'rescale_intercept': _first_value(ds.get('RescaleIntercept')) or 0.0,
+        'pixel_offset': None if transfer_syntax.is_compressed else pixel_offset,
+        'big_endian': not transfer_syntax.is_little_endian,
+    }
+
+
+def _pixel_data_offset(f, ds) -> Optional[int]:
+    """stop_before_pixels读取后文件位置位于像素数据元素处，解析元素头得到数据偏移"""
+    position = f.tell()
+    header = f.read(12)
+    if len(header) < 8:
+        return None
+    transfer_syntax = _transfer_syntax(ds)
+    order = '<' if transfer_syntax.is_little_endian else '>'
+    group, element = struct.unpack(order + 'HH', header[:4])
+    if (group << 16 | element) != _PIXEL_DATA_TAG:
+        return None
+    if transfer_syntax.is_implicit_VR:
+        length, offset = struct.unpack(order + 'I', header[4:8])[0], 8
+    elif header[4:6] in _LONG_VRS:
+        length, offset = struct.unpack(order + 'I', header[8:12])[0], 12
+    else:
+        length, offset = struct.unpack(order + 'H', header[6:8])[0], 8
+    # 未定义长度表示封装(压缩)像素数据
+    if length == _UNDEFINED_LENGTH:
+        return None
+    return position + offset
+
+
+def header_matches(header: Dict, modality: Optional[str] = None, view: Optional[str] = None,
+                   laterality: Optional[str] = None, min_size: Optional[int] = None,
+                   max_size: Optional[int] = None) -> bool:
+    """检查文件头是否满足筛选条件(字符串不区分大小写；尺寸按图像长边像素数)"""
+    for key, wanted in (('modality', modality), ('view', view), ('laterality', laterality)):
+        if wanted and header[key].upper() != wanted.upper():
+            return False
+    size = max(header['rows'], header['columns'])
+    if min_size is not None and size < min_size:
+        return False
+    if max_size is not None and size > max_size:
+        return False
+    return True
+
+
+def scan_directory(directory: str, recursive: bool = True, **filters) -> List[Dict]:
+    """
+    扫描目录中的DICOM文件头并按条件筛选，不解码像素
+
+    参数:
+        directory: 目录路径
+        recursive: 是否包含子目录
+        **filters: 传给header_matches的筛选条件
+
+    返回:
+        满足条件的文件头列表(按路径排序)；无法解析的文件被跳过
+    """
+    headers = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            # 临床DICOM文件常无扩展名，此时检查文件标记
+            if os.path.splitext(name)[1] and not name.lower().endswith(DICOM_EXTENSIONS):
+                continue
+            if not is_dicom_file(path):
+                continue
+            try:
+                header = read_header(path)
+            except ValueError:
+                continue
+            if header_matches(header, **filters):
+                headers.append(header)
+        if not recursive:
+            break
+    return headers
+
+
+def open_pixels(header: Dict) -> np.ndarray:
+    """
+    获取存储值(第一帧)的二维数组，按无符号整数解释原始位模式
+
+    未压缩像素数据返回只读np.memmap，不读入内存；压缩数据由pydicom解码
+    """
+    if header['photometric'] not in ('MONOCHROME1', 'MONOCHROME2') or header['samples_per_pixel'] != 1:
+        raise ValueError(f"不支持的DICOM光度解释: {header['photometric']}")
+    if header['bits_allocated'] not in (8, 16):
+        raise ValueError(f"不支持的DICOM位深: {header['bits_allocated']}")
+    rows, columns = header['rows'], header['columns']
+    if header['pixel_offset'] is not None:
+        dtype = np.dtype(f"u{header['bits_allocated'] // 8}")
+        dtype = dtype.newbyteorder('>' if header['big_endian'] else '<')
+        return np.memmap(header['path'], dtype=dtype, mode='r',
+                         offset=header['pixel_offset'], shape=(rows, columns))
+
+    pydicom = _pydicom()
+    try:
+        pixels = pydicom.dcmread(header['path']).pixel_array
+    except Exception as e:
+        raise ValueError(f"无法解码DICOM像素数据: {header['path']} ({e})") from None
+    if pixels.ndim == 3:
+        pixels = pixels[0]
+    return pixels.view(f"u{pixels.dtype.itemsize}")
+
+
+def stored_value_lut(header: Dict) -> np.ndarray:
+    """全部原始位模式对应的实际值(位屏蔽、符号扩展和重标定后)，float64"""
+    codes = np.arange(1 << header['bits_allocated'], dtype=np.int64)
+    bits = header['bits_stored']
+    values = codes & ((1 << bits) - 1)
+    if header['signed']:
+        values = np.where(values >= 1 << (bits - 1), values - (1 << bits), values)
+    return values * header['rescale_slope'] + header['rescale_intercept']
+
+
+def window_lut(header: Dict, center: float, width: float) -> np.ndarray:
+    """按DICOM线性VOI窗宽窗位生成原始位模式到8位灰度的查找表，MONOCHROME1自动反相"""
+    values = stored_value_lut(header)
+    scaled = ((values - (center - 0.5)) / max(float(width) - 1, 1.0) + 0.5) * 255
+    lut = np.clip(np.rint(scaled), 0, 255).astype(np.uint8)
+    if header['photometric'] == 'MONOCHROME1':
+        lut = 255 - lut
+    return lut
+
+
+def value_range(pixels: np.ndarray, header: Dict, chunk_pixels: int = CHUNK_PIXELS):
+    """分块统计原始位模式直方图，返回实际值的(最小值, 最大值)"""
+    counts = np.zeros(1 << header['bits_allocated'], dtype=np.int64)
+    for r0, r1 in _chunks(pixels.shape, chunk_pixels):
+        counts += np.bincount(np.asarray(pixels[r0:r1]).ravel(), minlength=len(counts))
+    values = stored_value_lut(header)[counts > 0]
+    return float(values.min()), float(values.max())
+
+
+def _chunks(shape, chunk_pixels):
+    rows = max(1, chunk_pixels // max(1, shape[1]))
+    for r0 in range(0, shape[0], rows):
+        yield r0, min(r0 + rows, shape[0])
+
+
+def window_to_uint8(pixels: np.ndarray, header: Dict, center: Optional[float] = None,
+                    width: Optional[float] = None, out: Optional[np.ndarray] = None,
+                    chunk_pixels: int = CHUNK_PIXELS) -> np.ndarray:
+    """
+    窗宽窗位转换为8位灰度图像(分块查表)
+
+    参数:
+        pixels: open_pixels返回的存储值数组(可为np.memmap)
+        header: read_header返回的文件头
+        center, width: 窗位和窗宽(实际值单位)，默认使用文件头中的值，
+            文件头未给出时使用图像实际值范围
+        out: 可选的输出数组(uint8，与pixels同形状)
+        chunk_pixels: 每个分块的像素数
+
+    返回:
+        numpy数组: uint8灰度图像
+    """
+    if center is None or width is None:
+        if header['window_center'] is not None and header['window_width'] is not None:
+            center, width = header['window_center'], header['window_width']
+        else:
+            low, high = value_range(pixels, header, chunk_pixels)
+            center, width = (low + high + 1) / 2, high - low + 1
+    lut = window_lut(header, center, width)
+    if out is None:
+        out = np.empty(pixels.shape, dtype=np.uint8)
+    for r0, r1 in _chunks(pixels.shape, chunk_pixels):
+        np.take(lut, pixels[r0:r1], out=out[r0:r1])
+    return out
+
+
+def read_dicom(path: str, center: Optional[float] = None, width: Optional[float] = None) -> np.ndarray:
+    """读取DICOM图像并按窗宽窗位转换为8位灰度"""
+    header = read_header(path)
+    return window_to_uint8(open_pixels(header), header, center, width)
+
+
+def write_dicom(path: str, pixels: np.ndarray, bits_stored: int = 12,
+                photometric: str = 'MONOCHROME2', modality: str = 'MG', view: str = '',
+                laterality: str = '', window: Optional[tuple] = None,
+                rescale: Optional[tuple] = None, rle: bool = False) -> None:
+    """
+    将整数图像保存为DICOM文件(默认未压缩的显式VR小端)，用于生成测试数据
+
+    参数:
+        pixels: uint8/uint16(无符号)或int8/int16(有符号)二维数组，存储值不超过bits_stored位
+        window: 可选的(窗位, 窗宽)，实际值单位
+        rescale: 可选的(斜率, 截距)
+        rle: 是否以RLE无损压缩保存(像素数据无法内存映射，读取时由pydicom解码)
+    """
+    pydicom = _pydicom()
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1.2'  # 数字乳腺X线图像
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = modality
+    ds.ViewPosition = view
+    ds.ImageLaterality = laterality
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.BitsAllocated = pixels.dtype.itemsize * 8
+    ds.BitsStored = min(bits_stored, ds.BitsAllocated)
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 1 if pixels.dtype.kind == 'i' else 0
+    if window is not None:
+        ds.WindowCenter, ds.WindowWidth = window
+    if rescale is not None:
+        ds.RescaleSlope, ds.RescaleIntercept = rescale
+    ds.PixelData = np.ascontiguousarray(pixels, dtype=pixels.dtype.newbyteorder('<')).tobytes()
+    if rle:
+        from pydicom.uid import RLELossless
+
+        ds.compress(RLELossless)
+    pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="扫描目录中的DICOM文件头并按条件筛选(不解码像素)")
+    parser.add_argument('directory', help="DICOM目录")
+    parser.add_argument('--modality', help="检查类型，如MG")
+    parser.add_argument('--view', help="体位，如CC、MLO")
+    parser.add_argument('--laterality', help="侧别，L或R")
+    parser.add_argument('--min-size', type=int, help="图像长边最小像素数")
+    parser.add_argument('--max-size', type=int, help="图像长边最大像素数")
+    parser.add_argument('--no-recursive', action='store_true', help="不扫描子目录")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    headers = scan_directory(args.directory, recursive=not args.no_recursive,
+                             modality=args.modality, view=args.view, laterality=args.laterality,
+                             min_size=args.min_size, max_size=args.max_size)
+    for header in headers:
+        mapped = '映射' if header['pixel_offset'] is not None else '解码'
+        print(f"{header['path']}\t{header['modality']}\t{header['view']}\t{header['laterality']}\t"
+              f"{header['columns']}x{header['rows']}\t{header['bits_stored']}位\t"
+              f"{header['photometric']}\t{mapped}")
+    print(f"共 {len(headers)} 个文件满足条件", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
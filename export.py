@@ -0,0 +1,408 @@
+"""
+分析结果导出
+
+支持两种格式:
+    目录格式: 标注图像(JPEG)、分析报告文本和病灶特征CSV，与原有保存方式相同
+    结果包(.mammo): 单个文件，内含deflate压缩的位掩码、病灶特征表、分析参数和报告文本，
+        掩码无损，不含原图(只记录原图路径和像素哈希，载入时据此核对)，可直接载入而无需重新分析
+
+ExportWriter在后台线程按提交顺序执行写出任务，界面线程提交后即可继续操作。
+写入采用临时文件 + 原子替换，写出中断不会留下不完整的结果包。
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from result import AnalysisResult
+
+# 结果包扩展名(内部为npz/zip容器)
+BUNDLE_SUFFIX = '.mammo'
+# 结果包格式版本，格式不兼容变化时递增
+BUNDLE_FORMAT_VERSION = 1
+# 报告中默认列出的病灶数
+REPORT_LESIONS = 3
+
+
+def snapshot_result(result: AnalysisResult) -> AnalysisResult:
+    """
+    复制结果对象用于后台写出
+
+    掩码、查找表和原图按引用共享(只读)，病灶特征表单独复制，后台补算形态特征时
+    不与界面线程的按需补算同时修改同一数组
+    """
+    arrays = result.to_arrays()
+    arrays['lesion_table'] = result.lesion_table.copy()
+    return AnalysisResult.from_arrays(result.original_img, arrays)
+
+
+def write_result_directory(result: AnalysisResult, save_dir: str, base_name: str,
+                           report: str) -> str:
+    """
+    按目录格式保存标注图像、分析报告和病灶特征
+
+    参数:
+        result: 分析结果(未计算的形态特征在此补算)
+        save_dir: 输出目录，不存在时创建
+        base_name: 输出文件名前缀(通常为原图文件名)
+        report: 报告文本
+
+    返回:
+        输出目录
+    """
+    import cv2
+    import processing
+
+    os.makedirs(save_dir, exist_ok=True)
+    highlighted_img = result['highlighted_img']
+    marked_img_path = os.path.join(save_dir, f"{base_name}_marked.jpg")
+    if len(highlighted_img.shape) == 2:
+        ok = cv2.imwrite(marked_img_path, highlighted_img)
+    else:
+        ok = cv2.imwrite(marked_img_path, cv2.cvtColor(highlighted_img, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise ValueError(f"无法写入标注图像: {marked_img_path}")
+
+    with open(os.path.join(save_dir, f"{base_name}_report.txt"), "w", encoding="utf-8") as f:
+        f.write(report)
+
+    processing.complete_shape_features(result)
+    processing.save_lesion_features(result.lesion_table, save_dir)
+    return save_dir
+
+
+def analysis_report(result: AnalysisResult, report_lesions: int = REPORT_LESIONS) -> str:
+    """
+    生成分析报告文本(界面保存和监视目录写出共用)
+
+    参数:
+        result: 分析结果(只补算报告用到的病灶的形态特征)
+        report_lesions: 报告中列出的病灶数
+
+    返回:
+        报告文本
+    """
+    import processing
+
+    height, width = result.shape
+    report = f"乳腺钼靶图像分析报告\n\n"
+    report += f"图像尺寸: {width}×{height}\n"
+    report += f"病灶区域占比: {result['lesion_percentage']:.2f}%\n"
+    report += f"检测到 {result['lesion_count']} 个可疑病灶\n\n"
+
+    # 直接使用按面积降序的病灶特征表
+    table = result.lesion_table
+    processing.complete_shape_features(result, range(min(report_lesions, len(table))))
+    if result['lesion_count'] > 0:
+        report += "主要病灶特征：\n"
+        for i, lesion in enumerate(table[:report_lesions]):
+            report += f"  病灶 {i+1}:\n"
+            report += f"    面积: {lesion['area']} 像素\n"
+            report += f"    圆形度: {lesion['circularity']:.2f}\n"
+            report += f"    长轴长度: {lesion['major_axis_length']:.1f} 像素\n"
+
+    # 医学建议
+    if result['lesion_count'] == 0 or result['lesion_percentage'] < 0.5:
+        report += "\n建议：未见明显异常，建议每年定期复查。"
+    elif result['lesion_count'] <= 2 and table[0]['circularity'] > 0.7:
+        report += "\n建议：发现良性可能病灶，建议6个月后复查超声。"
+    else:
+        report += "\n建议：发现可疑病灶，形态学特征不规则，建议尽快到乳腺专科就诊。"
+
+    return report
+
+
+def _text_array(text: str) -> np.ndarray:
+    # 以Unicode字符串数组保存，读取时无需allow_pickle
+    return np.array(text)
+
+
+def _save_bundle(f, result: AnalysisResult, report: str, params: Optional[Dict],
+                 image_path: Optional[str], image_digest: Optional[str]) -> None:
+    """按结果包格式写入已打开的二进制文件对象f"""
+    import processing
+
+    processing.complete_shape_features(result)
+    meta = {
+        'format_version': BUNDLE_FORMAT_VERSION,
+        'pipeline_version': processing.PIPELINE_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'image_path': os.path.abspath(image_path) if image_path else None,
+        'image_digest': image_digest,
+        'params': params or {},
+    }
+    np.savez_compressed(f, meta=_text_array(json.dumps(meta, ensure_ascii=False)),
+                        report=_text_array(report), **result.to_arrays())
+
+
+def write_bundle(path: str, result: AnalysisResult, report: str = "",
+                 params: Optional[Dict] = None, image_path: Optional[str] = None,
+                 image_digest: Optional[str] = None) -> str:
+    """
+    保存单文件结果包
+
+    参数:
+        path: 输出文件路径
+        result: 分析结果(未计算的形态特征在此补算，载入后无需再算)
+        report: 报告文本
+        params: 分析参数
+        image_path: 原图路径，载入时据此读取原图
+        image_digest: 原图像素哈希(cache.image_digest)，载入时核对原图未被修改
+
+    返回:
+        输出文件路径
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            _save_bundle(f, result, report, params, image_path, image_digest)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def bundle_bytes(result: AnalysisResult, report: str = "", params: Optional[Dict] = None,
+                 image_digest: Optional[str] = None) -> bytes:
+    """结果包的文件内容(不写入磁盘，如作为网络响应)，格式同write_bundle"""
+    buffer = io.BytesIO()
+    _save_bundle(buffer, result, report, params, None, image_digest)
+    return buffer.getvalue()
+
+
+def read_bundle(path: str) -> Dict:
+    """
+    读取结果包
+
+    返回:
+        dict: meta(参数、原图路径和哈希等)、report(报告文本)、arrays(AnalysisResult.from_arrays所需数组)
+    """
+    if not os.path.isfile(path) or not zipfile.is_zipfile(path):
+        raise ValueError(f"不是有效的结果包: {path}")
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {key: data[key] for key in data.files}
+    except (OSError, ValueError) as e:
+        raise ValueError(f"无法读取结果包 {path}: {e}")
+    if 'meta' not in arrays:
+        raise ValueError(f"不是有效的结果包: {path}")
+    meta = json.loads(str(arrays.pop('meta')))
+    if meta.get('format_version', 0) > BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"结果包格式版本过新({meta['format_version']})，请升级程序")
+    return {'meta': meta, 'report': str(arrays.pop('report')), 'arrays': arrays}
+
+
+def bundle_image_path(bundle: Dict, bundle_path: str) -> str:
+    """
+    结果包对应的原图路径
+
+    优先使用记录的路径；原图与结果包一同移动过时，在结果包所在目录按文件名查找
+    """
+    recorded = bundle['meta'].get('image_path')
+    if not recorded:
+        raise ValueError("结果包未记录原图路径")
+    if os.path.exists(recorded):
+        return recorded
+    nearby = os.path.join(os.path.dirname(os.path.abspath(bundle_path)), os.path.basename(recorded))
+    if os.path.exists(nearby):
+        return nearby
+    raise ValueError(f"原图不存在: {recorded}")
+
+
+def bundle_result(bundle: Dict, original_img: np.ndarray,
+                  image_digest: Optional[str] = None) -> AnalysisResult:
+    """
+    由结果包重建分析结果(不重新分析)
+
+    参数:
+        bundle: read_bundle的返回值
+        original_img: 原图
+        image_digest: 原图的像素哈希，省略时在此计算；与结果包记录的不一致时报错
+    """
+    import cache
+
+    arrays = bundle['arrays']
+    if tuple(int(v) for v in arrays['shape']) != tuple(original_img.shape[:2]):
+        raise ValueError("原图尺寸与结果包不一致")
+    recorded = bundle['meta'].get('image_digest')
+    if recorded:
+        if image_digest is None:
+            image_digest = cache.image_digest(original_img)
+        if image_digest != recorded:
+            raise ValueError("原图内容与结果包记录不一致(图像可能已被修改)")
+    return AnalysisResult.from_arrays(original_img, arrays)
+
+
+class ExportJob:
+    """
+    一次结果写出任务
+
+    参数:
+        result: 分析结果，提交前应由snapshot_result复制
+        target: 输出路径(结果包文件或目录格式的输出目录)
+        bundle: True写出结果包，False写出目录格式
+        report: 报告文本
+        params: 分析参数(写入结果包)
+        image_path: 原图路径
+        image_digest: 原图像素哈希
+        analysis_cache: 可选的cache.AnalysisCache，写出后同时写入缓存
+        cache_key: 写入缓存的键
+        feature_store: 可选的store.FeatureStore，写出后同时写入特征库
+    """
+
+    __slots__ = ('result', 'target', 'bundle', 'report', 'params', 'image_path',
+                 'image_digest', 'analysis_cache', 'cache_key', 'feature_store')
+
+    def __init__(self, result, target, bundle=False, report="", params=None, image_path=None,
+                 image_digest=None, analysis_cache=None, cache_key=None, feature_store=None):
+        self.result = result
+        self.target = target
+        self.bundle = bundle
+        self.report = report
+        self.params = params
+        self.image_path = image_path
+        self.image_digest = image_digest
+        self.analysis_cache = analysis_cache
+        self.cache_key = cache_key
+        self.feature_store = feature_store
+
+    def run(self) -> None:
+        if self.bundle:
+            write_bundle(self.target, self.result, self.report, self.params,
+                         self.image_path, self.image_digest)
+        else:
+            base_name = os.path.splitext(os.path.basename(self.image_path or self.target))[0]
+            write_result_directory(self.result, self.target, base_name, self.report)
+        if self.analysis_cache is not None and self.cache_key is not None:
+            self.analysis_cache.put(self.cache_key, self.result)
+        if self.feature_store is not None:
+            import store
+
+            # 形态特征已在写出时补算完整
+            self.feature_store.add(store.entry_from_result(
+                self.image_path or self.target, self.result, self.params, self.image_digest))
+            self.feature_store.flush()
+
+
+class ExportWriter:
+    """
+    后台结果写出队列，单个写出线程按提交顺序执行任务
+
+    参数:
+        on_done: 可选的on_done(job, elapsed_seconds)回调，在写出线程中调用
+        on_error: 可选的on_error(job, message)回调，在写出线程中调用
+    """
+
+    def __init__(self, on_done: Optional[Callable] = None, on_error: Optional[Callable] = None):
+        self.on_done = on_done
+        self.on_error = on_error
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._thread = None
+
+    @property
+    def pending(self) -> int:
+        """尚未完成(排队或正在写出)的任务数"""
+        with self._lock:
+            return self._pending
+
+    def submit(self, job: ExportJob) -> ExportJob:
+        """提交写出任务，立即返回"""
+        with self._lock:
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='export-writer', daemon=True)
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            start = time.perf_counter()
+            try:
+                job.run()
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(job, str(e))
+                else:
+                    print(f"写出失败 {job.target}: {e}", file=sys.stderr)
+            else:
+                if self.on_done is not None:
+                    self.on_done(job, time.perf_counter() - start)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                self._queue.task_done()
+
+    def wait(self) -> None:
+        """等待已提交的任务全部完成"""
+        self._queue.join()
+
+    def close(self) -> None:
+        """写完已提交的任务后结束写出线程"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='查看结果包，或将其转换为目录格式(不重新分析)')
+    parser.add_argument('bundle', help=f'结果包文件(*{BUNDLE_SUFFIX})')
+    parser.add_argument('--export-dir', help='按目录格式(标注图像、报告、特征CSV)输出到该目录')
+    parser.add_argument('--image', help='原图路径(默认使用结果包中记录的路径)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        bundle = read_bundle(args.bundle)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    meta, arrays = bundle['meta'], bundle['arrays']
+    height, width = (int(v) for v in arrays['shape'])
+    print(f"原图: {meta.get('image_path')} ({width}x{height})")
+    print(f"创建时间: {meta.get('created')}  流水线版本: {meta.get('pipeline_version')}")
+    print(f"参数: {json.dumps(meta.get('params', {}), ensure_ascii=False)}")
+    print(f"病灶: {len(arrays['lesion_table'])} 个，占比 {float(arrays['lesion_percentage']):.2f}%")
+    if not args.export_dir:
+        return 0
+
+    import utils
+
+    try:
+        image_path = args.image or bundle_image_path(bundle, args.bundle)
+        result = bundle_result(bundle, utils.read_image(image_path))
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        write_result_directory(result, args.export_dir, base_name, bundle['report'])
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f"已输出至: {args.export_dir}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+列式病灶特征计算
+
+面积、边界框、质心和二阶矩(长短轴、离心率)对全部连通域一次性向量化计算，
+按行分段累加，工作内存与分段大小有关；周长、圆形度和凸包实度代价较高，
+只对按面积排序后的前N个病灶或按需计算，未计算时为NaN。
+"""
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from scipy import ndimage
+
+from result import LESION_DTYPE
+
+# 需要逐病灶计算的形态特征
+SHAPE_FIELDS = ('perimeter', 'circularity', 'solidity')
+# 分段累加矩时每段的像素数
+CHUNK_PIXELS = 1 << 20
+
+# 矩的各项: 像素数，以及相对连通域边界框左上角坐标的一阶、二阶原点矩
+MOMENT_KEYS = ('count', 'sum_r', 'sum_c', 'sum_rr', 'sum_cc', 'sum_rc')
+# 边界框各项(闭区间)
+BOUND_KEYS = ('min_row', 'min_col', 'max_row', 'max_col')
+
+
+def component_moments(labeled_mask: np.ndarray, num_labels: int,
+                      offset: Tuple[int, int] = (0, 0),
+                      chunk_pixels: int = CHUNK_PIXELS) -> Dict[str, np.ndarray]:
+    """
+    统计标记图中各连通域的边界框和矩
+
+    参数:
+        labeled_mask: 连通域标记图(0为背景，标签1..num_labels)
+        num_labels: 标签数
+        offset: 标记图左上角在原图中的坐标，边界框按原图坐标给出
+
+    返回:
+        dict: min_row/min_col/max_row/max_col(闭区间，原图坐标)及MOMENT_KEYS各项，
+        均为长度num_labels的数组，第i项对应标签i+1
+    """
+    height, width = labeled_mask.shape
+    moments = {key: np.zeros(num_labels, dtype=np.float64) for key in MOMENT_KEYS}
+    slices = ndimage.find_objects(labeled_mask, num_labels)
+    bounds = np.array([(s[0].start, s[1].start, s[0].stop - 1, s[1].stop - 1) if s is not None
+                       else (0, 0, -1, -1) for s in slices], dtype=np.int64).reshape(-1, 4)
+    min_rows, min_cols = bounds[:, 0], bounds[:, 1]
+
+    band = max(1, chunk_pixels // max(1, width))
+    for r0 in range(0, height, band):
+        flat = labeled_mask[r0:r0 + band].ravel()
+        index = np.flatnonzero(flat)
+        if not index.size:
+            continue
+        labels = flat[index].astype(np.intp) - 1
+        rows, cols = np.divmod(index, width)
+        rows = rows.astype(np.float64)
+        rows += r0
+        cols = cols.astype(np.float64)
+        for key, weights in (('count', None), ('sum_r', rows), ('sum_c', cols),
+                             ('sum_rr', rows * rows), ('sum_cc', cols * cols),
+                             ('sum_rc', rows * cols)):
+            moments[key] += np.bincount(labels, weights=weights, minlength=num_labels)
+
+    # 坐标为整数，各项和在2**53以内时float64累加无舍入误差，平移到各自边界框左上角后
+    # 二阶矩数值较小，避免后续大数平方相减的精度损失
+    n = moments['count']
+    dr, dc = min_rows.astype(np.float64), min_cols.astype(np.float64)
+    moments['sum_rr'] -= 2 * dr * moments['sum_r'] - n * dr * dr
+    moments['sum_cc'] -= 2 * dc * moments['sum_c'] - n * dc * dc
+    moments['sum_rc'] -= dr * moments['sum_c'] + dc * moments['sum_r'] - n * dr * dc
+    moments['sum_r'] -= n * dr
+    moments['sum_c'] -= n * dc
+
+    moments['min_row'] = min_rows + offset[0]
+    moments['min_col'] = min_cols + offset[1]
+    moments['max_row'] = bounds[:, 2] + offset[0]
+    moments['max_col'] = bounds[:, 3] + offset[1]
+    return moments
+
+
+def merge_moments(moments: Dict[str, np.ndarray], groups: np.ndarray,
+                  num_groups: int) -> Dict[str, np.ndarray]:
+    """
+    将多个连通域片段(如跨分块的同一病灶)的矩合并
+
+    参数:
+        moments: component_moments的结果(可由多个分块的结果拼接)
+        groups: 每个片段所属的合并后编号(0..num_groups-1)
+        num_groups: 合并后的连通域数
+
+    返回:
+        dict: 与component_moments格式相同的合并结果
+    """
+    merged = {'min_row': np.full(num_groups, np.iinfo(np.int64).max, dtype=np.int64),
+              'min_col': np.full(num_groups, np.iinfo(np.int64).max, dtype=np.int64),
+              'max_row': np.full(num_groups, -1, dtype=np.int64),
+              'max_col': np.full(num_groups, -1, dtype=np.int64)}
+    np.minimum.at(merged['min_row'], groups, moments['min_row'])
+    np.minimum.at(merged['min_col'], groups, moments['min_col'])
+    np.maximum.at(merged['max_row'], groups, moments['max_row'])
+    np.maximum.at(merged['max_col'], groups, moments['max_col'])
+
+    # 片段的矩以片段边界框为原点，先平移到合并后边界框的原点再累加
+    n = moments['count']
+    dr = (moments['min_row'] - merged['min_row'][groups]).astype(np.float64)
+    dc = (moments['min_col'] - merged['min_col'][groups]).astype(np.float64)
+    shifted = {
+        'count': n,
+        'sum_r': moments['sum_r'] + n * dr,
+        'sum_c': moments['sum_c'] + n * dc,
+        'sum_rr': moments['sum_rr'] + 2 * dr * moments['sum_r'] + n * dr * dr,
+        'sum_cc': moments['sum_cc'] + 2 * dc * moments['sum_c'] + n * dc * dc,
+        'sum_rc': moments['sum_rc'] + dr * moments['sum_c'] + dc * moments['sum_r'] + n * dr * dc,
+    }
+    for key in MOMENT_KEYS:
+        merged[key] = np.bincount(groups, weights=shifted[key], minlength=num_groups)
+    return merged
+
+
+def table_from_moments(moments: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    由矩生成病灶特征表(LESION_DTYPE)
+
+    长短轴和离心率与skimage.measure.regionprops的定义一致(由惯性张量特征值计算)；
+    SHAPE_FIELDS各列为NaN，由fill_shape_features按需填充
+    """
+    n = moments['count']
+    table = np.zeros(len(n), dtype=LESION_DTYPE)
+    if not len(n):
+        return table
+    mean_r, mean_c = moments['sum_r'] / n, moments['sum_c'] / n
+    var_r = np.maximum(moments['sum_rr'] / n - mean_r ** 2, 0)
+    var_c = np.maximum(moments['sum_cc'] / n - mean_c ** 2, 0)
+    cov = moments['sum_rc'] / n - mean_r * mean_c
+    # 惯性张量[[var_c, -cov], [-cov, var_r]]的特征值
+    half_trace = (var_r + var_c) / 2
+    radius = np.sqrt(((var_c - var_r) / 2) ** 2 + cov ** 2)
+    major = np.maximum(half_trace + radius, 0)
+    minor = np.maximum(half_trace - radius, 0)
+
+    table['area'] = n
+    table['major_axis_length'] = 4 * np.sqrt(major)
+    table['minor_axis_length'] = 4 * np.sqrt(minor)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['eccentricity'] = np.where(major > 0, np.sqrt(np.maximum(1 - minor / major, 0)), 0)
+    table['bounding_box'] = np.stack([moments['min_row'], moments['min_col'],
+                                      moments['max_row'] + 1, moments['max_col'] + 1], axis=1)
+    table['centroid'] = np.stack([moments['min_row'] + mean_r, moments['min_col'] + mean_c], axis=1)
+    for field in SHAPE_FIELDS:
+        table[field] = np.nan
+    return table
+
+
+def component_table(labeled_mask: np.ndarray, num_labels: Optional[int] = None) -> np.ndarray:
+    """全部连通域的特征表，第i行对应标签i+1(形态特征为NaN)"""
+    if num_labels is None:
+        num_labels = int(labeled_mask.max())
+    return table_from_moments(component_moments(labeled_mask, num_labels))
+
+
+def shape_features(region_image: np.ndarray) -> Tuple[float, float, float]:
+    """单个病灶(边界框内的布尔图像)的(周长, 圆形度, 凸包实度)，与regionprops一致"""
+    from skimage import measure
+
+    region = measure.regionprops(region_image.astype(np.uint8))[0]
+    perimeter = region.perimeter
+    circularity = 4 * np.pi * region.area / (perimeter ** 2) if perimeter > 0 else 0
+    return perimeter, circularity, region.solidity
+
+
+def missing_shape_rows(table: np.ndarray, indices: Optional[Iterable[int]] = None) -> np.ndarray:
+    """indices(默认全部行)中尚未计算形态特征的行号"""
+    rows = np.arange(len(table)) if indices is None else np.asarray(list(indices), dtype=np.intp)
+    return rows[np.isnan(table['perimeter'][rows])]
+
+
+def fill_shape_features(table: np.ndarray, region_image: Callable[[int], np.ndarray],
+                        indices: Optional[Iterable[int]] = None,
+                        progress_callback: Optional[Callable[[int, int], None]] = None) -> int:
+    """
+    计算并填入指定行的形态特征(已计算的行跳过)
+
+    参数:
+        table: 病灶特征表，原地修改
+        region_image: region_image(row)返回该行病灶在其边界框内的布尔图像
+        indices: 需要形态特征的行号，默认全部
+        progress_callback: 可选的progress_callback(done, total)，逐病灶调用
+
+    返回:
+        新计算的病灶数
+    """
+    rows = missing_shape_rows(table, indices)
+    for i, row in enumerate(rows):
+        if progress_callback is not None:
+            progress_callback(i, len(rows))
+        table['perimeter'][row], table['circularity'][row], table['solidity'][row] = \
+            shape_features(region_image(row))
+    return len(rows)
+
+
+def mask_region_image(mask_window: np.ndarray, area: float) -> np.ndarray:
+    """
+    在病灶边界框内的掩码窗口中找出该病灶(面积相等且触及边界框四边的连通域)
+
+    用于只有掩码、没有连通域标记图的场合(如缓存或重新载入的结果)
+    """
+    labels, num = ndimage.label(mask_window)
+    if num == 1:
+        return labels == 1
+    counts = np.bincount(labels.ravel(), minlength=num + 1)
+    counts[0] = 0  # 背景
+    touches = np.ones(num + 1, dtype=bool)
+    for edge in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+        touches &= np.isin(np.arange(num + 1), edge)
+    candidates = np.flatnonzero((counts == int(area)) & touches)
+    label = candidates[0] if candidates.size else int(np.argmax(counts))
+    return labels == label
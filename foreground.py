@@ -0,0 +1,144 @@
+"""
+乳腺前景检测
+
+在降采样图像上找出乳房区域(皮肤线以内)的外接矩形，供分析前裁剪，去掉大片背景；
+可选检测内外斜位(MLO)图像胸壁侧上角的胸大肌三角区，分析前将其置为背景。
+检测只用于确定分析范围，结果由processing按原图坐标给出。
+"""
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# 检测在长边不超过该值的降采样图像上进行
+DETECT_SIZE = 512
+# 裁剪框在原分辨率下向外扩展的像素数，使皮肤线附近的滤波与形态学运算不受裁剪边界影响
+FOREGROUND_MARGIN = 16
+# Otsu阈值以下部分的平均灰度超过该值时认为图像没有可去除的背景(如整幅都是组织的局部片)
+MAX_BACKGROUND_LEVEL = 40
+# 前景阈值取背景均值加若干倍背景噪声标准差(不超过Otsu阈值)，保留较暗的皮肤线附近组织
+BACKGROUND_NOISE_SIGMAS = 3
+# 乳房区域占比低于该值时认为检测失败，不裁剪
+MIN_FOREGROUND_FRACTION = 0.05
+
+# 胸大肌只在胸壁侧上角的该比例范围(行, 列)内寻找
+PECTORAL_SEARCH = (0.6, 0.5)
+# 胸大肌边界直线拟合的最低决定系数，低于该值认为不是三角形的胸大肌区
+PECTORAL_MIN_R2 = 0.8
+# 胸大肌区最多占乳房区域的比例
+PECTORAL_MAX_FRACTION = 0.35
+
+
+def _downsample(img: np.ndarray) -> Tuple[np.ndarray, float]:
+    """缩小到长边不超过DETECT_SIZE，返回(小图, 缩放倍数)"""
+    scale = max(1.0, max(img.shape) / DETECT_SIZE)
+    if scale == 1.0:
+        return np.ascontiguousarray(img), scale
+    size = (max(1, int(round(img.shape[1] / scale))), max(1, int(round(img.shape[0] / scale))))
+    return cv2.resize(np.ascontiguousarray(img), size, interpolation=cv2.INTER_AREA), scale
+
+
+def _breast_region(small: np.ndarray) -> Optional[np.ndarray]:
+    """降采样图像中的乳房区域(布尔，最大连通域)；没有可去除的背景时返回None"""
+    otsu, _ = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    background = small[small <= otsu]
+    if background.size == 0 or background.mean() > MAX_BACKGROUND_LEVEL:
+        return None
+    threshold = min(otsu, background.mean() + BACKGROUND_NOISE_SIGMAS * background.std())
+    binary = (small > threshold).astype(np.uint8)
+    # 开运算去掉背景噪声和细小标记，闭运算连接皮肤线附近断开的部分
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+    num, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    if num < 2:
+        return None
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    if stats[largest, cv2.CC_STAT_AREA] < MIN_FOREGROUND_FRACTION * small.size:
+        return None
+    return labels == largest
+
+
+def foreground_box(img: np.ndarray, margin: int = FOREGROUND_MARGIN) -> Tuple[int, int, int, int]:
+    """
+    乳房区域在原图中的外接矩形
+
+    参数:
+        img: 8位灰度图像
+        margin: 向外扩展的像素数
+
+    返回:
+        (r0, r1, c0, c1): 行、列范围(左闭右开)；没有可去除的背景或检测失败时为整幅图像
+    """
+    height, width = img.shape
+    small, scale = _downsample(img)
+    region = _breast_region(small)
+    if region is None:
+        return 0, height, 0, width
+    rows = np.flatnonzero(region.any(axis=1))
+    cols = np.flatnonzero(region.any(axis=0))
+    # 小图中的一个像素对应原图scale个像素，边界向外取整
+    return (max(0, int(rows[0] * scale) - margin), min(height, int(np.ceil((rows[-1] + 1) * scale)) + margin),
+            max(0, int(cols[0] * scale) - margin), min(width, int(np.ceil((cols[-1] + 1) * scale)) + margin))
+
+
+def pectoral_mask(img: np.ndarray) -> Optional[np.ndarray]:
+    """
+    检测胸大肌区
+
+    胸壁侧取乳房区域较宽的一侧；在胸壁侧上角用乳房区域内的Otsu阈值取出与上角相连的
+    亮区，按每行的外侧边界拟合直线，直线向下收窄到胸壁且拟合良好时认为是胸大肌，
+    返回直线与胸壁、上边缘围成的三角区。
+
+    参数:
+        img: 8位灰度图像(通常为foreground_box裁剪后的图像)
+
+    返回:
+        np.ndarray或None: 与img同尺寸的布尔掩码；未检测到胸大肌时为None
+    """
+    height, width = img.shape
+    small, scale = _downsample(img)
+    region = _breast_region(small)
+    if region is None:
+        # 没有背景时整幅都是乳房组织
+        region = np.ones(small.shape, dtype=bool)
+    # 统一翻转为胸壁在左
+    half = small.shape[1] // 2
+    flip = region[:, half:].sum() > region[:, :half].sum()
+    if flip:
+        small, region = small[:, ::-1], region[:, ::-1]
+
+    # 搜索范围从乳房区域的上缘开始
+    top = int(np.argmax(region.any(axis=1)))
+    rows, cols = int(small.shape[0] * PECTORAL_SEARCH[0]), int(small.shape[1] * PECTORAL_SEARCH[1])
+    window, inside = small[top:top + rows, :cols], region[top:top + rows, :cols]
+    rows = window.shape[0]
+    if rows < 8 or cols < 8 or not inside[0, 0] or np.count_nonzero(inside) < 64:
+        return None
+    threshold, _ = cv2.threshold(window[inside].reshape(1, -1), 0, 255,
+                                 cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    bright = ((window > threshold) & inside).astype(np.uint8)
+    _, labels = cv2.connectedComponents(bright, connectivity=8)
+    corner = labels[0, 0]
+    if corner == 0:
+        return None
+    muscle = labels == corner
+    extent = np.where(muscle.any(axis=1), cols - np.argmax(muscle[:, ::-1], axis=1), 0)
+    used = np.flatnonzero(extent)
+    # 只用连续贴着上边缘的各行拟合
+    used = used[used == np.arange(len(used))]
+    if len(used) < 4 or used[-1] == rows - 1:
+        return None
+    slope, intercept = np.polyfit(used, extent[used], 1)
+    residual = extent[used] - (slope * used + intercept)
+    variance = np.var(extent[used])
+    if slope >= 0 or intercept <= 0 or variance == 0 or 1 - np.var(residual) / variance < PECTORAL_MIN_R2:
+        return None
+
+    # 三角区: 每行列号小于边界直线的部分(原图坐标)
+    row_centers = (np.arange(height, dtype=np.float64) + 0.5) / scale - 0.5 - top
+    boundary = (slope * row_centers + intercept) * scale
+    mask = np.arange(width)[None, :] < boundary[:, None]
+    if np.count_nonzero(mask) > PECTORAL_MAX_FRACTION * np.count_nonzero(region) * scale * scale:
+        return None
+    return mask[:, ::-1] if flip else mask
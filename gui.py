@@ -1,54 +1,457 @@
 import sys
 import os
+import time
+from collections import OrderedDict
 import cv2
 import numpy as np
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QLabel, QPushButton, QFileDialog,
                              QVBoxLayout, QHBoxLayout, QSpinBox, QProgressBar, QGroupBox,
-                             QApplication, QMessageBox)
-from PyQt5.QtGui import QIcon, QImage, QPixmap, QFont
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer
-import processing
+                             QApplication, QMessageBox, QCheckBox, QToolButton, QListWidget,
+                             QShortcut)
+from PyQt5.QtGui import QIcon, QImage, QPixmap, QFont, QKeySequence
+from PyQt5.QtCore import Qt, QThread, QObject, pyqtSignal, QTimer
+# 分析模块(processing)依赖scipy/scikit-image/scikit-learn，导入较慢；
+# 界面启动时不导入，由WarmUpThread在后台预先导入，用到的地方再局部导入
+import cache
+import export
+import session
+import store
+import tracemalloc
+import workers
+from diagnostics import Diagnostics, stage as diagnostics_stage
 from datetime import datetime
 
 # 导入用户提供的辅助函数
 import utils as utils  # 请替换为实际模块名
+import viewer
 
 
-class AnalysisThread(QThread):
+# 每个显示标签缓存的QPixmap数量(不同内容/尺寸)
+PIXMAP_CACHE_SIZE = 4
+# 窗口尺寸变化后延迟重绘(毫秒)，合并连续的尺寸变化
+REDISPLAY_DELAY_MS = 30
+# 分析进程池模式下轮询进度的间隔(毫秒)
+PROGRESS_POLL_MS = 50
+# 测量事件循环延迟的定时器间隔(毫秒)
+LATENCY_PROBE_MS = 10
+# 报告中列出的病灶数；分析时只为这些病灶计算周长、圆形度等形态特征，其余按需计算
+REPORT_LESIONS = 3
+# 粗到细模式的降采样倍数(先显示降采样预览，再在候选区域内按原分辨率细化)
+COARSE_FACTOR = 4
+
+# 流水线阶段在进度条上显示的名称
+STAGE_LABELS = {
+    'enhance': '预处理',
+    'smooth': '预处理',
+    'histogram': '聚类',
+    'cluster': '聚类',
+    'mask': '聚类',
+    'morphology': '形态学处理',
+    'filter': '病灶过滤',
+    'features': '特征提取',
+    'done': '完成',
+}
+
+
+class WarmUpThread(QThread):
+    """后台导入分析模块并预热KMeans/OpenMP，使首次分析不承担一次性开销"""
+    warmed_up = pyqtSignal(float)
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            import processing
+            processing.warm_up()
+        except Exception as e:
+            print(f"预热失败: {e}", file=sys.stderr)
+            return
+        self.warmed_up.emit(time.perf_counter() - start)
+
+
+class ExportSignals(QObject):
+    """后台写出完成/失败的信号，由写出线程发出，在界面线程处理"""
+    export_finished = pyqtSignal(object, float)
+    export_failed = pyqtSignal(object, str)
+
+
+class CancellableThread(QThread):
+    """支持协作式取消的工作线程，记录从请求取消到线程空闲的延迟"""
+    analysis_cancelled = pyqtSignal(float)
+
+    def __init__(self):
+        super().__init__()
+        self.cancel_requested_at = None
+
+    def cancel(self):
+        """请求取消，分析引擎在下一个检查点停止"""
+        if self.cancel_requested_at is None:
+            self.cancel_requested_at = time.perf_counter()
+
+    def is_cancelled(self):
+        return self.cancel_requested_at is not None
+
+    def emit_cancelled(self):
+        self.analysis_cancelled.emit((time.perf_counter() - self.cancel_requested_at) * 1000)
+
+
+class AnalysisThread(CancellableThread):
     """图像分析线程，防止UI卡顿"""
     update_progress = pyqtSignal(int)
-    finish_analysis = pyqtSignal(dict)
+    update_stage = pyqtSignal(str)
+    preview_ready = pyqtSignal(object)
+    finish_analysis = pyqtSignal(object)
     analysis_error = pyqtSignal(str)
 
-    def __init__(self, img, k_value):
+    def __init__(self, pipeline, params, analysis_cache, image_digest=None, diagnostics=None):
         super().__init__()
-        self.img = img
-        self.k_value = k_value
+        self.pipeline = pipeline
+        self.params = params
+        self.analysis_cache = analysis_cache
+        self.image_digest = image_digest
+        self.diagnostics = diagnostics
+        self.cache_key = None
+        self._last_progress = None
+
+    def on_progress(self, stage, percent):
+        """分析引擎进度回调，返回True时引擎取消分析"""
+        progress = (stage, int(percent))
+        if progress != self._last_progress:
+            self._last_progress = progress
+            self.update_stage.emit(STAGE_LABELS.get(stage, stage))
+            self.update_progress.emit(int(percent))
+        return self.is_cancelled()
 
     def run(self):
+        import processing
+
         try:
-            self.update_progress.emit(20)  # 开始处理
-            result = processing.analyze_mammo_image(
-                self.img, 
-                k=self.k_value
-            )
+            img = self.pipeline.img
+            if self.image_digest is None:
+                self.image_digest = cache.image_digest(img)
+            self.cache_key = cache.make_key(self.image_digest, self.params)
+            with diagnostics_stage(self.diagnostics, 'cache_lookup') as record:
+                result = self.analysis_cache.get(self.cache_key, img)
+                if record is not None:
+                    record['hit'] = result is not None
+            if result is None and self.params.get('coarse_factor'):
+                # 粗到细模式: 先显示降采样预览(不写入缓存)
+                preview = self.pipeline.preview(
+                    progress_callback=lambda stage, percent: self.is_cancelled(), **self.params)
+                self.preview_ready.emit(preview)
+            if result is None:
+                # 复用同一图像的流水线，参数变化时只重算下游阶段
+                result = self.pipeline.run(
+                    tile_size=processing.default_tile_size(img.shape),
+                    progress_callback=self.on_progress,
+                    diagnostics=self.diagnostics,
+                    **self.params
+                )
+                self.analysis_cache.put(self.cache_key, result)
+            result.diagnostics = self.diagnostics
             self.update_progress.emit(100)  # 处理完成
             self.finish_analysis.emit(result)
+        except processing.AnalysisCancelled:
+            self.emit_cancelled()
         except Exception as e:
             self.analysis_error.emit(str(e))
 
 
+class PoolAnalysis(QObject):
+    """
+    交给分析进程池的一次分析，信号和取消接口与AnalysisThread相同，但不创建线程
+
+    进度由界面线程定时读取共享内存中的进度，完成/取消/错误经信号回到界面线程
+    """
+    update_progress = pyqtSignal(int)
+    update_stage = pyqtSignal(str)
+    preview_ready = pyqtSignal(object)
+    finish_analysis = pyqtSignal(object)
+    analysis_error = pyqtSignal(str)
+    analysis_cancelled = pyqtSignal(float)
+    finished = pyqtSignal()
+    request_done = pyqtSignal(str, object)
+
+    def __init__(self, worker_pool, shared_image, pipeline, params, analysis_cache,
+                 image_digest=None, diagnostics=None):
+        super().__init__()
+        self.worker_pool = worker_pool
+        self.shared_image = shared_image
+        self.pipeline = pipeline
+        self.params = params
+        self.analysis_cache = analysis_cache
+        self.image_digest = image_digest
+        self.diagnostics = diagnostics
+        self.cache_key = None
+        self.request = None
+        self.cancel_requested_at = None
+        self._last_progress = None
+        self.progress_timer = QTimer(self)
+        self.progress_timer.timeout.connect(self.poll_progress)
+        self.request_done.connect(self.on_request_done)
+
+    def start(self):
+        self.progress_timer.start(PROGRESS_POLL_MS)
+        # 粗到细模式先请求预览(结果已缓存时直接返回最终结果)
+        self.submit(preview=bool(self.params.get('coarse_factor')))
+
+    def submit(self, preview=False):
+        self.request = self.worker_pool.submit(
+            self.shared_image, self.params, self.on_request_callback,
+            image_digest=self.image_digest, diagnostics=self.diagnostics, preview=preview)
+
+    def on_request_callback(self, request, status, payload):
+        # 在进程池的后台线程中调用，经排队的信号转到界面线程
+        try:
+            self.request_done.emit(status, payload)
+        except RuntimeError:
+            pass  # 窗口已关闭
+
+    def isRunning(self):
+        return self.progress_timer.isActive()
+
+    def wait(self):
+        """等待工作进程结束本请求(进程池关闭后调用)"""
+        if self.request is not None and self.request.future is not None:
+            try:
+                self.request.future.exception()
+            except Exception:
+                pass
+        return True
+
+    def cancel(self):
+        """请求取消；本请求已被更新的请求取代时不影响新请求"""
+        if self.cancel_requested_at is None:
+            self.cancel_requested_at = time.perf_counter()
+            if self.request is not None and self.worker_pool.is_current(self.request):
+                self.worker_pool.cancel()
+
+    def is_cancelled(self):
+        return self.cancel_requested_at is not None
+
+    def poll_progress(self):
+        progress = self.worker_pool.progress(self.request) if self.request is not None else None
+        if progress is None:
+            return
+        progress = (progress[0], int(progress[1]))
+        if progress != self._last_progress:
+            self._last_progress = progress
+            self.update_stage.emit(STAGE_LABELS.get(progress[0], progress[0]))
+            self.update_progress.emit(progress[1])
+
+    def on_request_done(self, status, payload):
+        if status == 'preview':
+            self.image_digest = self.request.image_digest
+            self.preview_ready.emit(payload)
+            if not self.is_cancelled():
+                self.submit()
+                return
+            status = 'cancelled'
+        self.progress_timer.stop()
+        if status == 'done':
+            self.image_digest = self.request.image_digest
+            self.cache_key = self.request.cache_key
+            self.analysis_cache.record_lookup(self.request.cache_hit)
+            self.update_progress.emit(100)
+            self.finish_analysis.emit(payload)
+        elif status == 'cancelled':
+            if self.cancel_requested_at is None:
+                # 被更新的请求取代
+                self.cancel_requested_at = time.perf_counter()
+            self.analysis_cancelled.emit((time.perf_counter() - self.cancel_requested_at) * 1000)
+        else:
+            self.analysis_error.emit(payload)
+        self.finished.emit()
+
+
+class EventLoopProbe(QObject):
+    """测量界面事件循环延迟: 定时器实际触发时刻相对预定间隔的滞后"""
+
+    def __init__(self, interval_ms=LATENCY_PROBE_MS, parent=None):
+        super().__init__(parent)
+        self.interval_ms = interval_ms
+        self.samples = []
+        self._last = None
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.on_timeout)
+
+    def start(self):
+        self.samples = []
+        self._last = time.perf_counter()
+        self.timer.start(self.interval_ms)
+
+    def on_timeout(self):
+        now = time.perf_counter()
+        self.samples.append(max(0.0, (now - self._last) * 1000 - self.interval_ms))
+        self._last = now
+
+    def stop(self):
+        """停止测量，返回延迟统计(毫秒)；未在测量时返回None"""
+        if not self.timer.isActive():
+            return None
+        self.timer.stop()
+        if not self.samples:
+            return None
+        samples = np.asarray(self.samples)
+        return {'samples': len(samples), 'p50_ms': float(np.percentile(samples, 50)),
+                'p95_ms': float(np.percentile(samples, 95)), 'max_ms': float(samples.max())}
+
+
+class SweepThread(CancellableThread):
+    """后台预先分析全部聚类数量k，切换k时可直接显示结果"""
+    finish_sweep = pyqtSignal(object, object)
+    sweep_error = pyqtSignal(str)
+
+    def __init__(self, pipeline, params, k_values, analysis_cache, image_digest=None):
+        super().__init__()
+        self.pipeline = pipeline
+        self.params = params  # 不含k的其余分析参数
+        self.k_values = list(k_values)
+        self.analysis_cache = analysis_cache
+        self.image_digest = image_digest
+
+    def run(self):
+        import processing
+
+        try:
+            img = self.pipeline.img
+            if self.image_digest is None:
+                self.image_digest = cache.image_digest(img)
+            keys = {k: cache.make_key(self.image_digest, dict(self.params, k=k)) for k in self.k_values}
+            results = {}
+            for k, key in keys.items():
+                result = self.analysis_cache.get(key, img)
+                if result is not None:
+                    results[k] = result
+            missing = [k for k in self.k_values if k not in results]
+            if missing:
+                computed, _ = self.pipeline.sweep(
+                    missing, progress_callback=lambda stage, percent: self.is_cancelled(), **self.params)
+                for k, result in computed.items():
+                    self.analysis_cache.put(keys[k], result)
+                results.update(computed)
+            # 裁剪时聚类只统计乳房区域，惯性按裁剪后图像的直方图计算
+            pipeline = self.pipeline
+            if self.params.get('crop_foreground'):
+                pipeline, _ = pipeline.foreground(self.params.get('mask_pectoral', False))
+            hist = pipeline.histogram()
+            summary = [processing.summarize_result(k, results[k], hist) for k in self.k_values]
+            self.finish_sweep.emit({k: (results[k], keys[k]) for k in self.k_values}, summary)
+        except processing.AnalysisCancelled:
+            self.emit_cancelled()
+        except Exception as e:
+            self.sweep_error.emit(str(e))
+
+
+class PrefetchThread(CancellableThread):
+    """后台预取文件夹会话中的后续图像：读取、生成显示内容并按当前参数分析"""
+    entry_prepared = pyqtSignal(object)
+    entry_analyzed = pyqtSignal(object, object, str)
+    prefetch_error = pyqtSignal(str, str)
+
+    def __init__(self, jobs, params, analysis_cache, display_size):
+        super().__init__()
+        self.jobs = jobs  # [(路径, 已预取的SessionEntry或None)]，按优先级排序
+        self.params = params
+        self.analysis_cache = analysis_cache
+        self.display_size = display_size
+        self.current_path = None
+        self.stop_requested = False
+
+    def stop_after_current(self):
+        """完成当前图像后停止(不中断当前图像的分析)"""
+        self.stop_requested = True
+
+    def run(self):
+        import processing
+
+        for path, entry in self.jobs:
+            if self.is_cancelled() or self.stop_requested:
+                break
+            self.current_path = path
+            try:
+                if entry is None:
+                    entry = session.prepare_entry(path, viewer.pyramid_depth, self.display_size,
+                                                  self.is_cancelled)
+                    if entry is None:
+                        break
+                    self.entry_prepared.emit(entry)
+                result, key = session.analyze_entry(
+                    entry, self.params, self.analysis_cache,
+                    progress_callback=lambda stage, percent: self.is_cancelled())
+                self.entry_analyzed.emit(entry, result, key)
+            except processing.AnalysisCancelled:
+                break
+            except Exception as e:
+                self.prefetch_error.emit(path, str(e))
+        self.current_path = None
+
+
 class MammoAnalysisApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("乳腺钼靶图像分析系统")
         self.original_img = None
-        self.highlighted_img = None
         self.image_path = None
         self.analysis_result = None
+        self.analysis_key = None
+        self.analysis_params = None
+        self.pipeline = None
+        self.image_digest = None
+        self.analysis_thread = None
+        self.reanalysis_pending = False
+        # 常驻分析进程池(MAMMO_ANALYSIS_WORKERS=0时在线程中分析)及当前图像的共享内存副本
+        self.worker_pool = None
+        self.shared_image = None
+        # 分析期间的界面事件循环延迟
+        self.latency_probe = EventLoopProbe(parent=self)
+        self.analysis_latency = None
+        # k扫描: k -> (结果, 缓存键)，以及扫描时使用的其余参数
+        self.sweep_thread = None
+        self.sweep_results = {}
+        self.sweep_params = None
+        self.sweep_pending = False
+        # 已请求取消、尚未退出的线程(保留引用直到线程结束)
+        self.retired_threads = []
+        # 当前图像读取和显示的诊断记录(未启用诊断时为None)
+        self.image_diagnostics = None
+        self.warm_up_thread = None
+        # 显示: 标签 -> (内容标识, 渲染函数)，以及每个标签的QPixmap缓存
+        self.display_sources = {}
+        self.pixmap_cache = {}
+        self.display_token = 0
+        self.original_pyramid = None
+        # 文件夹浏览会话、预取缓存和后台预取线程
+        self.folder_session = None
+        self.session_cache = session.SessionCache()
+        self.prefetch_thread = None
+        self.prefetch_pending = False
+        # 当前图像正在由预取线程分析时记录其路径，完成后直接显示
+        self.awaiting_prefetch = None
+        self.redisplay_timer = QTimer(self)
+        self.redisplay_timer.setSingleShot(True)
+        self.redisplay_timer.timeout.connect(self.refresh_displays)
+        
+        # 分析结果磁盘缓存
+        self.analysis_cache = cache.AnalysisCache()
+        if workers.DEFAULT_WORKERS > 0:
+            self.worker_pool = workers.AnalysisWorkerPool(workers.DEFAULT_WORKERS,
+                                                          self.analysis_cache.cache_dir)
+
+        # 结果在后台按提交顺序写出，保存后可立即继续操作
+        self.export_signals = ExportSignals()
+        self.export_signals.export_finished.connect(self.on_export_finished)
+        self.export_signals.export_failed.connect(self.on_export_failed)
+        self.export_writer = export.ExportWriter(self.export_signals.export_finished.emit,
+                                                 self.export_signals.export_failed.emit)
+        # 病灶特征库，首次勾选写入时打开
+        self.feature_store = None
         
         # 初始化UI
         self.init_ui()
+
+        # 窗口显示后在后台预热分析模块
+        QTimer.singleShot(0, self.start_warm_up)
         
         # 5秒后自动全屏
         QTimer.singleShot(5000, self.show_full_screen)
@@ -64,8 +467,11 @@ class MammoAnalysisApp(QMainWindow):
             QPushButton:pressed { background-color: #0d419d; }
             QLabel { color: #c9d1d9; }
             QSpinBox { background-color: #0d1117; color: #c9d1d9; border: 1px solid #30363d; }
+            QCheckBox { color: #c9d1d9; }
             QProgressBar { border: 1px solid #30363d; background-color: #0d1117; }
             QProgressBar::chunk { background-color: #1f6feb; }
+            QStatusBar { color: #8b949e; }
+            QToolButton { color: #58a6ff; border: none; }
         """)
 
         # 中央部件
@@ -84,6 +490,30 @@ class MammoAnalysisApp(QMainWindow):
         self.btn_open.clicked.connect(self.open_image)
         control_layout.addWidget(self.btn_open)
 
+        # 文件夹浏览：上一张/下一张(PageUp/PageDown)，后台预取后续图像
+        self.btn_open_folder = QPushButton("打开文件夹")
+        self.btn_open_folder.clicked.connect(self.open_folder)
+        control_layout.addWidget(self.btn_open_folder)
+        nav_layout = QHBoxLayout()
+        self.btn_prev = QPushButton("上一张")
+        self.btn_prev.clicked.connect(lambda: self.navigate(-1))
+        nav_layout.addWidget(self.btn_prev)
+        self.session_label = QLabel("")
+        self.session_label.setAlignment(Qt.AlignCenter)
+        nav_layout.addWidget(self.session_label, 1)
+        self.btn_next = QPushButton("下一张")
+        self.btn_next.clicked.connect(lambda: self.navigate(1))
+        nav_layout.addWidget(self.btn_next)
+        control_layout.addLayout(nav_layout)
+        QShortcut(QKeySequence(Qt.Key_PageUp), self, lambda: self.navigate(-1))
+        QShortcut(QKeySequence(Qt.Key_PageDown), self, lambda: self.navigate(1))
+        self.update_session_controls()
+
+        # 载入已保存的结果包(无需重新分析)
+        self.btn_open_bundle = QPushButton("载入分析结果包")
+        self.btn_open_bundle.clicked.connect(self.open_bundle)
+        control_layout.addWidget(self.btn_open_bundle)
+
         # 参数设置
         params_group = QGroupBox("分析参数")
         params_layout = QVBoxLayout(params_group)
@@ -94,12 +524,57 @@ class MammoAnalysisApp(QMainWindow):
         self.spin_k.setValue(3)
         param_layout.addWidget(self.spin_k)
         params_layout.addLayout(param_layout)
+
+        # 后处理参数：修改后自动重新分析，只重算受影响的阶段
+        kernel_layout = QHBoxLayout()
+        kernel_layout.addWidget(QLabel("形态学核大小:"))
+        self.spin_kernel = QSpinBox()
+        self.spin_kernel.setRange(1, 15)
+        self.spin_kernel.setSingleStep(2)
+        self.spin_kernel.setValue(5)
+        kernel_layout.addWidget(self.spin_kernel)
+        params_layout.addLayout(kernel_layout)
+
+        min_size_layout = QHBoxLayout()
+        min_size_layout.addWidget(QLabel("最小病灶面积:"))
+        self.spin_min_size = QSpinBox()
+        self.spin_min_size.setRange(0, 1000000)
+        self.spin_min_size.setSingleStep(50)
+        self.spin_min_size.setValue(100)
+        min_size_layout.addWidget(self.spin_min_size)
+        params_layout.addLayout(min_size_layout)
+
+        self.check_bright = QCheckBox("病灶表现为较亮区域")
+        self.check_bright.setChecked(True)
+        params_layout.addWidget(self.check_bright)
+
+        self.check_coarse = QCheckBox("快速预览(粗到细)")
+        self.check_coarse.setToolTip("先显示降采样预览，再在候选区域内按原分辨率细化；\n"
+                                     "降采样后消失的微小病灶可能不在结果中")
+        params_layout.addWidget(self.check_coarse)
+
+        self.check_crop = QCheckBox("只分析乳房区域")
+        self.check_crop.setToolTip("检测皮肤线并裁剪掉背景后再分析，结果仍按原图坐标显示")
+        params_layout.addWidget(self.check_crop)
+        self.check_pectoral = QCheckBox("屏蔽胸大肌")
+        self.check_pectoral.setToolTip("内外斜位图像中检测到的胸大肌区按背景处理")
+        self.check_pectoral.setEnabled(False)
+        params_layout.addWidget(self.check_pectoral)
+
+        self.spin_k.valueChanged.connect(self.on_k_changed)
+        self.spin_kernel.valueChanged.connect(self.on_params_changed)
+        self.spin_min_size.valueChanged.connect(self.on_params_changed)
+        self.check_bright.toggled.connect(self.on_params_changed)
+        self.check_coarse.toggled.connect(self.on_params_changed)
+        self.check_crop.toggled.connect(self.check_pectoral.setEnabled)
+        self.check_crop.toggled.connect(self.on_params_changed)
+        self.check_pectoral.toggled.connect(self.on_params_changed)
         control_layout.addWidget(params_group)
 
         # 处理按钮
         self.btn_process = QPushButton("分析图像")
         self.btn_process.setEnabled(False)
-        self.btn_process.clicked.connect(self.process_image)
+        self.btn_process.clicked.connect(self.on_process_clicked)
         self.btn_process.setMinimumHeight(40)
         control_layout.addWidget(self.btn_process)
 
@@ -109,6 +584,11 @@ class MammoAnalysisApp(QMainWindow):
         self.btn_save.clicked.connect(self.save_analysis_results)
         self.btn_save.setMinimumHeight(40)
         control_layout.addWidget(self.btn_save)
+        self.check_bundle = QCheckBox("保存为单文件结果包(无损掩码，可重新载入)")
+        control_layout.addWidget(self.check_bundle)
+        self.check_store = QCheckBox("同时写入病灶特征库")
+        self.check_store.setToolTip(f"特征库: {store.DEFAULT_STORE_PATH}")
+        control_layout.addWidget(self.check_store)
 
         # 退出按钮
         self.btn_exit = QPushButton("退出程序")
@@ -131,8 +611,41 @@ class MammoAnalysisApp(QMainWindow):
         font.setPointSize(10)
         self.result_label.setFont(font)
         results_layout.addWidget(self.result_label)
+
+        # 病灶列表：双击跳转到病灶边界框
+        self.lesion_list = QListWidget()
+        self.lesion_list.setToolTip("双击病灶放大显示")
+        self.lesion_list.setStyleSheet("background-color: #0d1117; color: #c9d1d9;")
+        self.lesion_list.setMaximumHeight(160)
+        self.lesion_list.itemDoubleClicked.connect(self.on_lesion_double_clicked)
+        results_layout.addWidget(self.lesion_list)
         control_layout.addWidget(results_group)
 
+        # 可折叠的诊断面板(默认折叠，诊断默认关闭)
+        self.btn_diagnostics = QToolButton()
+        self.btn_diagnostics.setText("诊断信息")
+        self.btn_diagnostics.setCheckable(True)
+        self.btn_diagnostics.setToolButtonStyle(Qt.ToolButtonTextBesideIcon)
+        self.btn_diagnostics.setArrowType(Qt.RightArrow)
+        self.btn_diagnostics.toggled.connect(self.toggle_diagnostics_panel)
+        control_layout.addWidget(self.btn_diagnostics)
+
+        self.diagnostics_panel = QWidget()
+        diagnostics_layout = QVBoxLayout(self.diagnostics_panel)
+        diagnostics_layout.setContentsMargins(0, 0, 0, 0)
+        self.check_diagnostics = QCheckBox("记录阶段耗时")
+        self.check_trace_memory = QCheckBox("跟踪内存峰值(较慢)")
+        self.check_trace_memory.toggled.connect(self.on_trace_memory_toggled)
+        diagnostics_layout.addWidget(self.check_diagnostics)
+        diagnostics_layout.addWidget(self.check_trace_memory)
+        self.diagnostics_label = QLabel("未启用诊断")
+        self.diagnostics_label.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.diagnostics_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.diagnostics_label.setFont(QFont("Consolas", 9))
+        diagnostics_layout.addWidget(self.diagnostics_label)
+        self.diagnostics_panel.setVisible(False)
+        control_layout.addWidget(self.diagnostics_panel)
+
         # 伸缩空间
         control_layout.addStretch(1)
 
@@ -151,99 +664,404 @@ class MammoAnalysisApp(QMainWindow):
         self.original_label.setText("未加载图像")
         image_layout.addWidget(self.original_label)
 
-        # 分析结果图像
-        image_layout.addWidget(QLabel("分析结果"))
-        self.result_image_label = QLabel()
-        self.result_image_label.setAlignment(Qt.AlignCenter)
-        self.result_image_label.setStyleSheet("""
-            border: 2px solid #1f6feb; border-radius: 5px; 
-            background-color: #0d1117; color: #58a6ff; font: bold 14px;
-        """)
-        self.result_image_label.setText("等待分析结果")
-        image_layout.addWidget(self.result_image_label)
+        # 分析结果图像：分块金字塔查看器，滚轮缩放、拖动平移、双击适应窗口
+        result_header = QHBoxLayout()
+        result_header.addWidget(QLabel("分析结果(滚轮缩放，拖动平移，双击复位)"))
+        result_header.addStretch(1)
+        self.check_annotations = QCheckBox("显示病灶标注")
+        self.check_annotations.setChecked(True)
+        self.check_annotations.toggled.connect(
+            lambda checked: self.result_viewer.set_show_annotations(checked))
+        result_header.addWidget(self.check_annotations)
+        image_layout.addLayout(result_header)
+        self.result_viewer = viewer.TileViewer()
+        self.result_viewer.setStyleSheet("border: 2px solid #1f6feb; border-radius: 5px;")
+        image_layout.addWidget(self.result_viewer)
 
         # 添加到主布局 - 左侧占30%，右侧占70%
         main_layout.addWidget(control_panel, 3)
         main_layout.addWidget(image_panel, 7)
 
+    def start_warm_up(self):
+        """启动后台预热(只执行一次)"""
+        if self.warm_up_thread is not None:
+            return
+        self.warm_up_thread = WarmUpThread()
+        self.warm_up_thread.warmed_up.connect(self.on_warmed_up)
+        self.warm_up_thread.start()
+
+    def on_warmed_up(self, seconds):
+        """预热完成后启动分析进程池(不与启动过程争用CPU；首次分析前未启动时在提交时启动)"""
+        self.statusBar().showMessage(f"分析引擎已就绪({seconds:.1f} s)")
+        if self.worker_pool is not None:
+            self.worker_pool.start()
+
     def show_full_screen(self):
         """显示全屏界面"""
         self.showFullScreen()
         # 调整图像显示区域的最小尺寸以适应全屏
         self.original_label.setMinimumSize(800, 800)
-        self.result_image_label.setMinimumSize(800, 800)
+        self.result_viewer.setMinimumSize(800, 800)
 
     def open_image(self):
         """打开图像文件"""
         file_path, _ = QFileDialog.getOpenFileName(
             self, "选择乳腺钼靶图像", "",
-            "图像文件 (*.png *.jpg *.jpeg *.bmp);;所有文件 (*.*)"
+            "图像文件 (*.png *.jpg *.jpeg *.bmp *.dcm *.dicom);;DICOM文件 (*.dcm *.dicom);;所有文件 (*.*)"
         )
 
-        if not file_path:
-            return
+        if file_path:
+            self.end_session()
+            self.load_image(file_path)
+
+    def load_image(self, file_path, entry=None):
+        """读取并显示图像，成功返回True；entry为文件夹会话中已预取的内容时不再读取"""
+        # 新图像立即取消正在进行的分析
+        self.cancel_running_jobs()
 
         try:
             # 释放旧资源
+            self.release_shared_image()
             self.original_img = None
-            self.highlighted_img = None
             self.analysis_result = None
+            self.analysis_key = None
+            self.analysis_params = None
+            self.pipeline = None
+            self.image_digest = None
+            self.original_pyramid = None
+            self.display_sources.clear()
+            self.pixmap_cache.clear()
+            self.result_viewer.clear()
+            self.lesion_list.clear()
+            self.sweep_results = {}
+            self.sweep_params = None
+            self.spin_k.setToolTip("")
             
             # 读取图像（使用用户提供的辅助函数）
-            self.original_img = utils.read_image(file_path)
+            self.image_diagnostics = self.new_diagnostics()
+            if entry is not None:
+                self.original_img = entry.img
+            else:
+                self.original_img = utils.read_image(file_path, self.image_diagnostics)
             
             # 验证图像
             if self.original_img is None or self.original_img.size == 0:
                 raise ValueError("图像数据为空")
                 
-            height, width = self.original_img.shape[:2]
-            if height > 4096 or width > 4096:
-                raise ValueError("图像尺寸过大(>4096px)")
-                
+            # 大尺寸图像(>4096px)在分析时自动使用分块模式，工作内存只取决于分块大小，
+            # 不限制图像大小；整图模式的图像仍检查内存占用
+            import processing
             img_size_mb = self.original_img.nbytes / (1024 * 1024)
-            if img_size_mb > 200:
+            if processing.default_tile_size(self.original_img.shape) is None and img_size_mb > 200:
                 raise MemoryError(f"图像内存占用过高({img_size_mb:.1f}MB)")
 
+            if entry is not None:
+                # 预取时已生成金字塔层级和显示图像
+                self.pipeline = entry.pipeline
+                self.image_digest = entry.image_digest
+                self.original_pyramid = entry.pyramid
+                render = entry.render
+            else:
+                self.pipeline = processing.AnalysisPipeline(self.original_img)
+                self.original_pyramid = utils.DisplayPyramid(self.original_img)
+                render = lambda max_w, max_h: utils.render_for_display(self.original_pyramid, max_w, max_h)
+
             # 显示图像（使用用户提供的辅助函数）
-            self.display_image(self.original_img, self.original_label)
+            self.set_display_source(self.original_label, render, self.image_diagnostics)
+            # 分析前即可缩放查看原图
+            self.result_viewer.set_image(self.original_pyramid)
+            self.show_diagnostics()
             self.btn_process.setEnabled(True)
             self.result_label.setText("已加载图像，点击'分析图像'开始处理")
             self.image_path = file_path
+            return True
 
         except Exception as e:
             self.result_label.setText(f"错误：{str(e)}")
             QMessageBox.critical(self, "错误", f"加载图像失败: {str(e)}")
+            return False
+
+    def open_bundle(self):
+        """载入结果包：读取原图并直接显示保存的分析结果，不重新分析"""
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "选择分析结果包", "", f"分析结果包 (*{export.BUNDLE_SUFFIX});;所有文件 (*.*)")
+        if not file_path:
+            return
+        self.end_session()
+        try:
+            bundle = export.read_bundle(file_path)
+            image_path = export.bundle_image_path(bundle, file_path)
+        except ValueError as e:
+            QMessageBox.critical(self, "错误", f"载入结果包失败: {str(e)}")
+            return
+        if not self.load_image(image_path):
+            return
+        try:
+            self.image_digest = cache.image_digest(self.original_img)
+            result = export.bundle_result(bundle, self.original_img, self.image_digest)
+            # 分析结果为空时修改参数不会触发重新分析
+            params = bundle['meta'].get('params', {})
+            self.spin_k.setValue(int(params.get('k', self.spin_k.value())))
+            self.spin_kernel.setValue(int(params.get('morph_kernel_size', [self.spin_kernel.value()])[0]))
+            self.spin_min_size.setValue(int(params.get('min_lesion_size', self.spin_min_size.value())))
+            self.check_bright.setChecked(bool(params.get('lesion_is_bright', self.check_bright.isChecked())))
+            self.check_coarse.setChecked(bool(params.get('coarse_factor')))
+            self.check_crop.setChecked(bool(params.get('crop_foreground')))
+            self.check_pectoral.setChecked(bool(params.get('mask_pectoral')))
+            params = self.current_params()
+            self.show_analysis_result(result, cache.make_key(self.image_digest, params), params)
+            self.statusBar().showMessage(f"已载入结果包: {file_path}")
+        except (ValueError, KeyError) as e:
+            QMessageBox.critical(self, "错误", f"载入结果包失败: {str(e)}")
+
+    def open_folder(self):
+        """打开文件夹，按文件名顺序浏览其中的图像"""
+        directory = QFileDialog.getExistingDirectory(self, "选择乳腺钼靶图像文件夹")
+        if not directory:
+            return
+        try:
+            folder_session = session.FolderSession.from_directory(directory)
+        except ValueError as e:
+            QMessageBox.critical(self, "错误", f"打开文件夹失败: {str(e)}")
+            return
+        self.end_session()
+        self.folder_session = folder_session
+        self.show_session_image()
+
+    def end_session(self):
+        """结束文件夹浏览，停止预取并释放预取缓存"""
+        self.retire_thread(self.prefetch_thread)
+        self.prefetch_thread = None
+        self.prefetch_pending = False
+        self.awaiting_prefetch = None
+        self.folder_session = None
+        self.session_cache.clear()
+        self.update_session_controls()
+
+    def update_session_controls(self):
+        active = self.folder_session is not None
+        self.btn_prev.setEnabled(active and self.folder_session.index > 0)
+        self.btn_next.setEnabled(active and self.folder_session.index < len(self.folder_session) - 1)
+        self.session_label.setText(session.entry_label(self.folder_session) if active else "")
+
+    def navigate(self, step):
+        """切换到文件夹中的上一张/下一张图像"""
+        if self.folder_session is None or not self.folder_session.move(step):
+            return
+        self.show_session_image()
+
+    def show_session_image(self):
+        """显示会话中的当前图像：已预取的图像和分析结果直接显示，否则读取并分析"""
+        path = self.folder_session.current_path
+        self.update_session_controls()
+        self.awaiting_prefetch = None
+        # 离开的图像只保留紧凑的分析结果，释放流水线中间结果
+        if self.pipeline is not None:
+            self.pipeline.clear()
+
+        entry = self.session_cache.get(path)
+        if entry is None:
+            try:
+                entry = session.prepare_entry(path)
+            except Exception as e:
+                self.result_label.setText(f"错误：{str(e)}")
+                QMessageBox.critical(self, "错误", f"加载图像失败: {str(e)}")
+                return
+            self.session_cache.put(entry)
+        self.session_cache.set_current(path)
+        if not self.load_image(path, entry):
+            return
 
-    def display_image(self, img, label, max_size=None):
+        params = self.current_params()
+        key = cache.make_key(entry.image_digest, params)
+        result = entry.results.get(key)
+        thread = self.prefetch_thread
+        if result is not None:
+            self.show_analysis_result(result, key, params)
+            self.start_sweep()
+            self.restart_prefetch()
+        elif thread is not None and thread.isRunning() and thread.current_path == path:
+            # 预取线程正在分析此图像，完成后直接显示
+            self.awaiting_prefetch = path
+            self.result_label.setText("正在后台分析此图像...")
+            self.restart_prefetch()
+        else:
+            self.process_image()
+
+    def display_size(self, label):
+        """标签内可用于显示图像的尺寸(扣除边框宽度)"""
+        return max(1, label.width() - 4), max(1, label.height() - 4)
+
+    def restart_prefetch(self):
+        """按当前位置和参数安排后台预取"""
+        if self.folder_session is None:
+            return
+        params = self.current_params()
+        wanted = self.folder_session.prefetch_paths()
+        thread = self.prefetch_thread
+        if thread is not None and thread.isRunning():
+            if thread.params == params and (thread.current_path in wanted
+                                            or thread.current_path == self.awaiting_prefetch):
+                # 正在预取的图像仍然需要，完成后再按新位置重新安排
+                thread.stop_after_current()
+                self.prefetch_pending = True
+                return
+            self.retire_thread(thread)
+        self.prefetch_pending = False
+
+        jobs = []
+        for path in wanted:
+            entry = self.session_cache.peek(path)
+            if entry is not None and cache.make_key(entry.image_digest, params) in entry.results:
+                continue
+            jobs.append((path, entry))
+        if not jobs:
+            self.prefetch_thread = None
+            return
+        self.prefetch_thread = PrefetchThread(jobs, params, self.analysis_cache,
+                                              self.display_size(self.original_label))
+        self.prefetch_thread.entry_prepared.connect(self.on_entry_prepared)
+        self.prefetch_thread.entry_analyzed.connect(self.on_entry_analyzed)
+        self.prefetch_thread.prefetch_error.connect(self.on_prefetch_error)
+        self.prefetch_thread.finished.connect(self.on_prefetch_finished)
+        self.prefetch_thread.start(QThread.LowPriority)
+
+    def on_entry_prepared(self, entry):
+        """预取的图像已读取，加入预取缓存(已有同一图像的条目时保留原条目)"""
+        if self.folder_session is not None and self.session_cache.peek(entry.path) is None:
+            self.session_cache.put(entry)
+
+    def on_entry_analyzed(self, entry, result, key):
+        """预取的图像已分析；若正是等待中的当前图像则直接显示"""
+        if self.folder_session is None:
+            return
+        cached = self.session_cache.peek(entry.path)
+        if cached is not None:
+            cached.results[key] = result
+            self.session_cache.evict()
+        if self.awaiting_prefetch == entry.path == self.image_path:
+            self.awaiting_prefetch = None
+            params = self.current_params()
+            if key == cache.make_key(self.image_digest, params):
+                self.show_analysis_result(result, key, params)
+                self.start_sweep()
+            else:
+                self.process_image()
+
+    def on_prefetch_error(self, path, error_msg):
+        self.statusBar().showMessage(f"预取失败 {os.path.basename(path)}: {error_msg}")
+        if self.awaiting_prefetch == path:
+            self.awaiting_prefetch = None
+            self.process_image()
+
+    def on_prefetch_finished(self):
+        """预取线程退出后，按需以最新位置和参数重新安排"""
+        if self.sender() is not self.prefetch_thread:
+            return
+        self.prefetch_thread = None
+        if self.awaiting_prefetch is not None:
+            # 预取线程未分析完当前图像就退出(如已取消)，改为直接分析
+            self.awaiting_prefetch = None
+            self.process_image()
+        if self.prefetch_pending:
+            self.restart_prefetch()
+
+    def display_image(self, img, label, max_size=None, diagnostics=None):
         """使用用户提供的辅助函数准备并显示图像，支持全屏自适应"""
         if img is None:
             label.setText("图像加载失败")
             return
-        
-        # 使用用户提供的函数准备图像
-        display_img = utils.prepare_image_for_display(img)
-        
-        # 全屏模式下动态计算最大尺寸
-        if max_size is None:
-            max_size = min(label.width(), label.height()) - 50
-        
-        # 自适应缩放
-        h, w = display_img.shape[:2]
-        if w > max_size or h > max_size:
-            scale = max_size / max(w, h)
-            new_w, new_h = int(w * scale), int(h * scale)
-            display_img = cv2.resize(display_img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-        
-        # 转换为QPixmap
-        h, w, ch = display_img.shape
-        bytes_per_line = ch * w
-        qimg = QImage(display_img.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(qimg)
-        scaled_pixmap = pixmap.scaled(
-            label.width(), label.height(),
-            Qt.KeepAspectRatio, Qt.SmoothTransformation
-        )
-        label.setPixmap(scaled_pixmap)
+        pyramid = utils.DisplayPyramid(img)
+
+        def render(max_w, max_h):
+            if max_size is not None:
+                max_w, max_h = min(max_w, max_size), min(max_h, max_size)
+            return utils.render_for_display(pyramid, max_w, max_h)
+        self.set_display_source(label, render, diagnostics)
+
+    def set_display_source(self, label, render, diagnostics=None):
+        """
+        设置标签的显示内容并立即显示
+
+        render(max_w, max_h)返回不超过该尺寸的RGB图像；窗口尺寸变化时按新尺寸重新渲染，
+        同一内容和尺寸的QPixmap按标签缓存
+        """
+        self.display_token += 1
+        self.display_sources[label] = (self.display_token, render)
+        self.refresh_display(label, diagnostics)
+
+    def refresh_display(self, label, diagnostics=None):
+        """按标签当前尺寸显示其内容(优先使用缓存的QPixmap)"""
+        source = self.display_sources.get(label)
+        if source is None:
+            return
+        token, render = source
+        size = self.display_size(label)
+        cache = self.pixmap_cache.setdefault(label, OrderedDict())
+        key = (token, size)
+        pixmap = cache.get(key)
+        if pixmap is None:
+            with diagnostics_stage(diagnostics, 'display'):
+                display_img = render(*size)
+                h, w, ch = display_img.shape
+                qimg = QImage(display_img.data, w, h, ch * w, QImage.Format_RGB888)
+                pixmap = QPixmap.fromImage(qimg)
+                # 小图像放大填充显示区域
+                if w < size[0] and h < size[1]:
+                    pixmap = pixmap.scaled(size[0], size[1], Qt.KeepAspectRatio,
+                                           Qt.SmoothTransformation)
+            cache[key] = pixmap
+            while len(cache) > PIXMAP_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        label.setPixmap(pixmap)
+
+    def refresh_displays(self):
+        for label in list(self.display_sources):
+            self.refresh_display(label)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # 合并连续的尺寸变化(如全屏切换时的多次重新布局)
+        self.redisplay_timer.start(REDISPLAY_DELAY_MS)
+
+    def on_process_clicked(self):
+        """分析进行中时按钮用于取消分析"""
+        if self.analysis_thread is not None and self.analysis_thread.isRunning():
+            self.reanalysis_pending = False
+            self.btn_process.setEnabled(False)
+            self.analysis_thread.cancel()
+            return
+        self.process_image()
+
+    def retire_thread(self, thread):
+        """取消线程并保留引用，直到线程结束"""
+        if thread is None or not thread.isRunning():
+            return
+        thread.cancel()
+        self.retired_threads.append(thread)
+        thread.finished.connect(lambda: self.retired_threads.remove(thread))
+
+    def cancel_running_jobs(self):
+        """取消当前图像的分析和k扫描"""
+        self.reanalysis_pending = False
+        self.sweep_pending = False
+        if self.analysis_thread is not None and self.analysis_thread.isRunning():
+            self.statusBar().showMessage("正在取消分析...")
+        self.retire_thread(self.analysis_thread)
+        self.retire_thread(self.sweep_thread)
+        self.analysis_thread = None
+        self.sweep_thread = None
+        self.reset_analysis_controls()
+
+    def reset_analysis_controls(self):
+        """恢复分析按钮和进度条"""
+        self.stop_latency_probe()
+        self.progress.setVisible(False)
+        self.btn_process.setText("分析图像")
+        self.btn_process.setEnabled(self.pipeline is not None)
+        self.btn_open.setEnabled(True)
 
     def process_image(self):
         """启动图像分析线程"""
@@ -254,26 +1072,194 @@ class MammoAnalysisApp(QMainWindow):
         # 显示处理状态
         self.progress.setVisible(True)
         self.progress.setValue(0)
+        self.progress.setFormat("%p%")
         self.result_label.setText("正在分析图像...")
-        self.btn_process.setEnabled(False)
-        self.btn_open.setEnabled(False)
+        self.btn_process.setText("取消分析")
 
-        # 启动分析线程
-        self.analysis_thread = AnalysisThread(self.original_img, self.spin_k.value())
+        self.latency_probe.start()
+        if self.worker_pool is not None:
+            # 交给分析进程池；仍在进行的旧请求由进程池按最新请求为准取消
+            self.retire_thread(self.analysis_thread)
+            if self.shared_image is None:
+                self.shared_image = workers.SharedImage(self.original_img)
+            self.analysis_thread = PoolAnalysis(self.worker_pool, self.shared_image, self.pipeline,
+                                                self.current_params(), self.analysis_cache,
+                                                self.image_digest, self.new_diagnostics())
+        else:
+            # 启动分析线程
+            self.analysis_thread = AnalysisThread(self.pipeline, self.current_params(),
+                                                  self.analysis_cache, self.image_digest,
+                                                  self.new_diagnostics())
         self.analysis_thread.update_progress.connect(self.progress.setValue)
+        self.analysis_thread.update_stage.connect(lambda stage: self.progress.setFormat(f"{stage} %p%"))
+        self.analysis_thread.preview_ready.connect(self.show_preview)
+        self.analysis_thread.analysis_cancelled.connect(self.on_analysis_cancelled)
         self.analysis_thread.finish_analysis.connect(self.on_analysis_complete)
         self.analysis_thread.analysis_error.connect(self.on_analysis_error)
         self.analysis_thread.start()
 
+    def release_shared_image(self):
+        """释放当前图像的共享内存副本(已附加的工作进程在完成后自行关闭)"""
+        if self.shared_image is not None:
+            self.shared_image.close()
+            self.shared_image = None
+
+    def stop_latency_probe(self):
+        """结束事件循环延迟测量，记录分析期间的延迟统计"""
+        stats = self.latency_probe.stop()
+        if stats is not None:
+            self.analysis_latency = stats
+
+    def current_params(self):
+        """从界面读取分析参数"""
+        kernel_size = self.spin_kernel.value()
+        params = {
+            'k': self.spin_k.value(),
+            'lesion_is_bright': self.check_bright.isChecked(),
+            'morph_kernel_size': (kernel_size, kernel_size),
+            'min_lesion_size': self.spin_min_size.value(),
+            'shape_top_n': REPORT_LESIONS,
+        }
+        if self.check_coarse.isChecked():
+            params['coarse_factor'] = COARSE_FACTOR
+        if self.check_crop.isChecked():
+            params['crop_foreground'] = True
+            params['mask_pectoral'] = self.check_pectoral.isChecked()
+        return params
+
+    def sweep_key_params(self):
+        """k扫描相关的其余参数(不含k；k扫描总是按整图模式分析)"""
+        params = self.current_params()
+        del params['k']
+        params.pop('coarse_factor', None)
+        return params
+
+    def on_params_changed(self):
+        """后处理参数变化时自动重新分析(分析进行中则在完成后再分析)"""
+        if self.prefetch_thread is not None and self.prefetch_thread.params != self.current_params():
+            # 按旧参数的预取已无用，当前图像分析完成后按新参数重新预取
+            self.retire_thread(self.prefetch_thread)
+            self.prefetch_thread = None
+        if self.awaiting_prefetch is not None:
+            # 预取线程按旧参数分析当前图像，改为按新参数直接分析
+            self.awaiting_prefetch = None
+            self.process_image()
+            return
+        if self.analysis_result is None or self.pipeline is None:
+            return
+        self.start_sweep()
+        if (self.worker_pool is None and self.analysis_thread is not None
+                and self.analysis_thread.isRunning()):
+            # 取消按旧参数进行的分析，线程退出后按最新参数重新分析
+            self.reanalysis_pending = True
+            self.analysis_thread.cancel()
+            return
+        self.process_image()
+
+    def on_k_changed(self, k):
+        """切换k: 预先分析的结果已就绪时直接显示，否则重新分析"""
+        ready = self.sweep_results.get(k)
+        if (ready is not None and self.sweep_params == self.sweep_key_params()
+                and not (self.analysis_thread is not None and self.analysis_thread.isRunning())):
+            result, key = ready
+            # 扫描结果按整图模式分析，保存时记录其实际参数(不含coarse_factor)
+            self.show_analysis_result(result, key, dict(self.sweep_params, k=k))
+            return
+        self.on_params_changed()
+
+    def start_sweep(self):
+        """在后台预先分析全部k(大尺寸分块图像不做预分析)"""
+        import processing
+
+        if self.pipeline is None or processing.default_tile_size(self.original_img.shape):
+            return
+        params = self.sweep_key_params()
+        if self.sweep_params == params and self.sweep_results:
+            return
+        self.sweep_results = {}
+        self.sweep_params = params
+        self.spin_k.setToolTip("")
+        if self.sweep_thread is not None and self.sweep_thread.isRunning():
+            # 取消过期的扫描，线程退出后按最新参数重新扫描
+            self.sweep_pending = True
+            self.sweep_thread.cancel()
+            return
+        self.sweep_pending = False
+        self.sweep_thread = SweepThread(self.pipeline, params,
+                                        range(self.spin_k.minimum(), self.spin_k.maximum() + 1),
+                                        self.analysis_cache, self.image_digest)
+        self.sweep_thread.finish_sweep.connect(self.on_sweep_complete)
+        self.sweep_thread.sweep_error.connect(self.on_sweep_error)
+        self.sweep_thread.finished.connect(self.on_sweep_finished)
+        self.sweep_thread.start()
+
+    def on_sweep_finished(self):
+        """扫描线程退出(完成或取消)后，按需以最新参数重新扫描"""
+        if self.sender() is self.sweep_thread and self.sweep_pending:
+            self.sweep_params = None
+            self.start_sweep()
+
+    def on_sweep_complete(self, results, summary):
+        """k扫描完成回调，丢弃图像或参数已变化的过期结果"""
+        thread = self.sender()
+        if (self.sweep_pending or thread.pipeline is not self.pipeline
+                or thread.params != self.sweep_params):
+            return
+        self.image_digest = self.image_digest or thread.image_digest
+        self.sweep_results = results
+        lines = ["k扫描摘要 (k: 惯性 / 病灶数 / 占比)"]
+        for item in summary:
+            lines.append(f"k={item['k']}: {item['inertia']:.3g} / {item['lesion_count']} / "
+                         f"{item['lesion_percentage']:.2f}%")
+        self.spin_k.setToolTip("\n".join(lines))
+
+    def on_sweep_error(self, error_msg):
+        self.sweep_pending = False
+        self.sweep_params = None
+        self.statusBar().showMessage(f"k扫描失败: {error_msg}")
+
+    def run_pending_analysis(self):
+        if self.reanalysis_pending:
+            self.reanalysis_pending = False
+            self.process_image()
+
     def on_analysis_complete(self, result):
         """分析完成回调"""
+        thread = self.sender()
+        if thread is not self.analysis_thread:
+            # 已取消的旧图像分析在取消前恰好完成，丢弃结果
+            return
+        self.stop_latency_probe()
+        try:
+            self.image_digest = thread.image_digest
+            self.show_analysis_result(result, thread.cache_key, thread.params)
+            # 文件夹浏览时记入预取缓存，返回此图像时直接显示
+            entry = self.session_cache.peek(self.image_path)
+            if entry is not None and entry.pipeline is thread.pipeline:
+                entry.results[thread.cache_key] = result
+                self.session_cache.evict()
+        finally:
+            # 恢复界面交互
+            self.reset_analysis_controls()
+            # 分析完成后确保全屏显示
+            self.show_full_screen()
+            # 首次分析完成后在后台预先分析其余k
+            self.start_sweep()
+            self.run_pending_analysis()
+            self.restart_prefetch()
+
+    def show_analysis_result(self, result, cache_key, params):
+        """显示分析结果图像和报告；params为得到该结果的分析参数(保存时记录)"""
         try:
             # 保存分析结果
             self.analysis_result = result
+            self.analysis_key = cache_key
+            self.analysis_params = params
+            self.show_cache_stats()
             
             # 显示结果图像
-            self.highlighted_img = result['highlighted_img']
-            self.display_lesion_annotations(result, self.result_image_label)
+            self.display_lesion_annotations(result, self.result_viewer)
+            self.show_diagnostics()
             
             # 生成分析报告
             report = self.generate_analysis_report(result)
@@ -285,113 +1271,189 @@ class MammoAnalysisApp(QMainWindow):
         except Exception as e:
             self.result_label.setText(f"结果显示错误: {str(e)}")
             QMessageBox.critical(self, "错误", f"显示分析结果失败: {str(e)}")
-        finally:
-            # 恢复界面交互
-            self.progress.setVisible(False)
-            self.btn_process.setEnabled(True)
-            self.btn_open.setEnabled(True)
-            # 分析完成后确保全屏显示
-            self.show_full_screen()
+
+    def show_preview(self, result):
+        """显示粗到细模式的降采样预览(不可保存，细化完成后由最终结果替换)"""
+        if self.sender() is not self.analysis_thread:
+            return
+        try:
+            self.display_lesion_annotations(result, self.result_viewer)
+            self.result_label.setText("[预览] 正在按原分辨率细化...\n\n" + self.generate_analysis_report(result))
+        except Exception as e:
+            self.result_label.setText(f"预览显示错误: {str(e)}")
+
+    def show_cache_stats(self):
+        """在状态栏显示缓存命中情况及最近一次分析期间的界面延迟"""
+        message = f"结果缓存: 命中 {self.analysis_cache.hits} 次 / 未命中 {self.analysis_cache.misses} 次"
+        if self.analysis_latency is not None:
+            message += (f" | 分析期间界面延迟 p95 {self.analysis_latency['p95_ms']:.0f} ms"
+                        f" / 最大 {self.analysis_latency['max_ms']:.0f} ms")
+        self.statusBar().showMessage(message)
+
+    def on_analysis_cancelled(self, latency_ms):
+        """分析取消回调，显示从请求取消到线程空闲的延迟"""
+        self.statusBar().showMessage(f"分析已取消(响应 {latency_ms:.0f} ms)")
+        if self.sender() is not self.analysis_thread:
+            return
+        self.result_label.setText("分析已取消")
+        self.reset_analysis_controls()
+        self.run_pending_analysis()
 
     def on_analysis_error(self, error_msg):
         """分析错误回调"""
+        if self.sender() is not self.analysis_thread:
+            return
         self.result_label.setText(f"分析错误: {error_msg}")
-        self.progress.setVisible(False)
-        self.btn_process.setEnabled(True)
-        self.btn_open.setEnabled(True)
+        self.reset_analysis_controls()
+        self.reanalysis_pending = False
         QMessageBox.critical(self, "错误", f"图像分析失败: {error_msg}")
 
     def generate_analysis_report(self, result):
         """生成详细分析报告"""
-        report = f"乳腺钼靶图像分析报告\n\n"
-        report += f"图像尺寸: {self.original_img.shape[1]}×{self.original_img.shape[0]}\n"
-        report += f"病灶区域占比: {result['lesion_percentage']:.2f}%\n"
-        report += f"检测到 {result['lesion_count']} 个可疑病灶\n\n"
-        
-        if result['lesion_count'] > 0:
-            report += "主要病灶特征：\n"
-            for i, lesion in enumerate(result['lesion_features'][:3]):
-                report += f"  病灶 {i+1}:\n"
-                report += f"    面积: {lesion['area']} 像素\n"
-                report += f"    圆形度: {lesion['circularity']:.2f}\n"
-                report += f"    长轴长度: {lesion['major_axis_length']:.1f} 像素\n"
-    
-        # 医学建议
-        if result['lesion_count'] == 0 or result['lesion_percentage'] < 0.5:
-            report += "\n建议：未见明显异常，建议每年定期复查。"
-        elif result['lesion_count'] <= 2 and result['lesion_features'][0]['circularity'] > 0.7:
-            report += "\n建议：发现良性可能病灶，建议6个月后复查超声。"
-        else:
-            report += "\n建议：发现可疑病灶，形态学特征不规则，建议尽快到乳腺专科就诊。"
-    
-        return report
+        return export.analysis_report(result, REPORT_LESIONS)
+
+    def new_diagnostics(self):
+        """按界面设置创建诊断记录对象，未启用时返回None"""
+        if not self.check_diagnostics.isChecked():
+            return None
+        return Diagnostics(trace_memory=self.check_trace_memory.isChecked())
+
+    def on_trace_memory_toggled(self, checked):
+        """内存跟踪由界面统一开关，避免各诊断对象重复启停tracemalloc"""
+        if checked:
+            self.check_diagnostics.setChecked(True)
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        elif tracemalloc.is_tracing():
+            tracemalloc.stop()
 
-    def display_lesion_annotations(self, result, label):
-        """在图像上标注病灶边界和中心"""
+    def toggle_diagnostics_panel(self, expanded):
+        self.btn_diagnostics.setArrowType(Qt.DownArrow if expanded else Qt.RightArrow)
+        self.diagnostics_panel.setVisible(expanded)
+
+    def diagnostics_text(self):
+        """当前图像读取/显示及最近一次分析的诊断文本，未启用时返回空字符串"""
+        combined = Diagnostics(trace_memory=self.check_trace_memory.isChecked())
+        combined.extend(self.image_diagnostics)
+        if self.analysis_result is not None:
+            combined.extend(self.analysis_result.diagnostics)
+        if not combined.records:
+            return ""
+        return combined.format_text()
+
+    def show_diagnostics(self):
+        self.diagnostics_label.setText(self.diagnostics_text() or "未启用诊断")
+
+    def display_lesion_annotations(self, result, result_viewer):
+        """在查看器中高亮病灶区域并标注边界框，同时列出全部病灶"""
         if result is None or 'highlighted_img' not in result:
             return
-        
-        img = result['highlighted_img'].copy()
-        if len(img.shape) == 2:
-            # 使用用户提供的函数转换为RGB
-            img = utils.prepare_image_for_display(img)
-        elif len(img.shape) == 3 and img.shape[2] == 3:
-            # BGR转RGB
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        lesion_features = result.get('lesion_features', [])
-        for i, lesion in enumerate(lesion_features[:5]):  # 最多标注5个病灶
-            y1, x1, y2, x2 = lesion['bounding_box']
-            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)  # 绿色框
-            
-            cv2.putText(img, f"nidus{i+1}", (x1, y1-10), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)  # 黄色文字
-        
-        self.display_image(img, label)
+
+        # 按分块在显示分辨率下生成高亮，不复制全分辨率图像
+        if self.original_pyramid is not None and result.original_img is self.original_img:
+            original = self.original_pyramid
+        else:
+            original = utils.DisplayPyramid(result.original_img)
+        with diagnostics_stage(result.diagnostics, 'annotate'):
+            mask = utils.DisplayPyramid(result.mask_img)
+            lesions = result.lesion_table
+            result_viewer.set_image(original, mask, lesions)
+            result_viewer.set_show_annotations(self.check_annotations.isChecked())
+
+        self.lesion_list.clear()
+        for i in range(len(lesions)):
+            self.lesion_list.addItem(self.lesion_item_text(lesions, i))
+
+    def lesion_item_text(self, lesions, i):
+        """病灶列表项文字(形态特征尚未计算时不显示圆形度)"""
+        lesion = lesions[i]
+        y1, x1, y2, x2 = (int(v) for v in lesion['bounding_box'])
+        text = f"nidus{i+1}: 面积 {lesion['area']:.0f}  "
+        if not np.isnan(lesion['circularity']):
+            text += f"圆形度 {lesion['circularity']:.2f}  "
+        return text + f"({x1}, {y1})-({x2}, {y2})"
+
+    def on_lesion_double_clicked(self, item):
+        """跳转到病灶，并按需计算其形态特征"""
+        import processing
+
+        row = self.lesion_list.row(item)
+        self.result_viewer.show_lesion(row)
+        if self.analysis_result is not None:
+            processing.complete_shape_features(self.analysis_result, [row])
+            item.setText(self.lesion_item_text(self.analysis_result.lesion_table, row))
 
     def save_analysis_results(self):
-        """保存标注图像和分析报告"""
+        """提交后台写出任务(结果包或标注图像、分析报告和病灶特征)，完成后在状态栏提示"""
         if self.image_path is None or self.analysis_result is None:
             self.result_label.setText("错误：无结果可保存")
             return
-        
-        try:
-            # 生成保存路径
-            base_name = os.path.splitext(os.path.basename(self.image_path))[0]
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            save_dir = os.path.join(os.path.dirname(self.image_path), f"{base_name}_analysis_{timestamp}")
-            os.makedirs(save_dir, exist_ok=True)
-            
-            # 保存标注图像
-            marked_img_path = os.path.join(save_dir, f"{base_name}_marked.jpg")
-            # 转换为BGR格式保存
-            if len(self.highlighted_img.shape) == 2:
-                cv2.imwrite(marked_img_path, self.highlighted_img)
-            else:
-                cv2.imwrite(marked_img_path, cv2.cvtColor(self.highlighted_img, cv2.COLOR_RGB2BGR))
-            
-            # 保存分析报告
-            report_path = os.path.join(save_dir, f"{base_name}_report.txt")
-            with open(report_path, "w", encoding="utf-8") as f:
-                f.write(self.result_label.text())
-            
-            # 保存病灶特征
-            processing.save_lesion_features(
-                self.analysis_result.get('lesion_features', []), 
-                save_dir
-            )
-            
-            self.result_label.setText(f"分析结果已保存至: {save_dir}")
-            QMessageBox.information(self, "保存成功", f"分析结果已保存至:\n{save_dir}")
-        except Exception as e:
-            self.result_label.setText(f"保存失败: {str(e)}")
-            QMessageBox.critical(self, "保存失败", f"保存分析结果时出错: {str(e)}")
+
+        # 生成保存路径
+        base_name = os.path.splitext(os.path.basename(self.image_path))[0]
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        target = os.path.join(os.path.dirname(self.image_path), f"{base_name}_analysis_{timestamp}")
+        bundle = self.check_bundle.isChecked()
+        if bundle:
+            target += export.BUNDLE_SUFFIX
+
+        report = self.generate_analysis_report(self.analysis_result)
+        # 启用诊断时附加逐阶段耗时
+        diagnostics_text = self.diagnostics_text()
+        if diagnostics_text:
+            report += "\n\n" + diagnostics_text + "\n"
+
+        if self.check_store.isChecked() and self.feature_store is None:
+            try:
+                self.feature_store = store.FeatureStore()
+            except Exception as e:
+                QMessageBox.critical(self, "错误", f"打开病灶特征库失败: {str(e)}")
+                return
+
+        # 写出线程使用结果快照，补算形态特征和文件写入均不占用界面线程；
+        # 同时写入缓存，再次打开同一图像时直接命中
+        self.export_writer.submit(export.ExportJob(
+            export.snapshot_result(self.analysis_result), target, bundle, report,
+            params=self.analysis_params, image_path=self.image_path,
+            image_digest=self.image_digest, analysis_cache=self.analysis_cache,
+            cache_key=self.analysis_key,
+            feature_store=self.feature_store if self.check_store.isChecked() else None))
+        self.statusBar().showMessage(f"正在后台保存({self.export_writer.pending} 项待写出): {target}")
+
+    def on_export_finished(self, job, seconds):
+        """后台写出完成"""
+        pending = self.export_writer.pending
+        message = f"分析结果已保存至: {job.target} ({seconds:.2f} s)"
+        if pending:
+            message += f"，还有 {pending} 项待写出"
+        self.statusBar().showMessage(message)
+
+    def on_export_failed(self, job, error_msg):
+        """后台写出失败"""
+        self.statusBar().showMessage(f"保存失败: {error_msg}")
+        QMessageBox.critical(self, "保存失败", f"保存分析结果至 {job.target} 时出错: {error_msg}")
 
     def closeEvent(self, event):
         """窗口关闭时释放资源"""
+        self.cancel_running_jobs()
+        self.retire_thread(self.prefetch_thread)
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+        for thread in list(self.retired_threads):
+            thread.wait()
+        if self.warm_up_thread is not None:
+            self.warm_up_thread.wait()
+        self.result_viewer.stop_pyramid_thread()
+        # 写完已提交的保存任务再退出
+        if self.export_writer.pending:
+            self.statusBar().showMessage("正在写出未完成的保存任务...")
+        self.export_writer.close()
+        if self.feature_store is not None:
+            self.feature_store.close()
+        self.release_shared_image()
         self.original_img = None
-        self.highlighted_img = None
         self.analysis_result = None
+        self.pipeline = None
         event.accept()
 
 
@@ -0,0 +1,213 @@
+"""
+分析服务(service.py)的负载生成器
+
+以固定并发向 /analyze 上传图像，统计各状态码数量、吞吐量和延迟分位数，最后取回服务端的
+/metrics。默认上传合成体模(phantom.py)，也可指定图像文件；--spawn 时在本机空闲端口上
+启动一个服务进程，测试结束后停止，无需另开终端。出现5xx或连接错误时返回非零退出码。
+
+用法示例:
+    python loadgen.py --spawn --workers 2 --queue-size 4 --requests 100 --concurrency 16
+    python loadgen.py --url http://127.0.0.1:8765 --images film1.png film2.dcm --requests 50
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import service
+
+# 等待 --spawn 启动的服务就绪的最长时间(秒)
+SPAWN_TIMEOUT = 120
+
+
+def phantom_uploads(size: int, count: int, lesions: int = 12) -> List[bytes]:
+    """生成count幅体模(种子0..count-1)并编码为PNG"""
+    import cv2
+    import phantom
+
+    uploads = []
+    for seed in range(count):
+        ok, data = cv2.imencode('.png', phantom.make_phantom(size, lesions, seed=seed)[0])
+        uploads.append(data.tobytes())
+    return uploads
+
+
+def file_uploads(paths: List[str]) -> List[bytes]:
+    uploads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            uploads.append(f.read())
+    return uploads
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((service.DEFAULT_HOST, 0))
+        return sock.getsockname()[1]
+
+
+def _request(host: str, port: int, method: str, path: str, body: Optional[bytes] = None,
+             timeout: float = 600) -> tuple:
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def spawn_service(port: int, workers: int, queue_size: int) -> subprocess.Popen:
+    """在子进程中启动服务，等待/health可用后返回"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'service.py')
+    proc = subprocess.Popen([sys.executable, script, '--port', str(port), '--workers', str(workers),
+                             '--queue-size', str(queue_size)])
+    deadline = time.monotonic() + SPAWN_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"服务进程已退出(退出码 {proc.returncode})")
+        try:
+            if _request(service.DEFAULT_HOST, port, 'GET', '/health', timeout=1)[0] == 200:
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("等待服务启动超时")
+
+
+def _check_json(body: bytes) -> Optional[str]:
+    """核对JSON响应: 掩码可还原且病灶数一致；有问题时返回说明"""
+    payload = json.loads(body)
+    mask = service.decode_mask(payload['mask'])
+    if mask.shape != (payload['height'], payload['width']):
+        return "掩码尺寸与图像不符"
+    if len(payload['lesions']) != payload['lesion_count']:
+        return "病灶列表长度与病灶数不符"
+    return None
+
+
+def run_load(host: str, port: int, uploads: List[bytes], requests: int, concurrency: int,
+             query: str = '', verify: bool = True) -> Dict:
+    """
+    以concurrency个并发连接依次上传uploads(循环使用)，共requests个请求
+
+    返回:
+        dict: seconds、status(状态码 -> 次数，连接错误记为'error')、invalid(核对失败数)、
+        throughput(每秒成功请求数)和latency(成功请求的延迟分位数)
+    """
+    path = '/analyze' + (f'?{query}' if query else '')
+    lock = threading.Lock()
+    status_counts = {}
+    latencies = []
+    invalid = []
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            status, body = _request(host, port, 'POST', path, uploads[i % len(uploads)])
+        except OSError:
+            status, body = 'error', b''
+        elapsed = time.perf_counter() - start
+        problem = _check_json(body) if verify and status == 200 and 'format=bundle' not in query else None
+        with lock:
+            status_counts[status] = status_counts.get(status, 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+            if problem:
+                invalid.append(problem)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'status': {str(key): value for key, value in sorted(status_counts.items(), key=str)},
+        'invalid': len(invalid),
+        'throughput': len(latencies) / seconds if seconds > 0 else 0.0,
+        'latency': service.latency_percentiles(latencies),
+    }
+
+
+def format_report(report: Dict, metrics: Optional[Dict] = None) -> str:
+    latency = report['latency']
+    lines = [f"{sum(report['status'].values())} 个请求, 用时 {report['seconds']:.2f} s, "
+             f"吞吐 {report['throughput']:.2f} 个/s",
+             "状态码: " + ", ".join(f"{key}×{value}" for key, value in report['status'].items())]
+    if latency['samples']:
+        lines.append(f"成功请求延迟: p50 {latency['p50_ms']:.0f} ms, p90 {latency['p90_ms']:.0f} ms, "
+                     f"p99 {latency['p99_ms']:.0f} ms, 最大 {latency['max_ms']:.0f} ms")
+    if report['invalid']:
+        lines.append(f"核对失败的响应: {report['invalid']} 个")
+    if metrics is not None:
+        analysis, wait = metrics['latency']['analysis'], metrics['latency']['queue_wait']
+        lines.append(f"服务端: 接受 {metrics['accepted']}, 拒绝(429) {metrics['rejected']}, "
+                     f"完成 {metrics['completed']}, 失败 {metrics['failed']}, 队列 {metrics['queue_depth']}"
+                     f"/{metrics['queue_size']}")
+        if analysis['samples']:
+            lines.append(f"服务端: 分析 p50 {analysis['p50_ms']:.0f} ms, p99 {analysis['p99_ms']:.0f} ms; "
+                         f"排队 p50 {wait['p50_ms']:.0f} ms, p99 {wait['p99_ms']:.0f} ms")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="分析服务负载生成器")
+    parser.add_argument('--url', default=f"http://{service.DEFAULT_HOST}:{service.DEFAULT_PORT}",
+                        help="服务地址")
+    parser.add_argument('--spawn', action='store_true', help="在本机空闲端口上启动服务进程(忽略--url)")
+    parser.add_argument('--workers', type=int, default=2, help="--spawn时服务的分析进程数")
+    parser.add_argument('--queue-size', type=int, default=service.DEFAULT_QUEUE_SIZE,
+                        help="--spawn时服务的排队上限")
+    parser.add_argument('--images', nargs='*', default=[], help="上传的图像文件(默认上传体模)")
+    parser.add_argument('--size', type=int, default=1024, help="体模图像高度(像素)")
+    parser.add_argument('--count', type=int, default=4, help="体模数量")
+    parser.add_argument('--requests', type=int, default=50, help="请求总数")
+    parser.add_argument('--concurrency', type=int, default=8, help="并发连接数")
+    parser.add_argument('--query', default='', help="分析参数查询字符串，如 k=3&min_lesion_size=100")
+    parser.add_argument('--no-verify', action='store_true', help="不核对JSON响应内容")
+    parser.add_argument('-o', '--output', help="结果JSON路径(默认只打印)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    uploads = file_uploads(args.images) if args.images else phantom_uploads(args.size, args.count)
+    proc = None
+    if args.spawn:
+        host, port = service.DEFAULT_HOST, _free_port()
+        try:
+            proc = spawn_service(port, args.workers, args.queue_size)
+        except RuntimeError as e:
+            print(f"错误: {e}", file=sys.stderr)
+            return 1
+    else:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    try:
+        report = run_load(host, port, uploads, args.requests, args.concurrency, args.query,
+                          not args.no_verify)
+        status, body = _request(host, port, 'GET', '/metrics')
+        metrics = json.loads(body) if status == 200 else None
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    print(format_report(report, metrics))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'client': report, 'server': metrics}, f, ensure_ascii=False, indent=2)
+    failed = report['status'].get('error', 0) + sum(value for key, value in report['status'].items()
+                                                   if key.isdigit() and int(key) >= 500)
+    return 1 if failed or report['invalid'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,10 @@
 import sys
 import os
-from PyQt5.QtWidgets import QApplication, QLabel
-from PIL import Image, ImageTk, ImageSequence
-import tkinter as tk
 import time
-from PyQt5.QtCore import Qt, QTimer
-from gui import MammoAnalysisApp
+import multiprocessing
+from PyQt5.QtWidgets import QApplication, QSplashScreen
+from PyQt5.QtGui import QMovie, QImageReader, QColor, QFont
+from PyQt5.QtCore import Qt
 import subprocess
 if sys.platform.startswith('win'):
     try:
@@ -23,7 +22,54 @@ if sys.platform.startswith('win'):
         kwargs['creationflags'] |= CREATE_NO_WINDOW
         return old_Popen(*args, **kwargs)
     subprocess.Popen = _Popen
+
+# 启动画面图片(支持GIF动画和静态图片)，位于程序所在目录
+SPLASH_IMAGE = "asdf.jpg"
+SPLASH_MAX_SIZE = (800, 600)
+
+
+def resource_path(name):
+    """资源文件路径: 打包后的可执行文件从解压目录读取，否则相对于本文件所在目录"""
+    base_dir = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(base_dir, name)
+
+
+class AnimatedSplash(QSplashScreen):
+    """Qt原生启动画面: QMovie按需逐帧解码，主窗口就绪后立即关闭"""
+
+    def __init__(self, image_path):
+        # 只读取文件头获取尺寸，按最大尺寸等比缩放
+        size = QImageReader(image_path).size()
+        self.movie = QMovie(image_path)
+        if not self.movie.isValid() or not size.isValid():
+            raise ValueError(f"无法读取启动图片: {image_path}")
+        size.scale(min(size.width(), SPLASH_MAX_SIZE[0]), min(size.height(), SPLASH_MAX_SIZE[1]),
+                   Qt.KeepAspectRatio)
+        self.movie.setScaledSize(size)
+        self.movie.jumpToFrame(0)
+        super().__init__(self.movie.currentPixmap())
+        self.setWindowFlag(Qt.WindowStaysOnTopHint)
+        self.setStyleSheet("background-color: #0a0e14;")
+
+        # 科技感欢迎文字，放置在底部中央
+        self.setFont(QFont("Microsoft YaHei", 24, QFont.Bold))
+        self.showMessage("生医软控欢迎您的使用", Qt.AlignBottom | Qt.AlignHCenter, QColor("#1f6feb"))
+
+        # 多帧动画由QMovie定时解码下一帧，不预先转换全部帧
+        if self.movie.frameCount() != 1:
+            self.movie.frameChanged.connect(lambda _: self.setPixmap(self.movie.currentPixmap()))
+            self.movie.start()
+
+    def finish(self, window):
+        self.movie.stop()
+        super().finish(window)
+
+
 if __name__ == "__main__":
+    # 打包后的可执行文件中启动分析工作进程(spawn)所需
+    multiprocessing.freeze_support()
+    start_time = time.perf_counter()
+
     # 创建应用实例
     app = QApplication(sys.argv)
 
@@ -31,110 +77,25 @@ if __name__ == "__main__":
     app.setApplicationName("乳腺钼靶分析系统")
     app.setApplicationDisplayName("乳腺钼靶图像分析系统")
 
-    # 创建主窗口(但不立即显示)
-    window = MammoAnalysisApp()
-    
-    # 创建启动动画
-    image_path = "E:/new/new/asdf.jpg"  # 使用实际启动图片
-    
-    # 创建临时启动窗口
-    startup_window = QLabel()
-    startup_window.setWindowFlags(Qt.SplashScreen | Qt.FramelessWindowHint)
-    # 设置启动窗口尺寸(800x600)并居中
-    startup_window.resize(800, 600)
-    screen_geometry = app.desktop().screenGeometry()
-    startup_window.move(
-        (screen_geometry.width() - 800) // 2,
-        (screen_geometry.height() - 600) // 2
-    )
-    # 设置科技感样式
-    startup_window.setStyleSheet("""
-        background-color: #0a0e14;
-        border: 2px solid #1f6feb;
-        border-radius: 10px;
-    """)
-    
-    # 加载并显示图片
-    print(f"正在加载图片: {image_path}")
+    # 先显示启动画面，再导入和创建主窗口
+    image_path = resource_path(SPLASH_IMAGE)
+    splash = None
     try:
-        # 创建Tkinter窗口
-        root = tk.Tk()
-        root.overrideredirect(True)  # 移除窗口装饰（标题栏、边框等）
-        root.attributes('-topmost', True)  # 确保窗口在最前
-        
-        # 使用Pillow加载动画
-        with Image.open(image_path) as img:
-            print(f"动画加载成功 - 格式: {img.format}, 尺寸: {img.width}x{img.height}")
-            # 设置窗口大小为图片尺寸并居中显示
-            root.geometry(f"{img.width}x{img.height}+{int((root.winfo_screenwidth()-img.width)/2)}+{int((root.winfo_screenheight()-img.height)/2)}")
-            
-            # 准备动画帧
-            frames = []
-            for frame in ImageSequence.Iterator(img):
-                frames.append(ImageTk.PhotoImage(frame))
-            
-            # 创建标签显示动画
-            label = tk.Label(root)
-            label.pack()
-            
-            # 检查图片是否存在且格式正确
-            if not os.path.exists(image_path):
-                raise FileNotFoundError(f"图片文件不存在: {image_path}")
-            
-            valid_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
-            if not image_path.lower().endswith(valid_extensions):
-                raise ValueError(f"不支持的图片格式，请使用: {', '.join(valid_extensions)}")
-
-            # 添加科技感欢迎文字
-            text_label = tk.Label(
-                root,
-                text="生医软控欢迎您的使用",
-                font=("Microsoft YaHei", 24, "bold"),
-                fg="#1f6feb",
-                bg="#0a0e14",
-                bd=0,
-                highlightthickness=0,
-                relief="flat"
-            )
-            # 添加发光效果
-            text_label.config(
-                highlightbackground="#1f6feb",
-                highlightcolor="#1f6feb",
-                highlightthickness=2
-            )
-            # 将文字放置在窗口底部中央
-            text_label.place(relx=0.5, rely=0.95, anchor="center")
-            
-            # 动画播放控制变量
-            start_time = time.time()
-            play_duration = 4  # 播放4秒
-            
-            # 动画播放函数
-            def play_animation(frame_num=0):
-                frame = frames[frame_num]
-                label.config(image=frame)
-                label.image = frame
-                
-                # 检查是否达到播放时长
-                if time.time() - start_time < play_duration:
-                    root.after(100, play_animation, (frame_num + 1) % len(frames))
-                else:
-                    root.destroy()  # 关闭窗口
-            
-            # 开始播放动画
-            play_animation()
-            root.mainloop()
-            
-            print(f"图片加载成功 - 格式: {img.format}, 尺寸: {img.width}x{img.height}")
-            
-            # 显示主窗口
-            window.show()
-        
+        splash = AnimatedSplash(image_path)
+        splash.show()
+        app.processEvents()
     except Exception as e:
-        print(f"图片加载出错: {str(e)}")
-        print(f"无法加载启动图片: {image_path}")
-        print("请检查: 1.图片是否存在 2.图片格式是否正确(jpg/png/bmp)")
-        window.show()
+        print(f"无法加载启动图片: {e}", file=sys.stderr)
+        print("请检查: 1.图片是否存在 2.图片格式是否正确(jpg/png/bmp/gif)", file=sys.stderr)
+
+    from gui import MammoAnalysisApp
+
+    window = MammoAnalysisApp()
+    window.show()
+    # 主窗口就绪后立即关闭启动画面(不再固定播放4秒)
+    if splash is not None:
+        splash.finish(window)
+    print(f"启动完成，耗时 {time.perf_counter() - start_time:.2f} s", file=sys.stderr)
 
     # 启动事件循环
-    sys.exit(app.exec_())
\ No newline at end of file
+    sys.exit(app.exec_())
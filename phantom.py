@@ -0,0 +1,168 @@
+"""
+合成乳腺钼靶体模生成器
+
+生成带乳房轮廓背景、腺体纹理、可配置病灶(数量/大小/亮度)和噪声的8位灰度图像，
+用于基准测试和回归验证，无需真实病例数据。生成结果由随机种子完全确定。
+
+用法示例:
+    python phantom.py phantom_2048.png --size 2048 --lesions 12 --seed 1
+    python phantom.py phantom_cc_l.dcm --size 4096 --view CC --laterality L --monochrome1
+"""
+import argparse
+import sys
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+# 纹理噪声的生成分辨率相对图像的缩小倍数(低分辨率噪声放大后得到平滑的腺体纹理)
+_TEXTURE_SCALE = 32
+
+
+def breast_mask(height: int, width: int, oblique: bool = False) -> np.ndarray:
+    """乳房轮廓掩码(布尔)：胸壁位于左侧，外缘为半椭圆；oblique为True时上缘与图像上边缘相接(内外斜位)"""
+    if oblique:
+        rows = (np.arange(height, dtype=np.float32) - height * 0.3) / (height * 0.66)
+    else:
+        rows = (np.arange(height, dtype=np.float32) - height / 2) / (height * 0.46)
+    cols = np.arange(width, dtype=np.float32) / (width * 0.92)
+    return rows[:, None] ** 2 + cols[None, :] ** 2 <= 1.0
+
+
+def make_phantom(size: int = 1024, n_lesions: int = 8,
+                 lesion_radius: Tuple[int, int] = (6, 30),
+                 lesion_contrast: Tuple[float, float] = (40, 90),
+                 noise_sigma: float = 6.0, seed: int = 0,
+                 pectoral: bool = False) -> Tuple[np.ndarray, List[Dict]]:
+    """
+    生成合成乳腺钼靶体模
+
+    参数:
+        size: 图像高度(像素)，宽度为高度的0.8倍
+        n_lesions: 病灶数量
+        lesion_radius: 病灶半长轴范围(像素，按1024高度给出，随图像尺寸等比缩放)
+        lesion_contrast: 病灶相对背景的亮度增量范围(灰度级)
+        noise_sigma: 高斯噪声标准差(灰度级)
+        seed: 随机种子
+        pectoral: 是否模拟内外斜位: 乳房上缘与图像上边缘相接，胸壁侧上角为胸大肌三角区
+
+    返回:
+        (img, lesions): uint8灰度图像，以及病灶真值列表，
+        每项包含center(行, 列)、radii(半长轴, 半短轴)、angle(度)和contrast
+    """
+    if size < 64:
+        raise ValueError("体模尺寸不能小于64像素")
+    rng = np.random.default_rng(seed)
+    height, width = size, int(size * 0.8)
+    scale = size / 1024
+
+    # 乳房轮廓与由胸壁向皮肤线逐渐变暗的组织密度
+    inside = breast_mask(height, width, oblique=pectoral)
+    cols = np.arange(width, dtype=np.float32) / width
+    img = np.empty((height, width), dtype=np.float32)
+    img[:] = 150 - 60 * cols[None, :]
+
+    # 低分辨率噪声放大为平滑的腺体纹理
+    texture = rng.standard_normal((max(2, height // _TEXTURE_SCALE),
+                                   max(2, width // _TEXTURE_SCALE))).astype(np.float32)
+    texture = cv2.resize(texture, (width, height), interpolation=cv2.INTER_CUBIC)
+    img += 18 * texture
+
+    if pectoral:
+        # 胸大肌: 上边缘宽、向下收窄到胸壁的亮三角区，边界过渡约8像素(按1024高度)
+        rows = np.arange(height, dtype=np.float32)[:, None]
+        boundary = width * 0.35 * (1 - rows / (height * 0.55))
+        edge = (boundary - np.arange(width, dtype=np.float32)[None, :]) / (8 * scale)
+        img += 60 / (1 + np.exp(-np.clip(edge, -30, 30)))
+
+    # 病灶: 随机取向的椭圆，边缘按高斯分布过渡，只放置在乳房轮廓内
+    lesions = []
+    inside_rows, inside_cols = np.nonzero(inside[::8, ::8])
+    for _ in range(n_lesions):
+        i = rng.integers(len(inside_rows))
+        center = (int(inside_rows[i]) * 8, int(inside_cols[i]) * 8)
+        a = rng.uniform(*lesion_radius) * scale
+        b = a * rng.uniform(0.5, 1.0)
+        angle = rng.uniform(0, 180)
+        contrast = rng.uniform(*lesion_contrast)
+        _add_lesion(img, center, (a, b), angle, contrast)
+        lesions.append({'center': center, 'radii': (a, b), 'angle': angle, 'contrast': contrast})
+
+    img += rng.normal(0, noise_sigma, size=img.shape).astype(np.float32)
+    img[~inside] = 0
+    return np.clip(img, 0, 255).astype(np.uint8), lesions
+
+
+def _add_lesion(img: np.ndarray, center: Tuple[int, int], radii: Tuple[float, float],
+                angle: float, contrast: float) -> None:
+    """在病灶所在的局部窗口内叠加椭圆高斯亮斑"""
+    a, b = radii
+    reach = int(np.ceil(1.5 * a))
+    r0, r1 = max(0, center[0] - reach), min(img.shape[0], center[0] + reach + 1)
+    c0, c1 = max(0, center[1] - reach), min(img.shape[1], center[1] + reach + 1)
+    rows = np.arange(r0, r1, dtype=np.float32)[:, None] - center[0]
+    cols = np.arange(c0, c1, dtype=np.float32)[None, :] - center[1]
+    theta = np.deg2rad(angle)
+    u = cols * np.cos(theta) + rows * np.sin(theta)
+    v = -cols * np.sin(theta) + rows * np.cos(theta)
+    # 平顶的广义高斯分布，边缘清晰但不突变
+    dist = (u / a) ** 2 + (v / b) ** 2
+    img[r0:r1, c0:c1] += contrast * np.exp(-dist ** 2)
+
+
+def save_dicom(path: str, img: np.ndarray, view: str = 'CC', laterality: str = 'L',
+               monochrome1: bool = False, seed: int = 0, signed: bool = False,
+               rle: bool = False) -> None:
+    """
+    将体模保存为12位DICOM：8位灰度扩展到12位并补充低位噪声，窗宽窗位对应原8位范围
+
+    signed为True时以有符号存储值(减去2048)保存并用重标定截距还原，实际值不变；
+    rle为True时以RLE无损压缩保存
+    """
+    import dicom_io
+
+    rng = np.random.default_rng(seed)
+    pixels = img.astype(np.uint16) << 4
+    pixels |= rng.integers(0, 16, size=img.shape, dtype=np.uint16)
+    if monochrome1:
+        pixels = 4095 - pixels
+    rescale = None
+    if signed:
+        pixels = pixels.astype(np.int16) - 2048
+        rescale = (1, 2048)
+    dicom_io.write_dicom(path, pixels, bits_stored=12,
+                         photometric='MONOCHROME1' if monochrome1 else 'MONOCHROME2',
+                         view=view, laterality=laterality, window=(2048, 4096),
+                         rescale=rescale, rle=rle)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="生成合成乳腺钼靶体模图像")
+    parser.add_argument('output', help="输出图像路径(.png等；.dcm保存为12位DICOM)")
+    parser.add_argument('--size', type=int, default=1024, help="图像高度(像素)")
+    parser.add_argument('--lesions', type=int, default=8, help="病灶数量")
+    parser.add_argument('--noise', type=float, default=6.0, help="高斯噪声标准差")
+    parser.add_argument('--seed', type=int, default=0, help="随机种子")
+    parser.add_argument('--pectoral', action='store_true', help="加入胸大肌三角区(模拟内外斜位)")
+    parser.add_argument('--view', default='CC', help="DICOM体位")
+    parser.add_argument('--laterality', default='L', help="DICOM侧别")
+    parser.add_argument('--monochrome1', action='store_true', help="DICOM按MONOCHROME1(反相)保存")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    img, lesions = make_phantom(args.size, args.lesions, noise_sigma=args.noise, seed=args.seed,
+                                pectoral=args.pectoral)
+    if args.output.lower().endswith('.dcm'):
+        save_dicom(args.output, img, args.view, args.laterality, args.monochrome1, args.seed)
+    elif not cv2.imwrite(args.output, img):
+        print(f"无法写入图像: {args.output}", file=sys.stderr)
+        return 1
+    print(f"已生成 {img.shape[1]}x{img.shape[0]} 体模({len(lesions)} 个病灶): {args.output}",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,986 @@
 import cv2
 import numpy as np
-from sklearn.cluster import KMeans
 from scipy import ndimage
-from skimage import measure
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
 import os
 import csv
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import foreground
+from diagnostics import Diagnostics, stage as diagnostics_stage
+from features import (BOUND_KEYS, MOMENT_KEYS, component_moments, component_table,
+                      fill_shape_features, mask_region_image, merge_moments, missing_shape_rows,
+                      table_from_moments)
+from result import AnalysisResult, lesion_table_from_features, lesion_table_to_features, unpack_mask
+
+
+# 流水线版本号，算法或默认行为变化导致结果不同时递增(用于结果缓存失效)
+PIPELINE_VERSION = 1
+
+CLUSTER_METHODS = ('histogram', 'sklearn')
+
+# 边长超过该值的图像应使用分块模式分析
+MAX_UNTILED_SIZE = 4096
+DEFAULT_TILE_SIZE = 1024
+
+# 高斯滤波核大小(5x5)对应的邻域半径
+_BLUR_KSIZE = (5, 5)
+_BLUR_HALO = 2
+
+# 各阶段完成时报告的进度(百分比)；特征提取在70~100之间按病灶数推进
+STAGE_PROGRESS = {
+    'enhance': 5,
+    'smooth': 15,
+    'histogram': 20,
+    'cluster': 35,
+    'mask': 40,
+    'morphology': 60,
+    'filter': 70,
+    'features': 100,
+}
+# 逐病灶循环中每隔多少个病灶报告一次进度
+_PROGRESS_INTERVAL = 16
+
+# 粗到细模式的默认降采样倍数
+DEFAULT_COARSE_FACTOR = 4
+# 粗到细模式的候选区域: 预览中换算到原分辨率后面积不超过面积上限除以该比例的连通域
+# (过滤口径与整图模式相同)都在原分辨率下复核，放宽上限以免漏掉降采样后面积变化的病灶
+COARSE_CANDIDATE_RATIO = 0.25
+# 粗到细模式中候选区域的最大扩展次数；用尽时仍接触区域边界的连通域(通常是与大片腺体
+# 组织相连的部分)被丢弃
+COARSE_MAX_GROWTH = 2
+# 候选区域总面积超过图像面积的该比例时(前景密集)，逐区域计算不再划算，改为整图计算
+COARSE_MAX_COVERAGE = 0.5
+
+# 整幅图像逐段处理(直方图、查表)时每段的像素数，避免整幅大小的索引类型临时数组
+_BAND_PIXELS = 1 << 20
+
+
+class AnalysisCancelled(Exception):
+    """分析被进度回调请求取消"""
+
+
+def _report_progress(progress_callback, stage: str, percent: float) -> None:
+    """调用进度回调progress_callback(stage, percent)；回调返回True表示请求取消"""
+    if progress_callback is not None and progress_callback(stage, percent):
+        raise AnalysisCancelled(f"分析已取消(阶段: {stage})")
+
+
+def gray_histogram(img: np.ndarray) -> np.ndarray:
+    """8位图像的256级灰度直方图；逐段统计，临时数组不超过一段大小"""
+    hist = np.zeros(256, dtype=np.int64)
+    band = max(1, _BAND_PIXELS // max(1, img.shape[1]))
+    for r0 in range(0, img.shape[0], band):
+        hist += np.bincount(img[r0:r0 + band].ravel(), minlength=256)
+    return hist
+
+
+def lookup_labels(lut: np.ndarray, labeled_mask: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    按标签查表(等价于lut[labeled_mask])，逐段写入out
+
+    参数:
+        lut: 标签编号到输出值的查找表
+        labeled_mask: 标记图
+        out: 可选的输出数组(与labeled_mask同尺寸，类型同lut)；默认新分配
+
+    返回:
+        np.ndarray: 查表结果(即out)
+    """
+    if out is None:
+        out = np.empty(labeled_mask.shape, dtype=lut.dtype)
+    band = max(1, _BAND_PIXELS // max(1, labeled_mask.shape[1]))
+    for r0 in range(0, labeled_mask.shape[0], band):
+        np.take(lut, labeled_mask[r0:r0 + band], out=out[r0:r0 + band], mode='clip')
+    return out
+
+
+class AnalysisWorkspace:
+    """
+    可复用的整幅图像缓冲区，供AnalysisPipeline各阶段直接写入
+
+    连续分析相同尺寸的图像时，平滑图像、掩码、标记图等不再重新分配；
+    尺寸或类型变化时按需重新分配。同一时刻只能有一个流水线使用工作区:
+    另一流水线开始使用时，前一个流水线的中间结果(引用工作区缓冲区)被释放。
+    工作区不是线程安全的，每个线程或进程应使用各自的工作区。
+
+    属性:
+        allocations: 累计分配缓冲区的次数(复用时不增加)
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._owner = None
+        self.allocations = 0
+
+    @property
+    def nbytes(self) -> int:
+        """全部缓冲区占用的字节数"""
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+    def buffer(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """名为name的缓冲区(内容未初始化)；尺寸或类型与已有缓冲区不同时重新分配"""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+    def claim(self, pipeline: 'AnalysisPipeline') -> None:
+        """由pipeline使用工作区；此前使用工作区的流水线释放中间结果"""
+        owner = self._owner() if self._owner is not None else None
+        if owner is not None and owner is not pipeline:
+            owner.clear()
+        self._owner = weakref.ref(pipeline)
+
+    def release(self) -> None:
+        """释放全部缓冲区"""
+        self._buffers.clear()
+        self._owner = None
+
+
+def cluster_histogram(hist: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    在256级灰度直方图上做加权一维K-Means聚类(动态规划求全局最优多阈值)
+
+    一维K-Means的最优解必为若干连续灰度区间，因此只需在非空灰度级上
+    按类内加权平方误差做动态规划，计算量与图像分辨率无关。
+
+    参数:
+        hist: 长度为256的灰度直方图(像素计数)
+        k: 聚类数量
+
+    返回:
+        (centers, label_lut): 升序排列的浮点聚类中心(长度k)，以及
+        灰度值到聚类编号的查找表(长度256, uint8)
+    """
+    return cluster_histogram_multi(hist, [k])[k]
+
+
+def cluster_histogram_multi(hist: np.ndarray, k_values) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    一次动态规划同时求出多个k的最优聚类
+
+    动态规划表的第c行即为c+1类的最优解，k+1类直接在k类的结果上递推，
+    因此求一组k的代价与只求最大的k相同。
+
+    返回:
+        dict: k -> (centers, label_lut)，含义同cluster_histogram
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    values = np.flatnonzero(hist)
+    if values.size == 0:
+        raise ValueError("直方图为空，无法聚类")
+    weights = hist[values]
+    x = values.astype(np.float64)
+    m = values.size
+    n_rows = min(max(k_values), m)
+
+    # 前缀和: cost[i, j] 为第i..j个灰度级归为一类时的加权平方误差
+    w_cum = np.concatenate(([0.0], np.cumsum(weights)))
+    s1_cum = np.concatenate(([0.0], np.cumsum(weights * x)))
+    s2_cum = np.concatenate(([0.0], np.cumsum(weights * x * x)))
+    w = w_cum[None, 1:] - w_cum[:-1, None]
+    s1 = s1_cum[None, 1:] - s1_cum[:-1, None]
+    s2 = s2_cum[None, 1:] - s2_cum[:-1, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost = s2 - s1 * s1 / w
+    cost[np.tril_indices(m, -1)] = np.inf
+    np.maximum(cost, 0, out=cost, where=np.isfinite(cost))
+
+    # dp[c, j]: 前j+1个灰度级分为c+1类的最小误差; start[c, j]: 最后一类的起点
+    dp = np.empty((n_rows, m))
+    start = np.zeros((n_rows, m), dtype=np.intp)
+    dp[0] = cost[0]
+    for c in range(1, n_rows):
+        prev = np.concatenate(([np.inf], dp[c - 1][:-1]))
+        total = prev[:, None] + cost
+        start[c] = np.argmin(total, axis=0)
+        dp[c] = total[start[c], np.arange(m)]
+
+    results = {}
+    for k in k_values:
+        n_clusters = min(k, m)
+
+        # 回溯得到各类的灰度区间
+        bounds = []
+        end = m - 1
+        for c in range(n_clusters - 1, -1, -1):
+            begin = start[c, end]
+            bounds.append((begin, end))
+            end = begin - 1
+        bounds.reverse()
+
+        centers = np.empty(k, dtype=np.float64)
+        label_lut = np.zeros(256, dtype=np.uint8)
+        for c, (begin, end) in enumerate(bounds):
+            centers[c] = (s1_cum[end + 1] - s1_cum[begin]) / (w_cum[end + 1] - w_cum[begin])
+            low = values[begin] if c > 0 else 0
+            label_lut[low:] = c
+        # 不同灰度级少于k时，多余的聚类中心复用最后一个(与sklearn行为一致，不会被分配像素)
+        centers[n_clusters:] = centers[n_clusters - 1]
+        results[k] = (centers, label_lut)
+    return results
+
+
+def cluster_inertia(hist: np.ndarray, centers: np.ndarray) -> float:
+    """聚类惯性: 各灰度级到最近聚类中心的加权平方距离之和"""
+    values = np.arange(256, dtype=np.float64)
+    distances = (values[:, None] - np.asarray(centers, dtype=np.float64)[None, :]) ** 2
+    return float(np.dot(np.asarray(hist, dtype=np.float64), distances.min(axis=1)))
+
+
+def _histogram_cluster_luts(hist: np.ndarray, k: int,
+                            lesion_is_bright: bool) -> Tuple[np.ndarray, int, np.ndarray, np.ndarray]:
+    """由平滑图像直方图求聚类中心，返回(聚类中心, 病灶聚类编号, 分割查找表, 掩码查找表)"""
+    cluster_centers, label_lut = cluster_histogram(hist, k)
+    return (cluster_centers,) + _cluster_luts(cluster_centers, label_lut, lesion_is_bright)
+
+
+def _cluster_luts(cluster_centers: np.ndarray, label_lut: np.ndarray,
+                  lesion_is_bright: bool) -> Tuple[int, np.ndarray, np.ndarray]:
+    """识别病灶聚类，返回(病灶聚类编号, 分割查找表, 掩码查找表)"""
+    centers = np.uint8(cluster_centers)
+    target_cluster = np.argmax(centers) if lesion_is_bright else np.argmin(centers)
+    segmented_lut = centers[label_lut]
+    mask_lut = (label_lut == target_cluster).astype(np.uint8) * 255
+    return target_cluster, segmented_lut, mask_lut
+
+
+def equalize_hist_lut(hist: np.ndarray) -> np.ndarray:
+    """由原图直方图计算与cv2.equalizeHist逐像素一致的均衡化查找表"""
+    hist = np.asarray(hist, dtype=np.int64)
+    lut = np.zeros(256, dtype=np.uint8)
+    nonzero = np.flatnonzero(hist)
+    if nonzero.size == 0:
+        return lut
+    first = nonzero[0]
+    total = hist.sum()
+    if hist[first] == total:
+        lut[:] = first
+        return lut
+    # 与OpenCV实现保持一致: 单精度缩放系数 + 四舍六入取整
+    scale = np.float32(255.0 / (total - hist[first]))
+    cumulative = np.cumsum(hist[first + 1:]).astype(np.float32)
+    lut[first + 1:] = np.clip(np.rint(cumulative * scale), 0, 255)
+    return lut
+
+
+def _cluster_sklearn(img_smooth: np.ndarray, k: int,
+                     init: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    参考实现: 对全部像素运行sklearn KMeans，返回(聚类中心, 灰度值到聚类编号的查找表)
+
+    init为可选的初始聚类中心(长度k)，用于由k-1类的结果热启动
+    """
+    # scikit-learn导入耗时较长，只在使用参考实现时导入
+    from sklearn.cluster import KMeans
+
+    pixel_values = img_smooth.reshape((-1, 1)).astype(np.float32)
+    if init is None:
+        kmeans = KMeans(n_clusters=k, random_state=42, n_init='auto')
+    else:
+        kmeans = KMeans(n_clusters=k, init=np.asarray(init, dtype=np.float32).reshape(-1, 1),
+                        n_init=1, random_state=42)
+    labels = kmeans.fit_predict(pixel_values)
+    # 每个像素归入最近的聚类中心，同一灰度值的标签必然相同，可折叠为查找表
+    label_lut = np.zeros(256, dtype=np.uint8)
+    label_lut[img_smooth.ravel()] = labels
+    return kmeans.cluster_centers_.ravel(), label_lut
+
+
+class AnalysisPipeline:
+    """
+    分阶段的分析流水线: 增强 → 平滑 → 聚类 → 掩码 → 形态学 → 过滤 → 特征
+
+    每个阶段的输出按其上游参数记忆(每阶段保留最近一次结果)，
+    同一图像只修改min_lesion_size或morph_kernel_size等参数时，
+    只重算受影响的下游阶段。
+
+    参数:
+        img: 灰度图像 (numpy数组)
+        workspace: 可选的AnalysisWorkspace；指定时整幅图像大小的中间结果写入其中的
+            缓冲区，连续分析相同尺寸的图像时不再重新分配
+    """
+
+    STAGES = ('enhance', 'smooth', 'histogram', 'cluster', 'mask', 'morphology', 'filter', 'features')
+
+    def __init__(self, img: np.ndarray, workspace: Optional[AnalysisWorkspace] = None):
+        if img is None or len(img.shape) != 2:
+            raise ValueError("输入图像应为灰度图像")
+        self.img = img
+        self.workspace = workspace
+        self._memo = {}
+        # 粗到细模式的降采样流水线: 倍数 -> (流水线, 行缩放比, 列缩放比)
+        self._coarse = {}
+        # 裁剪到乳房区域的流水线: 是否屏蔽胸肌 -> (流水线或None(无需裁剪), 裁剪框)
+        self._foreground = {}
+        # 各阶段实际计算次数，便于确认记忆是否生效
+        self.stage_runs = dict.fromkeys(self.STAGES, 0)
+        # 进度回调按线程保存，同一流水线可同时被多个线程使用
+        self._local = threading.local()
+
+    def _report(self, stage: str, percent: float) -> None:
+        _report_progress(getattr(self._local, 'progress_callback', None), stage, percent)
+
+    def _diagnostics(self) -> Optional[Diagnostics]:
+        return getattr(self._local, 'diagnostics', None)
+
+    def _count(self, **counts) -> None:
+        """为当前阶段的诊断记录添加计数(未启用诊断时不做任何事)"""
+        diagnostics = self._diagnostics()
+        if diagnostics is not None:
+            diagnostics.add_counts(**counts)
+
+    def _buffer(self, name: str, dtype=np.uint8) -> Optional[np.ndarray]:
+        """工作区中与图像同尺寸的缓冲区；未使用工作区时返回None(由OpenCV/NumPy新分配)"""
+        if self.workspace is None:
+            return None
+        self.workspace.claim(self)
+        return self.workspace.buffer(name, self.img.shape, dtype)
+
+    def _stage(self, name: str, key: Tuple, compute):
+        cached = self._memo.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        diagnostics = self._diagnostics()
+        if diagnostics is None:
+            value = compute()
+        else:
+            with diagnostics.stage(name):
+                value = compute()
+        self._memo[name] = (key, value)
+        self.stage_runs[name] += 1
+        # 阶段结果已保存，此时取消不会丢失已完成的计算
+        self._report(name, STAGE_PROGRESS[name])
+        return value
+
+    def clear(self) -> None:
+        """释放全部中间结果"""
+        self._memo.clear()
+        self._coarse.clear()
+        self._foreground.clear()
+
+    def fork(self) -> 'AnalysisPipeline':
+        """
+        创建共享预处理结果(增强、平滑、直方图)的新流水线，用于并行运行不同参数
+
+        新流水线不使用工作区(工作区不能被多个线程同时使用)。
+        """
+        forked = AnalysisPipeline(self.img)
+        for name in ('enhance', 'smooth', 'histogram'):
+            if name in self._memo:
+                forked._memo[name] = self._memo[name]
+        return forked
+
+    def enhance(self) -> np.ndarray:
+        """直方图均衡化查找表(与cv2.equalizeHist逐像素一致)"""
+        return self._stage('enhance', (), lambda: equalize_hist_lut(gray_histogram(self.img)))
+
+    def smooth(self) -> np.ndarray:
+        """均衡化后高斯滤波的图像"""
+        def compute():
+            img_enhanced = cv2.LUT(self.img, self.enhance(), dst=self._buffer('enhanced'))
+            return cv2.GaussianBlur(img_enhanced, _BLUR_KSIZE, 0, dst=self._buffer('smooth'))
+        return self._stage('smooth', (), compute)
+
+    def histogram(self) -> np.ndarray:
+        """平滑图像的256级灰度直方图"""
+        return self._stage('histogram', (), lambda: gray_histogram(self.smooth()))
+
+    def cluster(self, k: int, cluster_method: str = 'histogram') -> Tuple[np.ndarray, np.ndarray]:
+        """K-Means聚类，返回(聚类中心, 灰度值到聚类编号的查找表)"""
+        if cluster_method not in CLUSTER_METHODS:
+            raise ValueError(f"未知的聚类方法: {cluster_method}")
+
+        def compute():
+            if cluster_method == 'histogram':
+                # 8位图像的聚类问题可完全在256级直方图上求解，再通过查找表映射回像素
+                return cluster_histogram(self.histogram(), k)
+            return _cluster_sklearn(self.smooth(), k)
+        return self._stage('cluster', (k, cluster_method), compute)
+
+    def cluster_sweep(self, k_values, cluster_method: str = 'histogram') -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """
+        对一组k依次聚类，k+1类由k类的结果热启动
+
+        直方图聚类一次动态规划即得到全部k的最优解；sklearn聚类以k类中心
+        加上距离最远的灰度级作为k+1类的初始中心(结果可能与独立运行时不同)。
+
+        返回:
+            dict: k -> (聚类中心, 灰度值到聚类编号的查找表)
+        """
+        if cluster_method not in CLUSTER_METHODS:
+            raise ValueError(f"未知的聚类方法: {cluster_method}")
+        k_values = sorted(set(int(k) for k in k_values))
+        if cluster_method == 'histogram':
+            return cluster_histogram_multi(self.histogram(), k_values)
+        clusters = {}
+        prev_k = None
+        for k in k_values:
+            init = None
+            if prev_k == k - 1:
+                init = _warm_start_centers(self.histogram(), clusters[prev_k][0])
+            clusters[k] = _cluster_sklearn(self.smooth(), k, init)
+            prev_k = k
+        return clusters
+
+    def sweep(self, k_values=range(2, 7), lesion_is_bright: bool = True,
+              morph_kernel_size: Tuple[int, int] = (5, 5), min_lesion_size: int = 100,
+              cluster_method: str = 'histogram', max_workers: Optional[int] = None,
+              progress_callback=None,
+              shape_top_n: Optional[int] = None, crop_foreground: bool = False,
+              mask_pectoral: bool = False) -> Tuple[Dict[int, AnalysisResult], List[Dict]]:
+        """
+        一次分析多个聚类数量k
+
+        预处理只计算一次，各k的聚类热启动完成后，后续阶段在共享预处理结果的
+        分支流水线上并行运行。
+
+        参数:
+            k_values: 需要分析的k
+            max_workers: 并行线程数，默认取k的个数与CPU核数中的较小者
+            progress_callback: 进度回调，各分支流水线共用，返回True时取消全部k
+            其余参数含义同analyze_mammo_image
+
+        返回:
+            (results, summary): k到AnalysisResult的字典，以及按k升序的摘要列表，
+            每项包含k、cluster_centers、inertia、lesion_count、lesion_percentage
+        """
+        if crop_foreground:
+            pipeline, box = self.foreground(mask_pectoral)
+            if pipeline is not self:
+                results, _ = pipeline.sweep(k_values, lesion_is_bright, morph_kernel_size, min_lesion_size,
+                                            cluster_method, max_workers, progress_callback, shape_top_n)
+                results = {k: uncrop_result(result, self.img, box) for k, result in results.items()}
+                hist = pipeline.histogram()
+                return results, [summarize_result(k, results[k], hist) for k in sorted(results)]
+        k_values = sorted(set(int(k) for k in k_values))
+        self._local.progress_callback = progress_callback
+        try:
+            clusters = self.cluster_sweep(k_values, cluster_method)
+        finally:
+            self._local.progress_callback = None
+
+        def run_one(k):
+            forked = self.fork()
+            forked._memo['cluster'] = ((k, cluster_method), clusters[k])
+            return k, forked.run(k, lesion_is_bright, morph_kernel_size, min_lesion_size, cluster_method,
+                                 progress_callback=progress_callback, shape_top_n=shape_top_n)
+
+        max_workers = max_workers or min(len(k_values), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = dict(executor.map(run_one, k_values))
+        hist = self.histogram()
+        return results, [summarize_result(k, results[k], hist) for k in k_values]
+
+    def mask(self, k: int, lesion_is_bright: bool,
+             cluster_method: str = 'histogram') -> Tuple[int, np.ndarray, np.ndarray]:
+        """识别病灶聚类，返回(病灶聚类编号, 分割查找表, 掩码查找表)"""
+        return self._stage('mask', (k, lesion_is_bright, cluster_method), lambda: _cluster_luts(
+            *self.cluster(k, cluster_method), lesion_is_bright))
+
+    def morphology(self, k: int, lesion_is_bright: bool, morph_kernel_size: Tuple[int, int],
+                   cluster_method: str = 'histogram') -> Dict:
+        """形态学闭/开运算优化掩码并标记连通域"""
+        morph_kernel_size = tuple(morph_kernel_size)
+
+        def compute():
+            _, _, mask_lut = self.mask(k, lesion_is_bright, cluster_method)
+            mask_img = cv2.LUT(self.smooth(), mask_lut, dst=self._buffer('mask'))
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, morph_kernel_size)
+            # 闭、开运算在两个缓冲区之间交替写入(OpenCV不支持原地形态学运算)
+            closed = cv2.morphologyEx(mask_img, cv2.MORPH_CLOSE, kernel, dst=self._buffer('closed'))
+            mask_img = cv2.morphologyEx(closed, cv2.MORPH_OPEN, kernel, dst=mask_img)
+            with diagnostics_stage(self._diagnostics(), 'morphology/label'):
+                labeled_mask = self._buffer('labels', np.int32)
+                if labeled_mask is None:
+                    labeled_mask, num_features = ndimage.label(mask_img)
+                else:
+                    num_features = ndimage.label(mask_img, output=labeled_mask)
+            # 全部连通域的面积、边界框、质心和矩一次向量化计算；
+            # 形态特征按需计算后也按标签保存在此表中，供其他过滤参数复用
+            with diagnostics_stage(self._diagnostics(), 'morphology/moments'):
+                components = component_table(labeled_mask, num_features)
+            # 各标签像素数直接取自特征表，背景为其余像素，无需再遍历标记图
+            counts = np.empty(num_features + 1, dtype=np.int64)
+            counts[1:] = components['area']
+            counts[0] = labeled_mask.size - counts[1:].sum()
+            self._count(components=num_features)
+            return {
+                'labeled_mask': labeled_mask,
+                'counts': counts,
+                'components': components,
+            }
+        return self._stage('morphology', (k, lesion_is_bright, cluster_method, morph_kernel_size),
+                           compute)
+
+    def filter(self, k: int, lesion_is_bright: bool, morph_kernel_size: Tuple[int, int],
+               min_lesion_size: int, cluster_method: str = 'histogram') -> Tuple[np.ndarray, np.ndarray, float]:
+        """移除过小和过大的连通域，返回(保留标签表, 过滤后掩码, 病灶占比%)"""
+        morph = self.morphology(k, lesion_is_bright, morph_kernel_size, cluster_method)
+
+        def compute():
+            counts = morph['counts']
+            # 与ndimage.sum(mask_img, labeled_mask, ...)口径一致：按掩码值255累加
+            sizes = counts * 255
+            mask_size = morph['labeled_mask'].size
+            # 按标签编号建立保留表，一次查表完成过滤
+            keep = (sizes >= min_lesion_size) & (sizes <= 0.8 * mask_size)
+            keep[0] = False
+            keep_lut = keep.astype(np.uint8) * 255
+            mask_img = lookup_labels(keep_lut, morph['labeled_mask'], self._buffer('filtered'))
+            lesion_percentage = counts[keep].sum() / mask_size * 100
+            self._count(lesions=int(np.count_nonzero(keep)))
+            return keep, mask_img, lesion_percentage
+        return self._stage('filter', (k, lesion_is_bright, cluster_method, tuple(morph_kernel_size),
+                                      min_lesion_size), compute)
+
+    def features(self, k: int, lesion_is_bright: bool, morph_kernel_size: Tuple[int, int],
+                 min_lesion_size: int, cluster_method: str = 'histogram',
+                 shape_top_n: Optional[int] = None) -> np.ndarray:
+        """
+        返回保留病灶按面积降序的特征表(结构化数组)
+
+        周长、圆形度和凸包实度只为前shape_top_n个病灶计算(None为全部)，其余为NaN，
+        可用complete_shape_features按需补算
+        """
+        morph = self.morphology(k, lesion_is_bright, morph_kernel_size, cluster_method)
+        keep, _, _ = self.filter(k, lesion_is_bright, morph_kernel_size, min_lesion_size, cluster_method)
+
+        def compute():
+            components, labeled_mask = morph['components'], morph['labeled_mask']
+            labels = np.flatnonzero(keep)
+            table = components[labels - 1]
+            # 按面积降序排序(稳定排序，面积相同时保持标签顺序)
+            order = np.argsort(-table['area'], kind='stable')
+            table, labels = table[order], labels[order]
+
+            count = len(table) if shape_top_n is None else min(shape_top_n, len(table))
+            pending = missing_shape_rows(table, range(count))
+            self._count(regions=len(pending))
+
+            def region_image(row):
+                min_row, min_col, max_row, max_col = table['bounding_box'][row]
+                return labeled_mask[min_row:max_row, min_col:max_col] == labels[row]
+
+            def progress(i, total):
+                if i % _PROGRESS_INTERVAL == 0:
+                    self._report('features', 70 + 30 * i / total)
+
+            fill_shape_features(table, region_image, pending, progress)
+            components[labels[pending] - 1] = table[pending]
+            return table
+        return self._stage('features', (k, lesion_is_bright, cluster_method, tuple(morph_kernel_size),
+                                        min_lesion_size, shape_top_n), compute)
+
+    def foreground(self, mask_pectoral: bool = False) -> Tuple['AnalysisPipeline', Tuple[int, int, int, int]]:
+        """
+        裁剪到乳房区域(见foreground.foreground_box)的流水线，按是否屏蔽胸肌记忆
+
+        屏蔽胸肌时检测到的胸大肌区置为0(按背景处理)。图像没有可去除的背景且未屏蔽胸肌时
+        返回流水线本身。
+
+        返回:
+            (流水线, 裁剪框(r0, r1, c0, c1))
+        """
+        entry = self._foreground.get(mask_pectoral)
+        if entry is None:
+            with diagnostics_stage(self._diagnostics(), 'foreground'):
+                height, width = self.img.shape
+                box = foreground.foreground_box(self.img)
+                r0, r1, c0, c1 = box
+                crop = self.img[r0:r1, c0:c1]
+                pectoral = foreground.pectoral_mask(crop) if mask_pectoral else None
+                if pectoral is not None:
+                    crop = crop.copy()
+                    crop[pectoral] = 0
+                if pectoral is None and box == (0, height, 0, width):
+                    # 不保存流水线本身，避免循环引用推迟中间结果的释放
+                    entry = (None, box)
+                else:
+                    entry = (AnalysisPipeline(crop, self.workspace), box)
+            self._foreground[mask_pectoral] = entry
+        pipeline, box = entry
+        return (pipeline or self), box
+
+    def _foreground_for(self, mask_pectoral: bool,
+                        diagnostics: Optional[Diagnostics]) -> Tuple['AnalysisPipeline', Tuple[int, int, int, int]]:
+        """foreground()，首次检测的耗时记入diagnostics"""
+        self._local.diagnostics = diagnostics
+        try:
+            return self.foreground(mask_pectoral)
+        finally:
+            self._local.diagnostics = None
+
+    def _coarse_pipeline(self, coarse_factor: int) -> Tuple['AnalysisPipeline', float, float]:
+        """降采样图像的流水线(按倍数记忆)，返回(流水线, 行缩放比, 列缩放比)"""
+        if coarse_factor < 2:
+            raise ValueError("降采样倍数应不小于2")
+        entry = self._coarse.get(coarse_factor)
+        if entry is None:
+            height, width = self.img.shape
+            size = (-(-width // coarse_factor), -(-height // coarse_factor))
+            small = cv2.resize(np.ascontiguousarray(self.img), size, interpolation=cv2.INTER_AREA)
+            entry = (AnalysisPipeline(small), height / size[1], width / size[0])
+            self._coarse[coarse_factor] = entry
+        return entry
+
+    def preview(self, k: int = 3, lesion_is_bright: bool = True,
+                morph_kernel_size: Tuple[int, int] = (5, 5), min_lesion_size: int = 100,
+                cluster_method: str = 'histogram', coarse_factor: int = DEFAULT_COARSE_FACTOR,
+                progress_callback=None, diagnostics: Optional[Diagnostics] = None,
+                shape_top_n: Optional[int] = None, crop_foreground: bool = False,
+                mask_pectoral: bool = False) -> AnalysisResult:
+        """
+        粗到细分析的预览: 在降采样图像上分析，结果映射回原图尺寸和坐标
+
+        形态学核与最小病灶面积按降采样比例缩小；掩码按最近邻放大，特征表中的面积、边界框、
+        质心和长度按比例换算(近似值)。精细结果由run(coarse_factor=...)给出。
+        """
+        if crop_foreground:
+            pipeline, box = self._foreground_for(mask_pectoral, diagnostics)
+            if pipeline is not self:
+                return uncrop_result(pipeline.preview(k, lesion_is_bright, morph_kernel_size, min_lesion_size,
+                                                      cluster_method, coarse_factor, progress_callback,
+                                                      diagnostics, shape_top_n), self.img, box)
+        small, sy, sx = self._coarse_pipeline(coarse_factor)
+        with diagnostics_stage(diagnostics, 'preview'):
+            result = small.run(k, lesion_is_bright, _coarse_kernel(morph_kernel_size, sy, sx),
+                               min_lesion_size / (sy * sx), cluster_method,
+                               progress_callback=progress_callback, shape_top_n=shape_top_n)
+            height, width = self.img.shape
+            # 各阶段使用各自的缓冲区，不覆盖filter阶段缓存的掩码
+            mask_img = cv2.resize(result.mask_img, (width, height), dst=self._buffer('preview_mask'),
+                                  interpolation=cv2.INTER_NEAREST)
+        preview = AnalysisResult(self.img, mask_img, result.equalize_lut, result.segmented_lut,
+                                 scale_lesion_table(result.lesion_table, sy, sx),
+                                 result.lesion_percentage, result.target_cluster,
+                                 result.cluster_centers)
+        preview.diagnostics = diagnostics
+        return preview
+
+    def _candidate_boxes(self, k: int, lesion_is_bright: bool, morph_kernel_size: Tuple[int, int],
+                         cluster_method: str,
+                         coarse_factor: int) -> Tuple[List[Tuple[int, int, int, int]], np.ndarray]:
+        """
+        由预览得到候选区域
+
+        返回(候选连通域换算到原图并扩展邻域后的区域列表(r0, r1, c0, c1),
+        降采样图像上候选连通域的布尔掩码)。换算到原分辨率后的面积明显超过面积上限
+        (COARSE_CANDIDATE_RATIO倍以上)的连通域在整图模式中也会被过滤，不作为候选；
+        不按最小病灶面积筛选，以便修改该参数时复用细化结果。
+        """
+        small, sy, sx = self._coarse_pipeline(coarse_factor)
+        morph = small.morphology(k, lesion_is_bright, _coarse_kernel(morph_kernel_size, sy, sx),
+                                 cluster_method)
+        components = morph['components']
+        height, width = self.img.shape
+        sizes = components['area'] * sy * sx * 255
+        candidate = sizes <= 0.8 * height * width / COARSE_CANDIDATE_RATIO
+        candidate_mask = np.concatenate([[False], candidate])[morph['labeled_mask']]
+
+        # 降采样的边界最多偏差一个低分辨率像素，再留出同样宽度的余量
+        boxes = components['bounding_box'][candidate]
+        margin = 2 * int(np.ceil(max(sy, sx)))
+        scaled = np.empty((len(boxes), 4), dtype=np.int64)
+        scaled[:, 0] = np.maximum(np.floor(boxes[:, 0] * sy).astype(np.int64) - margin, 0)
+        scaled[:, 1] = np.minimum(np.ceil(boxes[:, 2] * sy).astype(np.int64) + margin, height)
+        scaled[:, 2] = np.maximum(np.floor(boxes[:, 1] * sx).astype(np.int64) - margin, 0)
+        scaled[:, 3] = np.minimum(np.ceil(boxes[:, 3] * sx).astype(np.int64) + margin, width)
+        return _merge_boxes(scaled), candidate_mask
+
+    def _refine_regions(self, k: int, lesion_is_bright: bool, morph_kernel_size: Tuple[int, int],
+                        cluster_method: str, coarse_factor: int) -> Optional[Dict]:
+        """
+        粗到细模式的区域形态学与连通域标记(按参数记忆，修改最小病灶面积时复用)
+
+        返回各区域的标签图及全部连通域的矩、首像素序号、所属区域和是否接触区域边界；
+        候选区域过密时返回None。
+        """
+        key = (k, lesion_is_bright, cluster_method, morph_kernel_size, coarse_factor)
+        cached = self._memo.get('refine')
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        height, width = self.img.shape
+        smooth = self.smooth()
+        _, _, mask_lut = self.mask(k, lesion_is_bright, cluster_method)
+        diagnostics = self._diagnostics()
+        with diagnostics_stage(diagnostics, 'preview'):
+            boxes, candidate_mask = self._candidate_boxes(k, lesion_is_bright, morph_kernel_size,
+                                                          cluster_method, coarse_factor)
+        if sum((r1 - r0) * (c1 - c0) for r0, r1, c0, c1 in boxes) > COARSE_MAX_COVERAGE * height * width:
+            self._memo['refine'] = (key, None)
+            return None
+        _, sy, sx = self._coarse_pipeline(coarse_factor)
+
+        def candidate_pixels(r0, r1, c0, c1):
+            """原图区域内落在候选连通域(预览)上的像素"""
+            rows = np.minimum((np.arange(r0, r1) / sy).astype(np.int64), candidate_mask.shape[0] - 1)
+            cols = np.minimum((np.arange(c0, c1) / sx).astype(np.int64), candidate_mask.shape[1] - 1)
+            return candidate_mask[np.ix_(rows, cols)]
+
+        # 面积上限(像素数)，与filter的口径一致
+        max_pixels = 0.8 * height * width / 255
+        # 闭运算+开运算共4次腐蚀/膨胀，区域外扩该半径后计算，区域内的结果与整图一致
+        halo = 4 * (max(morph_kernel_size) // 2)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, morph_kernel_size)
+        # 完成的区域 -> (标签图, 连通域数, 各连通域是否接触区域边界(图像边缘除外))
+        regions = {}
+        with diagnostics_stage(diagnostics, 'morphology', regions=len(boxes)) as record:
+            pending = [(box, box, 0) for box in boxes]
+            while pending:
+                (r0, r1, c0, c1), origin, steps = pending.pop()
+                if (r0, r1, c0, c1) in regions:
+                    continue
+                wr0, wr1 = max(0, r0 - halo), min(height, r1 + halo)
+                wc0, wc1 = max(0, c0 - halo), min(width, c1 + halo)
+                window = cv2.LUT(smooth[wr0:wr1, wc0:wc1], mask_lut)
+                window = cv2.morphologyEx(window, cv2.MORPH_CLOSE, kernel)
+                window = cv2.morphologyEx(window, cv2.MORPH_OPEN, kernel)
+                labels, num = ndimage.label(window[r0 - wr0:r1 - wr0, c0 - wc0:c1 - wc0])
+                # 与预览候选连通域重叠的连通域接触某边、且在区域内的部分不超过面积上限时，
+                # 无法确定其完整面积，向该边扩展区域边长的一半(至少32像素)后重算；
+                # 不与候选重叠的连通域(如相邻的组织)不需要完整
+                small = np.bincount(labels.ravel(), minlength=num + 1) <= max_pixels
+                relevant = np.zeros(num + 1, dtype=bool)
+                origin_labels = labels[origin[0] - r0:origin[1] - r0, origin[2] - c0:origin[3] - c0]
+                relevant[origin_labels[candidate_pixels(*origin)]] = True
+                relevant[0] = False
+                small &= relevant
+                touching = np.zeros(num + 1, dtype=bool)
+                sides = []
+                for edge, inner in ((labels[0], r0 > 0), (labels[-1], r1 < height),
+                                    (labels[:, 0], c0 > 0), (labels[:, -1], c1 < width)):
+                    if inner:
+                        touching[edge] = True
+                    sides.append(inner and bool(small[edge].any()))
+                if any(sides) and steps < COARSE_MAX_GROWTH:
+                    grow_rows, grow_cols = max(32, (r1 - r0) // 2), max(32, (c1 - c0) // 2)
+                    top, bottom, left, right = sides
+                    grown = (max(0, r0 - grow_rows) if top else r0, min(height, r1 + grow_rows) if bottom else r1,
+                             max(0, c0 - grow_cols) if left else c0, min(width, c1 + grow_cols) if right else c1)
+                    pending.append((grown, origin, steps + 1))
+                    continue
+                regions[(r0, r1, c0, c1)] = (labels, num, touching[1:])
+                self._report('morphology', 40 + 20 * len(regions) / (len(regions) + len(pending)))
+
+            boxes = list(regions)
+            box_labels, fragments, seeds, owners, touching = [], [], [], [], []
+            for index, (r0, r1, c0, c1) in enumerate(boxes):
+                labels, num, border = regions[r0, r1, c0, c1]
+                box_labels.append(labels)
+                if not num:
+                    continue
+                fragments.append(component_moments(labels, num, offset=(r0, c0)))
+                flat = labels.ravel()
+                foreground = np.flatnonzero(flat)
+                _, first = np.unique(flat[foreground], return_index=True)
+                first = foreground[first]
+                seeds.append((first // (c1 - c0) + r0) * width + first % (c1 - c0) + c0)
+                owners.append(np.full(num, index, dtype=np.int64))
+                touching.append(border)
+            empty = [np.zeros(0, dtype=np.int64)]
+            refined = {
+                'boxes': boxes,
+                'labels': box_labels,
+                'moments': {key: np.concatenate([m[key] for m in fragments] or empty)
+                            for key in BOUND_KEYS + MOMENT_KEYS},
+                'seeds': np.concatenate(seeds or empty),
+                'owners': np.concatenate(owners or empty),
+                'touching': np.concatenate(touching or [np.zeros(0, dtype=bool)]),
+            }
+            if record is not None:
+                record['pixels'] = int(sum((r1 - r0) * (c1 - c0) for r0, r1, c0, c1 in boxes))
+                record['components'] = len(refined['seeds'])
+        self._memo['refine'] = (key, refined)
+        return refined
+
+    def refine(self, k: int, lesion_is_bright: bool, morph_kernel_size: Tuple[int, int],
+               min_lesion_size: int, cluster_method: str = 'histogram',
+               coarse_factor: int = DEFAULT_COARSE_FACTOR,
+               shape_top_n: Optional[int] = None) -> AnalysisResult:
+        """
+        粗到细分析的精细阶段: 只在预览候选区域内按原分辨率做掩码、形态学、标记和特征提取
+
+        增强、平滑和聚类仍在整幅图像上进行(查找表与整图模式相同)。区域边界上仍有前景时
+        向外扩展该区域并重算，直到接触边界的连通域在区域内的部分已超过面积上限(整图模式中
+        同样会被过滤)，因此候选区域内的病灶与整图模式逐像素一致。以下病灶不在结果中:
+        预览中没有对应候选的(通常是降采样后消失的微小连通域)；扩展COARSE_MAX_GROWTH次后
+        仍接触区域边界的(通常与大片组织相连)。候选区域过密(见COARSE_MAX_COVERAGE)时
+        改为整图计算，结果与整图模式相同。应通过run(coarse_factor=...)调用以获得进度回调和诊断记录。
+        """
+        morph_kernel_size = tuple(morph_kernel_size)
+        height, width = self.img.shape
+        self.enhance()
+        self.smooth()
+        if cluster_method == 'histogram':
+            self.histogram()
+        cluster_centers, _ = self.cluster(k, cluster_method)
+        target_cluster, segmented_lut, _ = self.mask(k, lesion_is_bright, cluster_method)
+        refined = self._refine_regions(k, lesion_is_bright, morph_kernel_size, cluster_method,
+                                       coarse_factor)
+        if refined is None:
+            params = (k, lesion_is_bright, morph_kernel_size, min_lesion_size, cluster_method)
+            _, mask_img, lesion_percentage = self.filter(*params)
+            lesion_table = self.features(*params, shape_top_n)
+            return AnalysisResult(self.img, mask_img, self.enhance(), segmented_lut, lesion_table,
+                                  lesion_percentage, target_cluster, cluster_centers)
+        self._report('morphology', STAGE_PROGRESS['morphology'])
+        boxes, box_labels, moments = refined['boxes'], refined['labels'], refined['moments']
+        seeds, owners = refined['seeds'], refined['owners']
+
+        diagnostics = self._diagnostics()
+        with diagnostics_stage(diagnostics, 'filter'):
+            # 与整图模式相同的过滤口径(按掩码值255累加)；接触区域边界的是超过面积上限的连通域
+            # 或扩展次数用尽时的不完整连通域，一并丢弃
+            sizes = moments['count']
+            mask_size = height * width
+            keep = ((sizes * 255 >= min_lesion_size) & (sizes * 255 <= 0.8 * mask_size) &
+                    ~refined['touching'])
+            # 区域重叠时同一连通域会被标记多次(结果相同)，掩码取各区域保留部分的并集，
+            # 特征表按首像素去重
+            mask_img = self._buffer('refined_mask')
+            if mask_img is None:
+                mask_img = np.zeros((height, width), dtype=np.uint8)
+            else:
+                mask_img.fill(0)
+            start = 0
+            for (r0, r1, c0, c1), labels in zip(boxes, box_labels):
+                num = int(labels.max()) if labels.size else 0
+                keep_lut = np.zeros(num + 1, dtype=np.uint8)
+                keep_lut[1:] = keep[start:start + num] * 255
+                np.maximum(mask_img[r0:r1, c0:c1], keep_lut[labels], out=mask_img[r0:r1, c0:c1])
+                start += num
+            kept = np.flatnonzero(keep)
+            kept = kept[np.unique(seeds[kept], return_index=True)[1]]
+            lesion_percentage = sizes[kept].sum() / mask_size * 100
+            self._count(lesions=len(kept))
+        self._report('filter', STAGE_PROGRESS['filter'])
+
+        # np.unique已按首像素(整图标记顺序)排列，再按面积降序，与整图模式一致
+        lesion_table = table_from_moments({key: value[kept] for key, value in moments.items()})
+        order = np.argsort(-lesion_table['area'], kind='stable')
+        lesion_table, kept = lesion_table[order], kept[order]
+        count = len(kept) if shape_top_n is None else min(shape_top_n, len(kept))
+        with diagnostics_stage(diagnostics, 'features', regions=count):
+            def region_image(row):
+                index = kept[row]
+                r0, _, c0, _ = boxes[owners[index]]
+                labels = box_labels[owners[index]]
+                min_row, min_col, max_row, max_col = lesion_table['bounding_box'][row]
+                window = labels[min_row - r0:max_row - r0, min_col - c0:max_col - c0]
+                seed_row, seed_col = divmod(int(seeds[index]), width)
+                return window == labels[seed_row - r0, seed_col - c0]
+
+            def progress(i, total):
+                if i % _PROGRESS_INTERVAL == 0:
+                    self._report('features', 70 + 30 * i / total)
+
+            fill_shape_features(lesion_table, region_image, range(count), progress)
+
+        return AnalysisResult(self.img, mask_img, self.enhance(), segmented_lut, lesion_table,
+                              lesion_percentage, target_cluster, cluster_centers)
+
+    def run(self, k: int = 3, lesion_is_bright: bool = True,
+            morph_kernel_size: Tuple[int, int] = (5, 5), min_lesion_size: int = 100,
+            cluster_method: str = 'histogram', tile_size: Optional[int] = None,
+            progress_callback=None, diagnostics: Optional[Diagnostics] = None,
+            shape_top_n: Optional[int] = None,
+            coarse_factor: Optional[int] = None, crop_foreground: bool = False,
+            mask_pectoral: bool = False) -> AnalysisResult:
+        """按给定参数运行(或复用)各阶段，参数含义同analyze_mammo_image"""
+        if cluster_method not in CLUSTER_METHODS:
+            raise ValueError(f"未知的聚类方法: {cluster_method}")
+        if crop_foreground:
+            pipeline, box = self._foreground_for(mask_pectoral, diagnostics)
+            if pipeline is not self:
+                return uncrop_result(pipeline.run(k, lesion_is_bright, morph_kernel_size, min_lesion_size,
+                                                  cluster_method, tile_size, progress_callback, diagnostics,
+                                                  shape_top_n, coarse_factor), self.img, box)
+        if tile_size and not coarse_factor:
+            if cluster_method != 'histogram':
+                raise ValueError("分块模式仅支持直方图聚类")
+            return analyze_mammo_image_tiled(self.img, k, lesion_is_bright, morph_kernel_size,
+                                             min_lesion_size, tile_size=tile_size,
+                                             progress_callback=progress_callback,
+                                             diagnostics=diagnostics, shape_top_n=shape_top_n)
+
+        params = (k, lesion_is_bright, morph_kernel_size, min_lesion_size, cluster_method)
+        self._local.progress_callback = progress_callback
+        self._local.diagnostics = diagnostics
+        try:
+            if coarse_factor:
+                result = self.refine(*params, coarse_factor=coarse_factor, shape_top_n=shape_top_n)
+                self._report('done', 100)
+                result.diagnostics = diagnostics
+                return result
+            # 按流水线顺序逐阶段调用，各阶段的诊断记录互不嵌套
+            self.enhance()
+            self.smooth()
+            if cluster_method == 'histogram':
+                self.histogram()
+            cluster_centers, _ = self.cluster(k, cluster_method)
+            target_cluster, segmented_lut, _ = self.mask(k, lesion_is_bright, cluster_method)
+            _, mask_img, lesion_percentage = self.filter(*params)
+            lesion_table = self.features(*params, shape_top_n)
+            self._report('done', 100)
+        finally:
+            self._local.progress_callback = None
+            self._local.diagnostics = None
+
+        # 高亮图像与分割图像由结果对象按需生成
+        result = AnalysisResult(self.img, mask_img, self.enhance(), segmented_lut, lesion_table,
+                                lesion_percentage, target_cluster, cluster_centers)
+        result.diagnostics = diagnostics
+        return result
+
+
+def summarize_result(k: int, result: AnalysisResult, hist: np.ndarray) -> Dict:
+    """k扫描的单项摘要: 聚类中心、聚类惯性、病灶数量和病灶占比"""
+    return {
+        'k': k,
+        'cluster_centers': np.asarray(result.cluster_centers).tolist(),
+        'inertia': cluster_inertia(hist, result.cluster_centers),
+        'lesion_count': result.lesion_count,
+        'lesion_percentage': float(result.lesion_percentage),
+    }
+
+
+def _warm_start_centers(hist: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """在已有聚类中心基础上，加入加权距离最远的灰度级作为新中心(用于k+1类热启动)"""
+    values = np.arange(256, dtype=np.float64)
+    distances = ((values[:, None] - centers[None, :]) ** 2).min(axis=1)
+    new_center = np.argmax(np.asarray(hist, dtype=np.float64) * distances)
+    return np.sort(np.append(centers, new_center))
+
+
+def warm_up() -> None:
+    """
+    预热: 在小图像上运行一次完整流水线和sklearn KMeans
+
+    完成scikit-learn等的延迟导入、OpenMP/BLAS线程池和OpenCV内部缓冲区的初始化，
+    使首次真实分析不承担这些一次性开销；适合在后台线程中调用。
+    """
+    img = np.tile((np.arange(64, dtype=np.uint16) * 4).astype(np.uint8), (64, 1))
+    analyze_mammo_image(img, k=2, min_lesion_size=0)
+    _cluster_sklearn(img, 2)
 
 
 def analyze_mammo_image(img: np.ndarray, k: int = 3, lesion_is_bright: bool = True, 
                        morph_kernel_size: Tuple[int, int] = (5, 5), 
-                       min_lesion_size: int = 100) -> Dict:
+                       min_lesion_size: int = 100,
+                       cluster_method: str = 'histogram',
+                       tile_size: Optional[int] = None,
+                       progress_callback=None,
+                       diagnostics: Optional[Diagnostics] = None,
+                       shape_top_n: Optional[int] = None,
+                       coarse_factor: Optional[int] = None,
+                       workspace: Optional[AnalysisWorkspace] = None,
+                       crop_foreground: bool = False,
+                       mask_pectoral: bool = False) -> AnalysisResult:
     """
     对输入的乳腺钼靶图像进行分析，识别病灶区域并提供详细特征
     
@@ -20,110 +990,395 @@ def analyze_mammo_image(img: np.ndarray, k: int = 3, lesion_is_bright: bool = Tr
         lesion_is_bright: 病灶是否表现为较亮区域
         morph_kernel_size: 形态学操作核大小
         min_lesion_size: 最小病灶面积过滤阈值(像素)
+        cluster_method: 聚类后端，'histogram'为直方图加权聚类(默认)，
+            'sklearn'为逐像素KMeans参考实现
+        tile_size: 分块边长；指定时使用分块模式(见analyze_mammo_image_tiled)，
+            适用于超过MAX_UNTILED_SIZE的大尺寸图像
+        progress_callback: 可选的进度回调progress_callback(stage, percent)，
+            在阶段之间及逐病灶/逐分块循环中调用；返回True时抛出AnalysisCancelled
+        diagnostics: 可选的diagnostics.Diagnostics对象，记录各阶段耗时、内存峰值和
+            连通域数量，并附加到结果的diagnostics属性；默认不记录
+        shape_top_n: 只为面积最大的前N个病灶计算周长、圆形度和凸包实度(其余为NaN，
+            可用complete_shape_features按需补算)；默认None为全部病灶
+        coarse_factor: 粗到细模式的降采样倍数；指定时先在降采样图像上找出候选区域，
+            只在候选区域内按原分辨率细化(见AnalysisPipeline.refine，忽略tile_size)；
+            降采样预览可用AnalysisPipeline.preview单独获得
+        workspace: 可选的AnalysisWorkspace，连续分析相同尺寸的图像时复用整幅图像大小的
+            中间缓冲区(分块模式不使用)；结果不引用工作区，可安全保留
+        crop_foreground: 先检测乳房区域(皮肤线以内)，只分析其外接矩形(见foreground.foreground_box)；
+            掩码、边界框和质心映射回原图坐标，病灶占比仍按整幅图像面积计算。
+            均衡化和聚类只统计裁剪范围，结果与整幅分析不同
+        mask_pectoral: 与crop_foreground同时使用，检测到的胸大肌区按背景处理(见foreground.pectoral_mask)
     
     返回:
-        dict: 包含分析结果的字典，包括原始图像、分割图像、病灶掩码等
+        AnalysisResult: 分析结果，支持字典式访问原始图像、分割图像、病灶掩码等
+    """
+    # 单次分析；需要反复调整参数时应复用AnalysisPipeline
+    return AnalysisPipeline(img, workspace).run(k, lesion_is_bright, morph_kernel_size, min_lesion_size,
+                                                cluster_method, tile_size, progress_callback, diagnostics,
+                                                shape_top_n, coarse_factor, crop_foreground, mask_pectoral)
+
+
+def _coarse_kernel(morph_kernel_size: Tuple[int, int], sy: float, sx: float) -> Tuple[int, int]:
+    """按降采样比例缩小形态学核(宽, 高)，至少为1"""
+    return (max(1, int(round(morph_kernel_size[0] / sx))),
+            max(1, int(round(morph_kernel_size[1] / sy))))
+
+
+def scale_lesion_table(lesion_table: np.ndarray, sy: float, sx: float) -> np.ndarray:
+    """
+    把降采样图像上的特征表换算到原图坐标
+
+    面积乘以sy*sx，边界框和质心按行/列比例换算(像素中心对齐)，周长和轴长乘以
+    sqrt(sy*sx)；圆形度、离心率和凸包实度与尺度无关，保持不变。
+    """
+    table = lesion_table.copy()
+    scale = np.sqrt(sy * sx)
+    table['area'] = lesion_table['area'] * sy * sx
+    for field in ('perimeter', 'major_axis_length', 'minor_axis_length'):
+        table[field] = lesion_table[field] * scale
+    table['bounding_box'] = np.rint(lesion_table['bounding_box'] * np.array([sy, sx, sy, sx]))
+    table['centroid'] = (lesion_table['centroid'] + 0.5) * np.array([sy, sx]) - 0.5
+    return table
+
+
+def uncrop_result(result: AnalysisResult, img: np.ndarray, box: Tuple[int, int, int, int]) -> AnalysisResult:
+    """
+    把裁剪图像上的分析结果映射回整幅图像img
+
+    掩码放回裁剪框(r0, r1, c0, c1)内，边界框和质心平移到原图坐标，病灶占比按整幅图像
+    面积换算；分割图像由同一查找表作用于整幅原图生成。
+    """
+    r0, r1, c0, c1 = box
+    mask_img = np.zeros(img.shape, dtype=np.uint8)
+    mask_img[r0:r1, c0:c1] = result.mask_img
+    lesion_table = result.lesion_table.copy()
+    lesion_table['bounding_box'] += np.array([r0, c0, r0, c0], dtype=np.int64)
+    lesion_table['centroid'] += np.array([r0, c0], dtype=np.float64)
+    lesion_percentage = result.lesion_percentage * (r1 - r0) * (c1 - c0) / img.size
+    mapped = AnalysisResult(img, mask_img, result.equalize_lut, result.segmented_lut, lesion_table,
+                            lesion_percentage, result.target_cluster, result.cluster_centers)
+    mapped.diagnostics = result.diagnostics
+    return mapped
+
+
+def _merge_boxes(boxes: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    """
+    合并相交的区域(r0, r1, c0, c1)以减少重复计算
+
+    只在外接矩形的面积不超过各区域面积之和时合并，避免分散的小区域连成覆盖大半幅
+    图像的大区域；合并后仍可能相交。
+    """
+    merged = np.zeros((0, 4), dtype=np.int64)
+    for box in np.asarray(boxes, dtype=np.int64).reshape(-1, 4):
+        while len(merged):
+            overlap = ((merged[:, 0] < box[1]) & (box[0] < merged[:, 1]) &
+                       (merged[:, 2] < box[3]) & (box[2] < merged[:, 3]))
+            if not overlap.any():
+                break
+            group = np.vstack([merged[overlap], box])
+            union = np.array([group[:, 0].min(), group[:, 1].max(), group[:, 2].min(), group[:, 3].max()])
+            area = ((group[:, 1] - group[:, 0]) * (group[:, 3] - group[:, 2])).sum()
+            if (union[1] - union[0]) * (union[3] - union[2]) > area:
+                break
+            # 合并后的区域变大，可能与其他区域新产生相交，继续检查
+            box, merged = union, merged[~overlap]
+        merged = np.vstack([merged, box])
+    return [tuple(int(v) for v in box) for box in merged]
+
+
+def default_tile_size(shape: Tuple[int, ...]) -> Optional[int]:
+    """边长超过MAX_UNTILED_SIZE的图像返回默认分块大小，否则返回None(整图模式)"""
+    return DEFAULT_TILE_SIZE if max(shape[:2]) > MAX_UNTILED_SIZE else None
+
+
+def _iter_tiles(shape: Tuple[int, int], tile_size: int, halo: int):
+    """按行优先顺序遍历分块，返回(核心区域, 含邻域的窗口区域)，均为(r0, r1, c0, c1)"""
+    height, width = shape
+    for r0 in range(0, height, tile_size):
+        r1 = min(r0 + tile_size, height)
+        for c0 in range(0, width, tile_size):
+            c1 = min(c0 + tile_size, width)
+            window = (max(0, r0 - halo), min(height, r1 + halo),
+                      max(0, c0 - halo), min(width, c1 + halo))
+            yield (r0, r1, c0, c1), window
+
+
+def _smooth_window(img: np.ndarray, window: Tuple[int, int, int, int],
+                   equalize_lut: np.ndarray) -> np.ndarray:
+    """对窗口区域做直方图均衡(全局查找表)和高斯滤波"""
+    wr0, wr1, wc0, wc1 = window
+    img_enhanced = cv2.LUT(np.ascontiguousarray(img[wr0:wr1, wc0:wc1]), equalize_lut)
+    return cv2.GaussianBlur(img_enhanced, _BLUR_KSIZE, 0)
+
+
+def _crop_core(arr: np.ndarray, core: Tuple[int, int, int, int],
+               window: Tuple[int, int, int, int]) -> np.ndarray:
+    """从窗口结果中裁出核心区域"""
+    r0, r1, c0, c1 = core
+    wr0, _, wc0, _ = window
+    return arr[r0 - wr0:r1 - wr0, c0 - wc0:c1 - wc0]
+
+
+def _find_root(parent: List[int], i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _union_border(parent: List[int], labels_a: np.ndarray, labels_b: np.ndarray) -> None:
+    """合并分块边界两侧相邻的前景连通域"""
+    both = (labels_a > 0) & (labels_b > 0)
+    if not both.any():
+        return
+    for a, b in set(zip(labels_a[both].tolist(), labels_b[both].tolist())):
+        root_a, root_b = _find_root(parent, a), _find_root(parent, b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def analyze_mammo_image_tiled(img: np.ndarray, k: int = 3, lesion_is_bright: bool = True,
+                              morph_kernel_size: Tuple[int, int] = (5, 5),
+                              min_lesion_size: int = 100,
+                              tile_size: int = DEFAULT_TILE_SIZE,
+                              mask_out: Optional[np.ndarray] = None,
+                              progress_callback=None,
+                              diagnostics: Optional[Diagnostics] = None,
+                              shape_top_n: Optional[int] = None) -> AnalysisResult:
+    """
+    分块模式分析大尺寸乳腺钼靶图像，结果与analyze_mammo_image一致
+
+    先流式统计原图直方图得到均衡化查找表，再统计平滑图像直方图得到聚类中心；
+    之后逐块(带邻域重叠)完成均衡化、滤波、形态学和连通域标记，跨块的连通域
+    通过并查集拼接为完整病灶。工作内存只与分块大小有关。
+
+    参数:
+        img: 灰度图像，可以是numpy数组或np.memmap等支持切片的数组
+        k, lesion_is_bright, morph_kernel_size, min_lesion_size: 同analyze_mammo_image
+        tile_size: 分块边长(像素)
+        mask_out: 可选的预分配掩码输出数组(如np.memmap)，默认新建
+        progress_callback: 进度/取消回调，同analyze_mammo_image
+        diagnostics: 可选的诊断记录对象，同analyze_mammo_image
+        shape_top_n: 计算形态特征的病灶数，同analyze_mammo_image
+
+    返回:
+        AnalysisResult: 与analyze_mammo_image相同的结果
     """
-    # 验证输入
     if img is None or len(img.shape) != 2:
         raise ValueError("输入图像应为灰度图像")
-    
-    # 图像预处理
-    img_enhanced = cv2.equalizeHist(img)
-    
-    # 高斯滤波减少噪声
-    img_smooth = cv2.GaussianBlur(img_enhanced, (5, 5), 0)
-    
-    # K-Means聚类分割
-    pixel_values = img_smooth.reshape((-1, 1)).astype(np.float32)
-    kmeans = KMeans(n_clusters=k, random_state=42, n_init='auto')
-    labels = kmeans.fit_predict(pixel_values)
-    centers = np.uint8(kmeans.cluster_centers_)
-    
-    # 重构聚类图像
-    segmented_img = centers[labels.flatten()].reshape(img.shape)
-    
-    # 识别病灶聚类
-    target_cluster = np.argmax(centers) if lesion_is_bright else np.argmin(centers)
-    mask_img = (labels.reshape(img.shape) == target_cluster).astype(np.uint8) * 255
-    
-    # 形态学操作优化掩码
+    if tile_size <= 0:
+        raise ValueError("分块大小必须为正数")
+    height, width = img.shape
+    shape = (height, width)
+
+    # 形态学闭运算+开运算共4次腐蚀/膨胀，每次影响半径为核大小的一半
+    morph_halo = _BLUR_HALO + 4 * (max(morph_kernel_size) // 2)
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, morph_kernel_size)
-    mask_img = cv2.morphologyEx(mask_img, cv2.MORPH_CLOSE, kernel)
-    mask_img = cv2.morphologyEx(mask_img, cv2.MORPH_OPEN, kernel)
-    
-    # 移除小面积噪声区域
-    labeled_mask, num_features = ndimage.label(mask_img)
-    sizes = ndimage.sum(mask_img, labeled_mask, range(num_features + 1))
-    mask_size = mask_img.shape[0] * mask_img.shape[1]
-    
-    # 过滤小区域和过大区域
-    for i in range(num_features + 1):
-        if sizes[i] < min_lesion_size or sizes[i] > 0.8 * mask_size:
-            mask_img[labeled_mask == i] = 0
-    
-    # 计算病灶区域占比
-    lesion_percentage = np.sum(mask_img > 0) / mask_img.size * 100
-    
-    # 高亮病灶区域
-    highlighted_img = img.copy()
-    highlighted_img[mask_img > 0] = 255
-    
-    # 病灶特征提取
-    lesion_features = extract_lesion_features(mask_img)
-    
-    return {
-        'original_img': img,
-        'segmented_img': segmented_img,
-        'mask_img': mask_img,
-        'highlighted_img': highlighted_img,
-        'lesion_percentage': lesion_percentage,
-        'target_cluster': target_cluster,
-        'lesion_count': len(lesion_features),
-        'lesion_features': lesion_features
-    }
 
+    # 第一遍: 原图直方图 -> 全局均衡化查找表
+    n_tiles = -(-height // tile_size) * -(-width // tile_size)
 
-def extract_lesion_features(mask_img: np.ndarray) -> List[Dict]:
-    """提取病灶区域的形态学特征"""
-    labeled_mask, num_labels = ndimage.label(mask_img)
-    regions = measure.regionprops(labeled_mask)
-    
-    features = []
-    for region in regions:
-        # 计算基本特征
-        area = region.area
-        perimeter = region.perimeter
-        circularity = 4 * np.pi * area / (perimeter ** 2) if perimeter > 0 else 0
-        major_axis = region.major_axis_length
-        minor_axis = region.minor_axis_length
-        eccentricity = region.eccentricity
-        solidity = region.solidity
-        
-        # 计算边界框和中心
-        min_row, min_col, max_row, max_col = region.bbox
-        centroid = (region.centroid[0], region.centroid[1])
-        
-        features.append({
-            'area': area,
-            'perimeter': perimeter,
-            'circularity': circularity,
-            'major_axis_length': major_axis,
-            'minor_axis_length': minor_axis,
-            'eccentricity': eccentricity,
-            'solidity': solidity,
-            'bounding_box': (min_row, min_col, max_row, max_col),
-            'centroid': centroid
-        })
-    
-    # 按面积降序排序
-    features.sort(key=lambda x: x['area'], reverse=True)
-    return features
+    def report(stage, start, end, i):
+        _report_progress(progress_callback, stage, start + (end - start) * i / n_tiles)
+
+    def next_stage(name, **counts):
+        if diagnostics is not None:
+            diagnostics.switch(name, **counts)
+
+    next_stage('enhance', tiles=n_tiles)
+    hist = np.zeros(256, dtype=np.int64)
+    for i, ((r0, r1, c0, c1), _) in enumerate(_iter_tiles(shape, tile_size, 0)):
+        report('enhance', 0, 10, i)
+        hist += np.bincount(np.asarray(img[r0:r1, c0:c1]).ravel(), minlength=256)
+    equalize_lut = equalize_hist_lut(hist)
+
+    # 第二遍: 平滑图像直方图 -> 全局聚类中心
+    next_stage('histogram')
+    hist_smooth = np.zeros(256, dtype=np.int64)
+    for i, (core, window) in enumerate(_iter_tiles(shape, tile_size, _BLUR_HALO)):
+        report('histogram', 10, 25, i)
+        img_smooth = _crop_core(_smooth_window(img, window, equalize_lut), core, window)
+        hist_smooth += np.bincount(img_smooth.ravel(), minlength=256)
+    next_stage('cluster')
+    cluster_centers, target_cluster, segmented_lut, mask_lut = _histogram_cluster_luts(
+        hist_smooth, k, lesion_is_bright)
+
+    mask_img = mask_out if mask_out is not None else np.zeros(shape, dtype=np.uint8)
+
+    # 第三遍: 逐块掩码、形态学和连通域标记，并查集拼接跨块连通域
+    next_stage('morphology')
+    parent = [0]
+    tile_moments, seeds = [], []
+    tile_offsets = {}
+    bottom_labels = np.zeros(width, dtype=np.int64)
+    prev_bottom = bottom_labels.copy()
+    right_labels = None
+    for i, (core, window) in enumerate(_iter_tiles(shape, tile_size, morph_halo)):
+        report('morphology', 25, 60, i)
+        r0, r1, c0, c1 = core
+        if c0 == 0:
+            prev_bottom, bottom_labels = bottom_labels, np.zeros(width, dtype=np.int64)
+            right_labels = None
+
+        img_smooth = _smooth_window(img, window, equalize_lut)
+        tile_mask = cv2.LUT(img_smooth, mask_lut)
+        tile_mask = cv2.morphologyEx(tile_mask, cv2.MORPH_CLOSE, kernel)
+        tile_mask = cv2.morphologyEx(tile_mask, cv2.MORPH_OPEN, kernel)
+        tile_mask = _crop_core(tile_mask, core, window)
+        mask_img[r0:r1, c0:c1] = tile_mask
+
+        local_labels, num_local = ndimage.label(tile_mask)
+        offset = len(parent) - 1
+        tile_offsets[(r0, c0)] = offset
+        parent.extend(range(offset + 1, offset + num_local + 1))
+        global_labels = np.where(local_labels > 0, local_labels.astype(np.int64) + offset, 0)
+
+        if num_local:
+            tile_moments.append(component_moments(local_labels, num_local, offset=(r0, c0)))
+            # 每个连通域在块内按行优先的首个像素，其全局行优先序号用于恢复整图标记顺序
+            flat = local_labels.ravel()
+            foreground = np.flatnonzero(flat)
+            _, first = np.unique(flat[foreground], return_index=True)
+            first = foreground[first]
+            seeds.append((first // (c1 - c0) + r0) * width + first % (c1 - c0) + c0)
+
+        if r0 > 0:
+            _union_border(parent, global_labels[0], prev_bottom[c0:c1])
+        if right_labels is not None:
+            _union_border(parent, global_labels[:, 0], right_labels)
+        bottom_labels[c0:c1] = global_labels[-1]
+        right_labels = global_labels[:, -1]
+
+    # 汇总跨块连通域的面积、边界框、矩和首像素
+    next_stage('filter', components=len(parent) - 1)
+    num_labels = len(parent)
+    roots = np.array([_find_root(parent, i) for i in range(num_labels)], dtype=np.int64)
+    member_roots = roots[1:]
+    empty = [np.zeros(0, dtype=np.int64)]
+    fragments = {key: np.concatenate([m[key] for m in tile_moments] or empty)
+                 for key in BOUND_KEYS + MOMENT_KEYS}
+    moments = merge_moments(fragments, member_roots, num_labels)
+    sizes = moments['count'].astype(np.int64)
+    root_seeds = np.full(num_labels, height * width, dtype=np.int64)
+    np.minimum.at(root_seeds, member_roots, np.concatenate(seeds or empty))
+
+    # 与整图模式相同的过滤口径(按掩码值255累加)
+    mask_size = height * width
+    keep_root = (sizes * 255 >= min_lesion_size) & (sizes * 255 <= 0.8 * mask_size)
+    keep_root[0] = False
+    keep_label = keep_root[roots]
+
+    # 第四遍: 按保留表清除被过滤的连通域
+    for i, ((r0, r1, c0, c1), _) in enumerate(_iter_tiles(shape, tile_size, 0)):
+        report('filter', 60, 70, i)
+        tile_mask = mask_img[r0:r1, c0:c1]
+        local_labels, num_local = ndimage.label(tile_mask)
+        offset = tile_offsets[(r0, c0)]
+        keep_lut = np.zeros(num_local + 1, dtype=np.uint8)
+        keep_lut[1:] = keep_label[offset + 1:offset + num_local + 1] * 255
+        mask_img[r0:r1, c0:c1] = keep_lut[local_labels]
+
+    # 特征表按整图标记顺序排列后按面积降序，与整图模式一致
+    kept = np.flatnonzero(keep_root)
+    kept = kept[np.argsort(root_seeds[kept])] if kept.size else kept
+    lesion_table = table_from_moments({key: value[kept] for key, value in moments.items()})
+    order = np.argsort(-lesion_table['area'], kind='stable')
+    lesion_table, kept = lesion_table[order], kept[order]
+
+    # 形态特征在病灶边界框窗口内重新标记，以首像素确定病灶
+    count = len(kept) if shape_top_n is None else min(shape_top_n, len(kept))
+    next_stage('features', regions=count)
+
+    def region_image(row):
+        min_row, min_col, max_row, max_col = lesion_table['bounding_box'][row]
+        window_labels, _ = ndimage.label(np.asarray(mask_img[min_row:max_row, min_col:max_col]))
+        seed_row, seed_col = divmod(int(root_seeds[kept[row]]), width)
+        return window_labels == window_labels[seed_row - min_row, seed_col - min_col]
+
+    def progress(i, total):
+        if i % _PROGRESS_INTERVAL == 0:
+            _report_progress(progress_callback, 'features', 70 + 30 * i / total)
+
+    fill_shape_features(lesion_table, region_image, range(count), progress)
+    next_stage(None)
+    _report_progress(progress_callback, 'done', 100)
+
+    lesion_percentage = int(sizes[keep_root].sum()) / mask_size * 100
+
+    result = AnalysisResult(img, mask_img, equalize_lut, segmented_lut, lesion_table,
+                            lesion_percentage, target_cluster, cluster_centers)
+    result.diagnostics = diagnostics
+    return result
+
+
+def extract_lesion_table(mask_img: np.ndarray, labeled_mask: Optional[np.ndarray] = None,
+                         shape_top_n: Optional[int] = None, progress_callback=None) -> np.ndarray:
+    """
+    提取全部连通域的特征表(结构化数组，按面积降序)
+
+    参数:
+        mask_img: 病灶掩码
+        labeled_mask: 可选的已有连通域标记图，避免重复标记
+        shape_top_n: 只为前N个病灶计算周长、圆形度和凸包实度，默认全部
+        progress_callback: 进度/取消回调，同analyze_mammo_image
+    """
+    if labeled_mask is None:
+        labeled_mask, num_labels = ndimage.label(mask_img)
+    else:
+        num_labels = int(labeled_mask.max())
+    table = component_table(labeled_mask, num_labels)
+    order = np.argsort(-table['area'], kind='stable')
+    table, labels = table[order], order + 1
+
+    def region_image(row):
+        min_row, min_col, max_row, max_col = table['bounding_box'][row]
+        return labeled_mask[min_row:max_row, min_col:max_col] == labels[row]
+
+    def progress(i, total):
+        if i % _PROGRESS_INTERVAL == 0:
+            _report_progress(progress_callback, 'features', 70 + 30 * i / total)
+
+    count = len(table) if shape_top_n is None else min(shape_top_n, len(table))
+    fill_shape_features(table, region_image, range(count), progress)
+    return table
+
+
+def extract_lesion_features(mask_img: np.ndarray, labeled_mask: Optional[np.ndarray] = None,
+                            progress_callback=None) -> List[Dict]:
+    """提取病灶区域的形态学特征，可传入已有的连通域标记图以避免重复标记"""
+    return lesion_table_to_features(extract_lesion_table(mask_img, labeled_mask,
+                                                         progress_callback=progress_callback))
+
+
+def complete_shape_features(result: AnalysisResult, indices=None) -> int:
+    """
+    按需为结果中的病灶补算周长、圆形度和凸包实度(原地填入result.lesion_table)
+
+    参数:
+        result: 分析结果
+        indices: 病灶序号(按面积降序)，默认全部
+
+    返回:
+        新计算的病灶数
+    """
+    table = result.lesion_table
+    width = result.shape[1]
+
+    def region_image(row):
+        # 只解压病灶边界框所在的行
+        min_row, min_col, max_row, max_col = table['bounding_box'][row]
+        window = unpack_mask(result.mask_bits[min_row:max_row], width)[:, min_col:max_col]
+        return mask_region_image(window, table['area'][row])
+
+    return fill_shape_features(table, region_image, indices)
 
 
-def save_lesion_features(lesion_features: List[Dict], save_dir: str) -> None:
-    """将病灶特征保存为CSV文件"""
-    if not lesion_features:
+def save_lesion_features(lesion_table, save_dir: str) -> None:
+    """将病灶特征表(或特征字典列表)保存为CSV文件，未计算的形态特征留空"""
+    if not isinstance(lesion_table, np.ndarray):
+        lesion_table = lesion_table_from_features(lesion_table)
+    if not len(lesion_table):
         return
     
     csv_path = os.path.join(save_dir, "lesion_features.csv")
@@ -131,7 +1386,7 @@ def save_lesion_features(lesion_features: List[Dict], save_dir: str) -> None:
                   'minor_axis_length', 'eccentricity', 'solidity']
     
     with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for lesion in lesion_features:
-            writer.writerow({k: lesion[k] for k in fieldnames if k in lesion})
\ No newline at end of file
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        for row in zip(*(lesion_table[name].tolist() for name in fieldnames)):
+            writer.writerow(['' if value != value else value for value in row])
@@ -0,0 +1,186 @@
+"""
+乳腺钼靶分析结果对象
+
+只保存紧凑数据：原始图像按引用保存，病灶掩码按位压缩，病灶特征为列式结构化数组；
+分割图像和高亮图像由查找表按需生成。对象同时保留字典式访问，兼容原有代码。
+"""
+from collections.abc import Mapping
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+
+# 病灶特征列式存储格式，字段与extract_lesion_features返回的字典一致
+LESION_DTYPE = np.dtype([
+    ('area', np.float64),
+    ('perimeter', np.float64),
+    ('circularity', np.float64),
+    ('major_axis_length', np.float64),
+    ('minor_axis_length', np.float64),
+    ('eccentricity', np.float64),
+    ('solidity', np.float64),
+    ('bounding_box', np.int64, (4,)),
+    ('centroid', np.float64, (2,)),
+])
+
+# 按行分段压缩掩码，避免为np.memmap等大尺寸掩码创建整幅布尔临时数组
+_PACK_BAND_ROWS = 1024
+
+
+def lesion_row(lesion: Dict) -> tuple:
+    """将单个病灶特征字典转换为LESION_DTYPE的一行"""
+    return tuple(lesion[name] for name in LESION_DTYPE.names)
+
+
+def lesion_table_from_features(lesion_features: List[Dict]) -> np.ndarray:
+    """将病灶特征字典列表转换为结构化数组"""
+    return np.array([lesion_row(lesion) for lesion in lesion_features], dtype=LESION_DTYPE)
+
+
+def lesion_table_to_features(table: np.ndarray) -> List[Dict]:
+    """将结构化数组还原为病灶特征字典列表"""
+    features = []
+    for row in table:
+        lesion = {name: row[name] for name in LESION_DTYPE.names[:-2]}
+        lesion['bounding_box'] = tuple(int(v) for v in row['bounding_box'])
+        lesion['centroid'] = (row['centroid'][0], row['centroid'][1])
+        features.append(lesion)
+    return features
+
+
+def pack_mask(mask_img: np.ndarray) -> np.ndarray:
+    """将0/255掩码按行位压缩为(高, ceil(宽/8))的uint8数组"""
+    height, width = mask_img.shape
+    packed = np.empty((height, (width + 7) // 8), dtype=np.uint8)
+    for r0 in range(0, height, _PACK_BAND_ROWS):
+        r1 = min(r0 + _PACK_BAND_ROWS, height)
+        packed[r0:r1] = np.packbits(np.asarray(mask_img[r0:r1]) > 0, axis=1)
+    return packed
+
+
+def unpack_mask(packed: np.ndarray, width: int) -> np.ndarray:
+    """还原位压缩掩码为0/255的uint8图像"""
+    return np.unpackbits(packed, axis=1, count=width) * np.uint8(255)
+
+
+class AnalysisResult(Mapping):
+    """
+    紧凑的分析结果
+
+    属性:
+        original_img: 原始灰度图像(引用，不复制)
+        mask_bits: 位压缩的病灶掩码
+        equalize_lut: 直方图均衡化查找表
+        segmented_lut: 平滑灰度值到聚类中心灰度的查找表
+        lesion_table: 病灶特征结构化数组(LESION_DTYPE)，按面积降序
+        diagnostics: 分析过程的逐阶段诊断记录(diagnostics.Diagnostics)，未启用时为None
+    """
+
+    __slots__ = ('original_img', 'shape', 'mask_bits', 'equalize_lut', 'segmented_lut',
+                 'lesion_table', 'lesion_percentage', 'target_cluster', 'cluster_centers',
+                 'diagnostics')
+
+    KEYS = ('original_img', 'segmented_img', 'mask_img', 'highlighted_img',
+            'lesion_percentage', 'target_cluster', 'cluster_centers',
+            'lesion_count', 'lesion_features')
+
+    def __init__(self, original_img, mask_img, equalize_lut, segmented_lut, lesion_table,
+                 lesion_percentage, target_cluster, cluster_centers):
+        self.original_img = original_img
+        self.shape = tuple(mask_img.shape)
+        self.mask_bits = pack_mask(mask_img)
+        self.equalize_lut = equalize_lut
+        self.segmented_lut = segmented_lut
+        self.lesion_table = lesion_table
+        self.lesion_percentage = lesion_percentage
+        self.target_cluster = target_cluster
+        self.cluster_centers = cluster_centers
+        self.diagnostics = None
+
+    @property
+    def mask_img(self) -> np.ndarray:
+        """病灶掩码(0/255)，每次访问解压生成"""
+        return unpack_mask(self.mask_bits, self.shape[1])
+
+    @property
+    def segmented_img(self) -> np.ndarray:
+        """聚类分割图像，由原图经均衡化、高斯滤波和分割查找表按需生成"""
+        img_enhanced = cv2.LUT(np.ascontiguousarray(self.original_img), self.equalize_lut)
+        img_smooth = cv2.GaussianBlur(img_enhanced, (5, 5), 0)
+        return cv2.LUT(img_smooth, self.segmented_lut)
+
+    @property
+    def highlighted_img(self) -> np.ndarray:
+        """病灶区域置为255的高亮图像，按需生成"""
+        highlighted_img = np.array(self.original_img)
+        highlighted_img[self.mask_img > 0] = 255
+        return highlighted_img
+
+    @property
+    def lesion_count(self) -> int:
+        return len(self.lesion_table)
+
+    @property
+    def lesion_features(self) -> List[Dict]:
+        """病灶特征字典列表(兼容旧接口)，每次访问由列式数组生成"""
+        return lesion_table_to_features(self.lesion_table)
+
+    @property
+    def nbytes(self) -> int:
+        """结果对象自身持有的数组字节数(不含按引用保存的原始图像)"""
+        return (self.mask_bits.nbytes + self.equalize_lut.nbytes + self.segmented_lut.nbytes
+                + self.lesion_table.nbytes + np.asarray(self.cluster_centers).nbytes)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """导出可用np.savez保存的紧凑数组(不含原始图像)"""
+        return {
+            'shape': np.asarray(self.shape, dtype=np.int64),
+            'mask_bits': self.mask_bits,
+            'equalize_lut': self.equalize_lut,
+            'segmented_lut': self.segmented_lut,
+            'lesion_table': self.lesion_table,
+            'lesion_percentage': np.float64(self.lesion_percentage),
+            'target_cluster': np.int64(self.target_cluster),
+            'cluster_centers': np.asarray(self.cluster_centers, dtype=np.float64),
+        }
+
+    @classmethod
+    def from_arrays(cls, original_img, arrays) -> 'AnalysisResult':
+        """由to_arrays导出的数组重建结果对象，原始图像按引用传入"""
+        result = cls.__new__(cls)
+        result.original_img = original_img
+        result.shape = tuple(int(v) for v in arrays['shape'])
+        result.mask_bits = np.asarray(arrays['mask_bits'])
+        result.equalize_lut = np.asarray(arrays['equalize_lut'])
+        result.segmented_lut = np.asarray(arrays['segmented_lut'])
+        result.lesion_table = np.asarray(arrays['lesion_table'])
+        result.lesion_percentage = np.float64(arrays['lesion_percentage'])
+        result.target_cluster = np.int64(arrays['target_cluster'])
+        result.cluster_centers = np.asarray(arrays['cluster_centers'])
+        result.diagnostics = None
+        return result
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        # 只检查键名，不生成对应的整幅图像
+        return key in self.KEYS
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def to_dict(self) -> Dict:
+        """生成包含全部完整图像的普通字典"""
+        return {key: self[key] for key in self.KEYS}
+
+    def __repr__(self):
+        height, width = self.shape
+        return (f"AnalysisResult({width}x{height}, lesion_count={self.lesion_count}, "
+                f"lesion_percentage={self.lesion_percentage:.2f}%, nbytes={self.nbytes})")
@@ -0,0 +1,506 @@
+"""
+本地分析服务(HTTP)
+
+供阅片工作站和PACS网关在本机调用分析，无需启动界面。基于asyncio的HTTP/1.1服务:
+上传的图像进入有界队列，由固定数量的分析进程处理(每个进程同一时刻分析一张)；
+排队的请求已达上限时立即返回429，客户端按Retry-After稍后重试。
+
+接口:
+    POST /analyze  请求体为PNG/JPEG/DICOM文件内容，查询参数为分析参数(k、lesion_is_bright、
+                   morph_kernel_size、min_lesion_size、cluster_method、crop_foreground、
+                   mask_pectoral)。默认返回JSON: 病灶特征和按行位压缩的病灶掩码(base64)；
+                   format=bundle时返回结果包(.mammo，见export.py)的文件内容
+    GET /metrics   队列深度、运行中的请求数、请求计数和延迟分位数(JSON)
+    GET /health    服务状态(JSON)
+
+用法示例:
+    python service.py --port 8765 --workers 4 --queue-size 16
+    curl --data-binary @film.png "http://127.0.0.1:8765/analyze?k=3&min_lesion_size=100"
+    python loadgen.py --spawn --requests 200 --concurrency 8
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing as mp
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# 排队等待分析的请求数上限(不含正在分析的请求)
+DEFAULT_QUEUE_SIZE = 16
+# 上传文件大小上限(字节)
+MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+# 延迟分位数按最近完成的多少个请求统计
+LATENCY_WINDOW = 1000
+# 返回429时建议的重试间隔(秒)
+RETRY_AFTER = 1
+
+RESPONSE_FORMATS = ('json', 'bundle')
+# 查询参数 -> 类型
+_INT_PARAMS = ('k', 'min_lesion_size', 'morph_kernel_size')
+_BOOL_PARAMS = ('lesion_is_bright', 'crop_foreground', 'mask_pectoral')
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               411: 'Length Required', 413: 'Payload Too Large', 429: 'Too Many Requests',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# 分析进程状态: 结果缓存与分析工作区(同尺寸图像连续分析时复用缓冲区)
+_worker_cache = None
+_worker_workspace = None
+
+
+def _parse_bool(value: str) -> bool:
+    lowered = value.strip().lower()
+    if lowered in ('1', 'true', 'yes', 'on'):
+        return True
+    if lowered in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f"无效的布尔值: {value}")
+
+
+def parse_params(query: str) -> Tuple[Dict, str]:
+    """
+    解析/analyze的查询字符串
+
+    返回:
+        (params, fmt): 传给processing.analyze_mammo_image的参数，以及响应格式；
+        参数无效时抛出ValueError
+    """
+    import cache
+
+    fields = {key: values[-1] for key, values in parse_qs(query, keep_blank_values=True).items()}
+    fmt = fields.pop('format', 'json')
+    if fmt not in RESPONSE_FORMATS:
+        raise ValueError(f"未知的响应格式: {fmt}")
+    params = {}
+    for key, value in fields.items():
+        if key not in _INT_PARAMS + _BOOL_PARAMS + ('cluster_method',):
+            raise ValueError(f"未知的分析参数: {key}")
+        try:
+            if key in _INT_PARAMS:
+                params[key] = int(value)
+            elif key in _BOOL_PARAMS:
+                params[key] = _parse_bool(value)
+            else:
+                params[key] = value
+        except ValueError as e:
+            raise ValueError(f"参数 {key} 无效: {e}")
+    if 'morph_kernel_size' in params:
+        params['morph_kernel_size'] = (params['morph_kernel_size'],) * 2
+    if params.get('mask_pectoral') and not params.get('crop_foreground'):
+        raise ValueError("mask_pectoral 需与 crop_foreground 同时使用")
+    cache.normalize_params(params)
+    return params, fmt
+
+
+def result_json(result, image_digest: str, params: Dict) -> Dict:
+    """
+    分析结果的JSON表示
+
+    mask为按行位压缩(np.packbits(mask > 0, axis=1))的病灶掩码，data为其base64编码，
+    可用decode_mask还原
+    """
+    import batch
+    import cache
+    import processing
+
+    height, width = result.shape
+    return {
+        'image_digest': image_digest,
+        'width': width,
+        'height': height,
+        'pipeline_version': processing.PIPELINE_VERSION,
+        'params': cache.normalize_params(params),
+        'lesion_percentage': float(result['lesion_percentage']),
+        'lesion_count': int(result['lesion_count']),
+        'lesions': [batch.lesion_to_row(lesion) for lesion in result['lesion_features']],
+        'mask': {
+            'shape': [height, width],
+            'encoding': 'packbits',
+            'data': base64.b64encode(result.mask_bits.tobytes()).decode('ascii'),
+        },
+    }
+
+
+def decode_mask(mask: Dict):
+    """由result_json中的mask还原病灶掩码(0/255, uint8)"""
+    import numpy as np
+    from result import unpack_mask
+
+    height, width = mask['shape']
+    bits = np.frombuffer(base64.b64decode(mask['data']), dtype=np.uint8).reshape(height, -1)
+    return unpack_mask(bits, width)
+
+
+def _init_worker(threads: int, cache_dir: Optional[str]) -> None:
+    """分析进程初始化: 限制线程数、打开结果缓存、创建工作区并预热流水线"""
+    global _worker_cache, _worker_workspace
+    import batch
+
+    # 线程数环境变量在BLAS/OpenMP库加载时读取，须在导入分析模块之前设置
+    batch.limit_threads(threads)
+    import processing
+
+    if cache_dir is not None:
+        import cache
+        _worker_cache = cache.AnalysisCache(cache_dir)
+    _worker_workspace = processing.AnalysisWorkspace()
+    processing.warm_up()
+
+
+def _worker_pid() -> int:
+    # 短暂占用进程，使启动时的各个任务分散到不同进程
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def analyze_upload(data: bytes, params: Dict, fmt: str = 'json') -> Tuple[bytes, str, float]:
+    """
+    在分析进程中解码并分析上传的图像
+
+    返回:
+        (body, content_type, seconds): 响应内容、类型和分析耗时(含解码)；
+        图像无法解码或参数无效时抛出ValueError
+    """
+    import cache
+    import export
+    import processing
+    import utils
+
+    start = time.perf_counter()
+    img = utils.decode_image(data)
+    digest = cache.image_digest(img)
+    tile_size = processing.default_tile_size(img.shape)
+    if _worker_cache is not None:
+        result = _worker_cache.analyze(img, digest, _worker_workspace, tile_size=tile_size, **params)
+    else:
+        result = processing.analyze_mammo_image(img, tile_size=tile_size, workspace=_worker_workspace,
+                                                **params)
+    # 缓存的结果可能只含前几个病灶的形态特征，输出前补算
+    processing.complete_shape_features(result)
+    if fmt == 'bundle':
+        body = export.bundle_bytes(result, params=cache.normalize_params(params), image_digest=digest)
+        content_type = 'application/octet-stream'
+    else:
+        body = json.dumps(result_json(result, digest, params), ensure_ascii=False).encode('utf-8')
+        content_type = 'application/json; charset=utf-8'
+    return body, content_type, time.perf_counter() - start
+
+
+def latency_percentiles(samples: Iterable[float]) -> Dict:
+    """耗时样本(秒)的p50/p90/p99和最大值(毫秒，最近秩法)"""
+    ordered = sorted(samples)
+    stats = {'samples': len(ordered)}
+    for name, q in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+        stats[name] = ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000 if ordered else None
+    stats['max_ms'] = ordered[-1] * 1000 if ordered else None
+    return stats
+
+
+class ServiceMetrics:
+    """请求计数和最近LATENCY_WINDOW个完成请求的耗时(总计、排队、分析)"""
+
+    COUNTERS = ('accepted', 'rejected', 'completed', 'failed')
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.started = time.time()
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.running = 0
+        self.total = deque(maxlen=window)
+        self.wait = deque(maxlen=window)
+        self.analysis = deque(maxlen=window)
+
+    def record(self, total: float, wait: float, analysis: float) -> None:
+        self.total.append(total)
+        self.wait.append(wait)
+        self.analysis.append(analysis)
+
+    def snapshot(self, queue_depth: int, queue_size: int, workers: int) -> Dict:
+        return {
+            'uptime_s': round(time.time() - self.started, 3),
+            'workers': workers,
+            'queue_size': queue_size,
+            'queue_depth': queue_depth,
+            'running': self.running,
+            **self.counts,
+            'latency': {
+                'total': latency_percentiles(self.total),
+                'queue_wait': latency_percentiles(self.wait),
+                'analysis': latency_percentiles(self.analysis),
+            },
+        }
+
+
+class _Job:
+    __slots__ = ('data', 'params', 'fmt', 'future', 'queued', 'started')
+
+    def __init__(self, data, params, fmt, future):
+        self.data = data
+        self.params = params
+        self.fmt = fmt
+        self.future = future
+        self.queued = time.perf_counter()
+        self.started = None
+
+
+class AnalysisService:
+    """
+    分析服务: 有界请求队列 + 固定数量的分析进程
+
+    参数:
+        workers: 分析进程数(同时分析的请求数上限)，默认CPU核心数
+        queue_size: 排队请求数上限，超出时返回429
+        threads_per_worker: 每个分析进程内的线程数上限
+        cache_dir: 结果缓存目录，None表示不使用缓存
+        max_upload: 上传文件大小上限(字节)
+    """
+
+    def __init__(self, workers: Optional[int] = None, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 threads_per_worker: int = 1, cache_dir: Optional[str] = None,
+                 max_upload: int = MAX_UPLOAD_BYTES):
+        if queue_size < 1:
+            raise ValueError("队列上限应不小于1")
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.threads_per_worker = threads_per_worker
+        self.cache_dir = cache_dir
+        self.max_upload = max_upload
+        self.metrics = ServiceMetrics()
+        self._queue = None
+        self._executor = None
+        self._dispatchers = []
+        self._server = None
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn 保证子进程在导入 numpy/cv2 之前完成线程数限制
+        return ProcessPoolExecutor(self.workers, mp_context=mp.get_context('spawn'),
+                                   initializer=_init_worker,
+                                   initargs=(self.threads_per_worker, self.cache_dir))
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        """启动分析进程(全部预热完成后)并开始监听，返回asyncio服务器对象"""
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.queue_size)
+        self._executor = self._new_executor()
+        # 反复提交与进程数相同的空任务，直到全部进程都完成启动和预热后才接受请求
+        pids = set()
+        while len(pids) < self.workers:
+            pids.update(await asyncio.gather(*(loop.run_in_executor(self._executor, _worker_pid)
+                                               for _ in range(self.workers))))
+        self._dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    async def serve_forever(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        server = await self.start(host, port)
+        address = server.sockets[0].getsockname()
+        print(f"分析服务已启动: http://{address[0]}:{address[1]} "
+              f"({self.workers} 个分析进程, 队列上限 {self.queue_size})", file=sys.stderr)
+        # SIGTERM时关闭监听并停止分析进程池，避免留下孤立的分析进程(Windows不支持，仍由Ctrl+C停止)
+        stopped = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+        try:
+            await stopped.wait()
+        finally:
+            await self.close()
+
+    async def _dispatch(self) -> None:
+        """从队列取出请求交给分析进程；每个分发协程同一时刻只有一个请求在分析"""
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job.future.done():
+                # 等待期间连接已断开
+                continue
+            job.started = time.perf_counter()
+            executor = self._executor
+            self.metrics.running += 1
+            try:
+                outcome = await loop.run_in_executor(executor, analyze_upload, job.data, job.params, job.fmt)
+            except BrokenProcessPool as e:
+                # 分析进程崩溃: 重建进程池，当前请求以503结束
+                if self._executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = self._new_executor()
+                outcome = e
+            except Exception as e:
+                outcome = e
+            finally:
+                self.metrics.running -= 1
+            if job.future.done():
+                continue
+            if isinstance(outcome, BaseException):
+                job.future.set_exception(outcome)
+            else:
+                job.future.set_result(outcome)
+
+    async def _analyze(self, query: str, body: bytes) -> Tuple[int, str, bytes, Dict]:
+        try:
+            params, fmt = parse_params(query)
+        except ValueError as e:
+            return _json_response(400, {'error': str(e)})
+        if not body:
+            return _json_response(400, {'error': "请求体应为图像文件内容"})
+        job = _Job(body, params, fmt, asyncio.get_running_loop().create_future())
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.metrics.counts['rejected'] += 1
+            return _json_response(429, {'error': "分析队列已满，请稍后重试"}, {'Retry-After': str(RETRY_AFTER)})
+        self.metrics.counts['accepted'] += 1
+        try:
+            payload, content_type, analysis_s = await job.future
+        except ValueError as e:
+            self.metrics.counts['failed'] += 1
+            return _json_response(400, {'error': str(e)})
+        except BrokenProcessPool:
+            self.metrics.counts['failed'] += 1
+            return _json_response(503, {'error': "分析进程异常退出，请重试"})
+        except Exception as e:
+            self.metrics.counts['failed'] += 1
+            return _json_response(500, {'error': f"{type(e).__name__}: {e}"})
+        finally:
+            # 请求处理被取消(连接断开)时，分发协程跳过尚未开始的分析
+            if not job.future.done():
+                job.future.cancel()
+        finished = time.perf_counter()
+        self.metrics.counts['completed'] += 1
+        self.metrics.record(finished - job.queued, job.started - job.queued, analysis_s)
+        return 200, content_type, payload, {}
+
+    async def route(self, method: str, target: str, body: bytes) -> Tuple[int, str, bytes, Dict]:
+        """处理一个请求，返回(状态码, Content-Type, 响应内容, 其他响应头)"""
+        url = urlsplit(target)
+        if url.path == '/analyze':
+            if method != 'POST':
+                return _json_response(405, {'error': "请使用POST上传图像"}, {'Allow': 'POST'})
+            return await self._analyze(url.query, body)
+        if url.path in ('/metrics', '/health'):
+            if method != 'GET':
+                return _json_response(405, {'error': "请使用GET"}, {'Allow': 'GET'})
+            if url.path == '/health':
+                return _json_response(200, {'status': 'ok', 'workers': self.workers})
+            return _json_response(200, self.metrics.snapshot(self._queue.qsize(), self.queue_size,
+                                                             self.workers))
+        return _json_response(404, {'error': f"未知的路径: {url.path}"})
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """HTTP/1.1连接: 依次处理请求，支持keep-alive；请求体须带Content-Length"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await _write_response(writer, *_json_response(400, {'error': "无效的请求行"}), False)
+                    break
+                method, target, version = parts
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+                if 'transfer-encoding' in headers:
+                    await _write_response(writer, *_json_response(411, {'error': "请求体须带Content-Length"}), False)
+                    break
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await _write_response(writer, *_json_response(400, {'error': "无效的Content-Length"}), False)
+                    break
+                if length > self.max_upload:
+                    await _write_response(writer, *_json_response(413, {'error': "上传文件过大"}), False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                response = await self.route(method.upper(), target, body)
+                await _write_response(writer, *response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+def _json_response(status: int, payload: Dict, headers: Optional[Dict] = None) -> Tuple[int, str, bytes, Dict]:
+    return (status, 'application/json; charset=utf-8', json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+            headers or {})
+
+
+async def _write_response(writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes,
+                          headers: Dict, keep_alive: bool) -> None:
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}",
+             f"Content-Type: {content_type}",
+             f"Content-Length: {len(body)}",
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+    writer.write(body)
+    await writer.drain()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="乳腺钼靶本地分析服务(HTTP)")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="监听地址(默认只接受本机连接)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="监听端口")
+    parser.add_argument('--workers', type=int, default=None, help="分析进程数(默认CPU核心数)")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="排队请求数上限，超出时返回429")
+    parser.add_argument('--threads-per-worker', type=int, default=1, help="每个分析进程的线程数上限")
+    parser.add_argument('--cache-dir', default=None, help="结果缓存目录(默认不使用缓存)")
+    parser.add_argument('--max-upload-mb', type=float, default=MAX_UPLOAD_BYTES / 2 ** 20,
+                        help="上传文件大小上限(MB)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        service = AnalysisService(args.workers, args.queue_size, args.threads_per_worker,
+                                  args.cache_dir, int(args.max_upload_mb * 2 ** 20))
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 1
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        print("分析服务已停止", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
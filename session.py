@@ -0,0 +1,224 @@
+"""
+文件夹浏览会话
+
+按顺序浏览文件夹中的图像(上一张/下一张)。后台预先读取后续N张图像，生成显示用的
+金字塔层级和原图显示图像，并按当前参数完成分析；预取的图像和结果保存在按内存上限
+淘汰的LRU中，切换到已预取的图像时无需等待解码和分析。
+"""
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import cache
+import utils
+
+# 向后预取的图像数
+PREFETCH_AHEAD = 3
+# 向前保留/预取的图像数(返回上一张时同样无需等待)
+PREFETCH_BEHIND = 1
+# 预取缓存的内存上限(字节)
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class SessionEntry:
+    """
+    一张图像的预取内容
+
+    属性:
+        path: 图像路径
+        img: 解码后的灰度图像
+        pyramid: 显示用的utils.DisplayPyramid
+        pipeline: processing.AnalysisPipeline
+        image_digest: 图像像素哈希
+        results: 缓存键 -> AnalysisResult
+        renders: (宽, 高) -> 原图显示用的RGB图像
+    """
+
+    __slots__ = ('path', 'img', 'pyramid', 'pipeline', 'image_digest', 'results', 'renders')
+
+    def __init__(self, path, img, pipeline, image_digest=None):
+        self.path = path
+        self.img = img
+        self.pyramid = utils.DisplayPyramid(img)
+        self.pipeline = pipeline
+        self.image_digest = image_digest
+        self.results = {}
+        self.renders = {}
+
+    @property
+    def nbytes(self) -> int:
+        """图像、金字塔层级、预渲染图像和分析结果的字节数(不含流水线中间结果)"""
+        total = sum(np.asarray(level).nbytes for level in self.pyramid.levels)
+        total += sum(render.nbytes for render in self.renders.values())
+        total += sum(result.nbytes for result in self.results.values())
+        return total
+
+    def render(self, max_width, max_height):
+        """原图显示图像，预先渲染过同一尺寸时直接返回"""
+        rendered = self.renders.get((max_width, max_height))
+        if rendered is None:
+            rendered = utils.render_for_display(self.pyramid, max_width, max_height)
+        return rendered
+
+
+class SessionCache:
+    """
+    按内存上限淘汰的预取缓存(LRU)
+
+    参数:
+        max_bytes: 全部条目的字节数上限，超出时淘汰最久未使用的条目(当前图像除外)
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.current = None
+
+    def get(self, path) -> Optional[SessionEntry]:
+        entry = self.entries.get(path)
+        if entry is not None:
+            self.entries.move_to_end(path)
+        return entry
+
+    def peek(self, path) -> Optional[SessionEntry]:
+        """查询条目但不刷新使用顺序(用于后台预取的检查)"""
+        return self.entries.get(path)
+
+    def put(self, entry: SessionEntry) -> None:
+        self.entries[entry.path] = entry
+        self.entries.move_to_end(entry.path)
+        self.evict()
+
+    def set_current(self, path) -> None:
+        """标记当前显示的图像，淘汰时保留"""
+        self.current = path
+        self.evict()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry.nbytes for entry in self.entries.values())
+
+    def evict(self, keep=()) -> int:
+        """淘汰最久未使用的条目直到不超过上限，返回淘汰数量"""
+        total = self.nbytes
+        removed = 0
+        for path in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            if path == self.current or path in keep:
+                continue
+            total -= self.entries.pop(path).nbytes
+            removed += 1
+        return removed
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.current = None
+
+
+class FolderSession:
+    """
+    文件夹中图像的浏览顺序
+
+    参数:
+        paths: 图像路径列表(按浏览顺序)
+    """
+
+    def __init__(self, paths: List[str]):
+        if not paths:
+            raise ValueError("文件夹中没有可读取的图像")
+        self.paths = list(paths)
+        self.index = 0
+
+    @classmethod
+    def from_directory(cls, directory: str, recursive: bool = False) -> 'FolderSession':
+        """收集目录中的图像(与批量分析支持的格式相同)"""
+        import batch
+
+        return cls(batch.collect_inputs([directory], recursive=recursive))
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def current_path(self) -> str:
+        return self.paths[self.index]
+
+    def move(self, step: int) -> bool:
+        """前进或后退step张，超出范围时不移动并返回False"""
+        index = self.index + step
+        if not 0 <= index < len(self.paths):
+            return False
+        self.index = index
+        return True
+
+    def prefetch_paths(self, ahead: int = PREFETCH_AHEAD, behind: int = PREFETCH_BEHIND) -> List[str]:
+        """需要预取的图像，按优先级排序(先后续，再之前)"""
+        after = self.paths[self.index + 1:self.index + 1 + ahead]
+        before = self.paths[max(0, self.index - behind):self.index][::-1]
+        return after + before
+
+
+def prepare_entry(path: str, pyramid_depth: Optional[Callable] = None,
+                  display_size: Optional[Tuple[int, int]] = None,
+                  is_cancelled: Optional[Callable[[], bool]] = None) -> Optional[SessionEntry]:
+    """
+    读取图像并生成显示用内容
+
+    参数:
+        path: 图像路径
+        pyramid_depth: 可选的pyramid_depth(shape)，预先生成到该层级
+        display_size: 可选的(宽, 高)，预先渲染该尺寸的原图显示图像
+        is_cancelled: 可选的取消检查，返回True时放弃并返回None
+
+    返回:
+        SessionEntry，取消时为None
+    """
+    import processing
+
+    is_cancelled = is_cancelled or (lambda: False)
+    img = utils.read_image(path)
+    if is_cancelled():
+        return None
+    entry = SessionEntry(path, img, processing.AnalysisPipeline(img), cache.image_digest(img))
+    if pyramid_depth is not None:
+        for index in range(1, pyramid_depth(img.shape) + 1):
+            if is_cancelled():
+                return None
+            entry.pyramid.level(index)
+    if display_size is not None:
+        entry.renders[display_size] = utils.render_for_display(entry.pyramid, *display_size)
+    return entry
+
+
+def analyze_entry(entry: SessionEntry, params: Dict, analysis_cache,
+                  progress_callback=None) -> Tuple[object, str]:
+    """
+    按参数分析预取的图像(先查结果缓存)，结果记入entry.results
+
+    分析后释放流水线的中间结果，预取的图像只保留紧凑的结果对象
+
+    返回:
+        (AnalysisResult, 缓存键)
+    """
+    import processing
+
+    key = cache.make_key(entry.image_digest, params)
+    result = entry.results.get(key)
+    if result is not None:
+        return result, key
+    result = analysis_cache.get(key, entry.img)
+    if result is None:
+        result = entry.pipeline.run(tile_size=processing.default_tile_size(entry.img.shape),
+                                    progress_callback=progress_callback, **params)
+        analysis_cache.put(key, result)
+        entry.pipeline.clear()
+    entry.results[key] = result
+    return result, key
+
+
+def entry_label(session: FolderSession) -> str:
+    """浏览位置文字，如 3/120 film.png"""
+    return f"{session.index + 1}/{len(session)} {os.path.basename(session.current_path)}"
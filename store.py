@@ -0,0 +1,353 @@
+"""
+病灶特征库(SQLite)
+
+把每次分析的图像摘要(路径、像素哈希、参数、病灶占比和数量)和逐病灶特征汇总到一个
+SQLite数据库，常用查询字段建有索引，队列研究的筛选(如"含圆形度<0.5且面积>2000病灶的
+全部图像")只需一次查询，无需遍历大量保存目录。
+
+同一图像(路径 + 像素哈希)以同一参数重复写入时替换旧记录。写入按批合并为事务，
+界面保存和批量分析均可使用。
+
+用法示例:
+    python store.py features.db images "circularity<0.5" "area>2000"
+    python store.py features.db lesions "circularity<0.5" "area>2000" --order area --limit 20
+    python store.py features.db stats
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from operator import itemgetter
+
+# 注意: 本模块不导入 numpy，批量分析主进程可直接使用
+
+DEFAULT_STORE_PATH = os.environ.get(
+    'MAMMO_FEATURE_STORE', os.path.join(os.path.expanduser('~'), '.mammo_features.sqlite'))
+
+# 每个事务写入的图像数
+BATCH_SIZE = 64
+# SQLite页缓存大小(KiB)
+CACHE_KIB = 64 * 1024
+
+# 逐病灶特征列(与批量分析输出的病灶字段一致)
+LESION_FIELDS = ['area', 'perimeter', 'circularity', 'major_axis_length',
+                 'minor_axis_length', 'eccentricity', 'solidity',
+                 'bbox_min_row', 'bbox_min_col', 'bbox_max_row', 'bbox_max_col',
+                 'centroid_row', 'centroid_col']
+
+_lesion_values = itemgetter(*LESION_FIELDS)
+
+# 可用于查询条件的图像摘要列
+IMAGE_COLUMNS = ['path', 'image_digest', 'k', 'pipeline_version', 'width', 'height',
+                 'lesion_percentage', 'lesion_count', 'analyzed_at']
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    image_digest TEXT NOT NULL DEFAULT '',
+    params TEXT NOT NULL,
+    k INTEGER,
+    pipeline_version INTEGER,
+    width INTEGER,
+    height INTEGER,
+    lesion_percentage REAL,
+    lesion_count INTEGER,
+    analyzed_at TEXT,
+    UNIQUE (path, image_digest, params)
+);
+CREATE TABLE IF NOT EXISTS lesions (
+    image_id INTEGER NOT NULL,
+    lesion_index INTEGER NOT NULL,
+    {', '.join(f"{name} {'INTEGER' if name.startswith('bbox_') else 'REAL'}" for name in LESION_FIELDS)},
+    PRIMARY KEY (image_id, lesion_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS images_digest ON images (image_digest);
+CREATE INDEX IF NOT EXISTS images_percentage ON images (lesion_percentage);
+CREATE INDEX IF NOT EXISTS images_count ON images (lesion_count);
+CREATE INDEX IF NOT EXISTS lesions_area ON lesions (area);
+CREATE INDEX IF NOT EXISTS lesions_circularity ON lesions (circularity);
+"""
+
+_CONDITION_RE = re.compile(r'^\s*(\w+)\s*(<=|>=|!=|=|<|>|~)\s*(.*?)\s*$')
+
+
+def lesion_rows_from_table(table):
+    """由病灶特征表(LESION_DTYPE)生成按LESION_FIELDS排列的行，未计算的形态特征为NaN(写入为NULL)"""
+    columns = [table[name].tolist() for name in LESION_FIELDS[:7]]
+    bbox = table['bounding_box'].tolist()
+    centroid = table['centroid'].tolist()
+    return [tuple(values) + tuple(b) + tuple(c)
+            for values, b, c in zip(zip(*columns), bbox, centroid)]
+
+
+def entry_from_result(path, result, params, image_digest=None):
+    """由分析结果(AnalysisResult)生成一条写入记录"""
+    height, width = result.shape
+    return {
+        'path': os.path.abspath(path),
+        'image_digest': image_digest,
+        'params': params,
+        'width': width,
+        'height': height,
+        'lesion_percentage': float(result.lesion_percentage),
+        'lesion_count': int(result.lesion_count),
+        'lesions': lesion_rows_from_table(result.lesion_table),
+    }
+
+
+def entry_from_record(record, params):
+    """由批量分析的结果记录(batch.analyze_file)生成一条写入记录"""
+    return {
+        'path': record['path'],
+        'image_digest': record.get('image_digest'),
+        'params': params,
+        'width': record['width'],
+        'height': record['height'],
+        'lesion_percentage': record['lesion_percentage'],
+        'lesion_count': record['lesion_count'],
+        'lesions': list(map(_lesion_values, record['lesions'])),
+    }
+
+
+def parse_condition(text):
+    """
+    解析查询条件，如"area>2000"、"circularity<=0.5"、"path~%/CC/%"(~为LIKE匹配)
+
+    返回:
+        (列名, 运算符, 值)
+    """
+    match = _CONDITION_RE.match(text)
+    if not match or not match.group(3):
+        raise ValueError(f"无法解析查询条件: {text}")
+    column, op, value = match.groups()
+    if column not in LESION_FIELDS and column not in IMAGE_COLUMNS:
+        raise ValueError(f"未知的查询字段: {column}")
+    if op != '~':
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    return column, op, value
+
+
+def _normalized_params(params):
+    """参数的规范化JSON(补全默认值)，相同参数总是得到相同文本"""
+    import cache
+
+    return json.dumps(cache.normalize_params(params or {}), sort_keys=True)
+
+
+class FeatureStore:
+    """
+    病灶特征库
+
+    参数:
+        path: 数据库文件路径
+        batch_size: 缓冲的图像记录达到该数量时合并为一个事务写入
+
+    add()只缓冲记录，flush()/close()或离开with块时写入剩余记录。
+    可在后台线程中使用(内部加锁)。
+    """
+
+    def __init__(self, path=None, batch_size=BATCH_SIZE):
+        self.path = path or DEFAULT_STORE_PATH
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        # 较大的页缓存减少批量写入时索引页的换入换出
+        self._conn.execute(f'PRAGMA cache_size={-CACHE_KIB}')
+        self._conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, entry):
+        """缓冲一条记录(entry_from_result/entry_from_record的返回值)，达到批大小时写入"""
+        with self._lock:
+            self._pending.append(entry)
+            if len(self._pending) >= self.batch_size:
+                self._write(self._pending)
+                self._pending = []
+
+    def flush(self):
+        """写入缓冲的全部记录"""
+        with self._lock:
+            if self._pending:
+                self._write(self._pending)
+                self._pending = []
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.flush()
+        with self._lock:
+            self._conn.close()
+            self._conn = None
+
+    def _write(self, entries):
+        """在一个事务中写入多条记录，同一图像和参数的旧记录被替换"""
+        import processing
+
+        analyzed_at = datetime.now().isoformat(timespec='seconds')
+        lesion_sql = (f"INSERT INTO lesions (image_id, lesion_index, {', '.join(LESION_FIELDS)}) "
+                      f"VALUES ({', '.join('?' * (len(LESION_FIELDS) + 2))})")
+        with self._conn:
+            for entry in entries:
+                params = _normalized_params(entry['params'])
+                key = (entry['path'], entry['image_digest'] or '', params)
+                summary = (json.loads(params)['k'], processing.PIPELINE_VERSION, entry['width'],
+                           entry['height'], entry['lesion_percentage'], entry['lesion_count'],
+                           analyzed_at)
+                row = self._conn.execute(
+                    "SELECT id FROM images WHERE path = ? AND image_digest = ? AND params = ?",
+                    key).fetchone()
+                if row is None:
+                    image_id = self._conn.execute(
+                        "INSERT INTO images (path, image_digest, params, k, pipeline_version, "
+                        "width, height, lesion_percentage, lesion_count, analyzed_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", key + summary).lastrowid
+                else:
+                    image_id = row[0]
+                    self._conn.execute(
+                        "UPDATE images SET k = ?, pipeline_version = ?, width = ?, height = ?, "
+                        "lesion_percentage = ?, lesion_count = ?, analyzed_at = ? WHERE id = ?",
+                        summary + (image_id,))
+                    self._conn.execute("DELETE FROM lesions WHERE image_id = ?", (image_id,))
+                self._conn.executemany(
+                    lesion_sql, ((image_id, i) + lesion
+                                 for i, lesion in enumerate(entry['lesions'], 1)))
+
+    def _where(self, conditions, per_image):
+        """生成WHERE子句；按图像查询时病灶条件需由同一个病灶同时满足"""
+        image_terms, lesion_terms, values, lesion_values = [], [], [], []
+        for column, op, value in conditions:
+            sql_op = 'LIKE' if op == '~' else op
+            if column in LESION_FIELDS:
+                lesion_terms.append(f"l.{column} {sql_op} ?")
+                lesion_values.append(value)
+            else:
+                image_terms.append(f"i.{column} {sql_op} ?")
+                values.append(value)
+        if per_image and lesion_terms:
+            # 子查询可使用病灶特征列上的索引
+            image_terms.append("i.id IN (SELECT l.image_id FROM lesions l WHERE "
+                               + " AND ".join(lesion_terms) + ")")
+            lesion_terms = []
+        terms = image_terms + lesion_terms
+        return (" WHERE " + " AND ".join(terms) if terms else ""), values + lesion_values
+
+    def _select(self, sql, values):
+        self.flush()
+        with self._lock:
+            cursor = self._conn.execute(sql, values)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def query_images(self, conditions=(), order_by='lesion_percentage', limit=None):
+        """
+        查询图像摘要
+
+        参数:
+            conditions: (列名, 运算符, 值)序列，见parse_condition；病灶条件表示"至少有一个病灶满足"
+            order_by: 排序列(降序)
+            limit: 最多返回的行数
+
+        返回:
+            list: 每行一个dict(含params的JSON文本)
+        """
+        if order_by not in IMAGE_COLUMNS:
+            raise ValueError(f"未知的排序字段: {order_by}")
+        where, values = self._where(conditions, per_image=True)
+        sql = (f"SELECT i.path, i.image_digest, i.params, i.width, i.height, i.lesion_percentage, "
+               f"i.lesion_count, i.analyzed_at FROM images i{where} ORDER BY i.{order_by} DESC")
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self._select(sql, values)
+
+    def query_lesions(self, conditions=(), order_by='area', limit=None):
+        """查询满足条件的病灶(附带所属图像的路径、参数和病灶占比)，参数同query_images"""
+        if order_by not in LESION_FIELDS and order_by not in IMAGE_COLUMNS:
+            raise ValueError(f"未知的排序字段: {order_by}")
+        where, values = self._where(conditions, per_image=False)
+        table = 'l' if order_by in LESION_FIELDS else 'i'
+        sql = (f"SELECT i.path, i.params, i.lesion_percentage, l.lesion_index, "
+               f"{', '.join('l.' + name for name in LESION_FIELDS)} "
+               f"FROM lesions l JOIN images i ON i.id = l.image_id{where} "
+               f"ORDER BY {table}.{order_by} DESC")
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self._select(sql, values)
+
+    def stats(self):
+        """图像记录数、病灶记录数和数据库文件大小"""
+        counts = self._select("SELECT (SELECT COUNT(*) FROM images) AS images, "
+                              "(SELECT COUNT(*) FROM lesions) AS lesions", ())[0]
+        counts['bytes'] = os.path.getsize(self.path)
+        return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="病灶特征库查询")
+    parser.add_argument('database', help="特征库文件")
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, help_text, default_order in (('images', "查询图像(病灶条件表示至少一个病灶同时满足)",
+                                            'lesion_percentage'),
+                                           ('lesions', "查询病灶", 'area')):
+        query = sub.add_parser(name, help=help_text)
+        query.add_argument('conditions', nargs='*',
+                           help='查询条件，如 "area>2000" "circularity<0.5" "path~%%CC%%"')
+        query.add_argument('--order', default=default_order, help="排序字段(降序)")
+        query.add_argument('--limit', type=int, default=None, help="最多输出的行数")
+        query.add_argument('-o', '--output', help="将结果写入CSV文件(默认打印)")
+    sub.add_parser('stats', help="记录数和文件大小")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.database):
+        print(f"特征库不存在: {args.database}", file=sys.stderr)
+        return 1
+    with FeatureStore(args.database) as feature_store:
+        if args.command == 'stats':
+            stats = feature_store.stats()
+            print(f"图像 {stats['images']} 条, 病灶 {stats['lesions']} 条, "
+                  f"{stats['bytes'] / 1024:.1f} KB")
+            return 0
+        try:
+            conditions = [parse_condition(text) for text in args.conditions]
+            query = feature_store.query_images if args.command == 'images' else feature_store.query_lesions
+            rows = query(conditions, args.order, args.limit)
+        except (ValueError, sqlite3.Error) as e:
+            print(e, file=sys.stderr)
+            return 1
+
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [])
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"{len(rows)} 行已写入 {args.output}", file=sys.stderr)
+    else:
+        for row in rows:
+            print("\t".join('' if v is None else str(v) for v in row.values()))
+        print(f"共 {len(rows)} 行", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
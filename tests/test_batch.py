@@ -0,0 +1,138 @@
+"""批量分析: 结果写入器、中断后续跑和工作进程线程数限制"""
+import csv
+import json
+import multiprocessing as mp
+import os
+
+import pytest
+
+import batch
+
+
+def _record(path, lesion_count):
+    lesions = [{'area': 100 + i, 'bbox_min_row': i} for i in range(lesion_count)]
+    return {'path': path, 'status': 'ok', 'width': 64, 'height': 64, 'lesion_percentage': 1.0,
+            'lesion_count': lesion_count, 'lesions': lesions, 'cache_hit': False, 'elapsed': 0.1}
+
+
+def _write(writer, records):
+    writer.open()
+    try:
+        for record in records:
+            writer.write(record)
+    finally:
+        writer.close()
+
+
+def _csv_rows(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+def _without_elapsed(rows):
+    return [{k: v for k, v in row.items() if k != 'elapsed'} for row in rows]
+
+
+def test_csv_rows_per_lesion(tmp_path):
+    path = str(tmp_path / 'out.csv')
+    writer = batch.CsvResultWriter(path)
+    _write(writer, [_record('a.png', 3), _record('b.png', 0),
+                    {'path': 'c.png', 'status': 'error', 'error': 'bad'}])
+    rows = _csv_rows(path)
+    assert [(row['path'], row['lesion_index']) for row in rows] == [
+        ('a.png', '1'), ('a.png', '2'), ('a.png', '3'), ('b.png', ''), ('c.png', '')]
+    assert rows[1]['area'] == '101'
+    assert writer.finished_paths() == {'a.png', 'b.png'}
+
+
+def test_csv_resume_drops_partially_written_image(tmp_path):
+    path = str(tmp_path / 'out.csv')
+    writer = batch.CsvResultWriter(path)
+    _write(writer, [_record('a.png', 2), _record('b.png', 3)])
+    # 模拟写到b.png第二行中途被终止: 保留第一行和第二行的一半
+    with open(path, encoding='utf-8', newline='') as f:
+        lines = f.readlines()
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.writelines(lines[:4])
+        f.write(lines[4][:10])
+
+    assert writer.finished_paths() == {'a.png'}
+    _write(writer, [_record('b.png', 3)])
+    rows = _csv_rows(path)
+    assert [(row['path'], row['lesion_index']) for row in rows] == [
+        ('a.png', '1'), ('a.png', '2'), ('b.png', '1'), ('b.png', '2'), ('b.png', '3')]
+    assert writer.finished_paths() == {'a.png', 'b.png'}
+
+
+def test_jsonl_resume_ignores_partial_line(tmp_path):
+    path = str(tmp_path / 'out.jsonl')
+    writer = batch.JsonlResultWriter(path)
+    _write(writer, [_record('a.png', 2), {'path': 'b.png', 'status': 'error', 'error': 'bad'}])
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(_record('c.png', 1))[:20])
+
+    assert writer.finished_paths() == {'a.png'}
+    _write(writer, [_record('c.png', 1)])
+    assert writer.finished_paths() == {'a.png', 'c.png'}
+
+
+@pytest.fixture(scope='module')
+def films(tmp_path_factory):
+    import cv2
+    import phantom
+
+    directory = tmp_path_factory.mktemp('films')
+    for seed in range(3):
+        cv2.imwrite(str(directory / f'film{seed}.png'), phantom.make_phantom(256, 6, seed=seed)[0])
+    return directory
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'jsonl'])
+def test_main_resumes_interrupted_run(films, tmp_path, fmt, capsys):
+    output = str(tmp_path / f'out.{fmt}')
+    argv = [str(films), '-o', output, '--workers', '1', '--no-cache']
+    assert batch.main(argv) == 0
+    with open(output, 'rb') as f:
+        complete = f.read()
+    expected = _csv_rows(output) if fmt == 'csv' else None
+    # 截断到最后一张图像的记录中途
+    with open(output, 'wb') as f:
+        f.write(complete[:len(complete) - 30])
+    capsys.readouterr()
+
+    assert batch.main(argv) == 0
+    assert '跳过已处理的 2 张图像' in capsys.readouterr().err
+    if fmt == 'csv':
+        # 除耗时外与一次跑完的结果相同，且没有残余的重复行
+        assert _without_elapsed(_csv_rows(output)) == _without_elapsed(expected)
+    else:
+        with open(output, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        records = [json.loads(line) for line in lines if line.endswith('}')]
+        paths = [record['path'] for record in records]
+        assert sorted(paths) == sorted(set(paths)) and len(paths) == 3
+
+
+def test_parse_args_rejects_mask_pectoral_without_crop(capsys):
+    with pytest.raises(SystemExit):
+        batch.parse_args(['x', '-o', 'out.jsonl', '--mask-pectoral'])
+    assert '--crop-foreground' in capsys.readouterr().err
+
+
+def _worker_thread_limits(_):
+    import cv2
+    from threadpoolctl import threadpool_info
+
+    return (os.environ['OMP_NUM_THREADS'], cv2.getNumThreads(),
+            sorted({info['num_threads'] for info in threadpool_info()}))
+
+
+def test_workers_limit_threads():
+    pytest.importorskip('threadpoolctl')
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(2, initializer=batch._init_worker, initargs=(2, {}, None)) as pool:
+        results = pool.map(_worker_thread_limits, range(2))
+    for env, cv2_threads, pool_threads in results:
+        assert env == '2'
+        assert cv2_threads == 2
+        assert all(n <= 2 for n in pool_threads)
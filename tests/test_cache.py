@@ -0,0 +1,72 @@
+"""分析结果磁盘缓存: 命中/未命中、损坏条目和LRU淘汰"""
+import os
+
+import numpy as np
+import pytest
+
+import cache
+import phantom
+
+
+@pytest.fixture(scope='module')
+def film():
+    return phantom.make_phantom(256, 6, seed=2)[0]
+
+
+def test_hit_returns_same_result(film, tmp_path):
+    c = cache.AnalysisCache(str(tmp_path))
+    first = c.analyze(film, k=3)
+    second = c.analyze(film, k=3)
+    assert (c.hits, c.misses) == (1, 1)
+    assert np.array_equal(first.mask_img, second.mask_img)
+    assert first.lesion_count == second.lesion_count
+    # 参数不同则键不同
+    c.analyze(film, k=4)
+    assert (c.hits, c.misses) == (1, 2)
+    assert c.stats()['entries'] == 2
+
+
+@pytest.mark.parametrize('content', [b'PK\x03\x04garbage', b'', b'\x93NUMPY'])
+def test_corrupt_entry_is_a_miss(film, tmp_path, content):
+    c = cache.AnalysisCache(str(tmp_path))
+    key = cache.make_key(cache.image_digest(film), {'k': 3})
+    os.makedirs(os.path.dirname(c._path(key)), exist_ok=True)
+    with open(c._path(key), 'wb') as f:
+        f.write(content)
+
+    assert c.get(key, film) is None
+    assert c.misses == 1
+    assert not os.path.exists(c._path(key))
+    # 删除坏文件后可重新写入并命中
+    result = c.analyze(film, k=3)
+    assert c.get(key, film).lesion_count == result.lesion_count
+
+
+def test_truncated_entry_is_a_miss(film, tmp_path):
+    c = cache.AnalysisCache(str(tmp_path))
+    c.analyze(film, k=3)
+    key = cache.make_key(cache.image_digest(film), {'k': 3})
+    with open(c._path(key), 'rb') as f:
+        data = f.read()
+    with open(c._path(key), 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    assert c.get(key, film) is None
+    assert not os.path.exists(c._path(key))
+
+
+def test_evicts_least_recently_used(film, tmp_path):
+    c = cache.AnalysisCache(str(tmp_path))
+    keys = {}
+    for k in (2, 3, 4):
+        c.analyze(film, k=k)
+        keys[k] = c._path(cache.make_key(cache.image_digest(film), {'k': k}))
+    # 访问时间: k=3最旧，k=2最新
+    for age, k in ((300, 3), (200, 4), (100, 2)):
+        mtime = os.path.getmtime(keys[k]) - age
+        os.utime(keys[k], (mtime, mtime))
+    c.max_bytes = c.stats()['bytes'] - 1
+
+    assert c.evict() == 1
+    assert not os.path.exists(keys[3])
+    assert os.path.exists(keys[2]) and os.path.exists(keys[4])
@@ -0,0 +1,78 @@
+"""直方图聚类与sklearn逐像素聚类的一致性"""
+import cv2
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import phantom
+import processing
+
+SIZES = (256, 512, 1024)
+K_VALUES = (2, 3, 4, 5)
+# 两种实现的聚类中心允许的最大差异(灰度级)
+CENTER_TOLERANCE = 2.0
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def film(request):
+    return phantom.make_phantom(request.param, 12, seed=request.param)[0]
+
+
+def baseline_mask(img, k, lesion_is_bright=True, morph_kernel_size=(5, 5), min_lesion_size=100):
+    """原逐像素实现: 对全部像素运行KMeans，按标签取目标类，形态学处理后逐个连通域过滤"""
+    from sklearn.cluster import KMeans
+
+    img_smooth = cv2.GaussianBlur(cv2.equalizeHist(img), (5, 5), 0)
+    kmeans = KMeans(n_clusters=k, random_state=42, n_init='auto')
+    labels = kmeans.fit_predict(img_smooth.reshape((-1, 1)).astype(np.float32))
+    centers = np.uint8(kmeans.cluster_centers_)
+    target_cluster = np.argmax(centers) if lesion_is_bright else np.argmin(centers)
+    mask_img = (labels.reshape(img.shape) == target_cluster).astype(np.uint8) * 255
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, morph_kernel_size)
+    mask_img = cv2.morphologyEx(mask_img, cv2.MORPH_CLOSE, kernel)
+    mask_img = cv2.morphologyEx(mask_img, cv2.MORPH_OPEN, kernel)
+    labeled_mask, num_features = ndimage.label(mask_img)
+    sizes = ndimage.sum(mask_img, labeled_mask, range(num_features + 1))
+    for i in range(num_features + 1):
+        if sizes[i] < min_lesion_size or sizes[i] > 0.8 * mask_img.size:
+            mask_img[labeled_mask == i] = 0
+    return mask_img
+
+
+@pytest.mark.parametrize('k', K_VALUES)
+def test_histogram_inertia_not_above_sklearn(film, k):
+    # 动态规划求得全局最优，惯性不高于sklearn后端(默认n_init='auto'可能停在局部最优)
+    pipeline = processing.AnalysisPipeline(film)
+    hist = pipeline.histogram()
+    histogram_centers, _ = pipeline.cluster(k, 'histogram')
+    sklearn_centers, _ = pipeline.cluster(k, 'sklearn')
+    assert (processing.cluster_inertia(hist, histogram_centers)
+            <= processing.cluster_inertia(hist, sklearn_centers) * (1 + 1e-9))
+
+
+@pytest.mark.parametrize('k', K_VALUES)
+def test_histogram_centers_are_lloyd_fixed_point(film, k):
+    # 最优解是Lloyd迭代的不动点: 以直方图聚类中心初始化sklearn，中心基本不动
+    pipeline = processing.AnalysisPipeline(film)
+    histogram_centers, _ = pipeline.cluster(k, 'histogram')
+    sklearn_centers, _ = processing._cluster_sklearn(pipeline.smooth(), k, histogram_centers)
+    np.testing.assert_allclose(np.sort(sklearn_centers), histogram_centers, atol=0.5)
+
+
+@pytest.mark.parametrize('k', K_VALUES)
+def test_histogram_centers_match_converged_sklearn(film, k):
+    from sklearn.cluster import KMeans
+
+    pipeline = processing.AnalysisPipeline(film)
+    histogram_centers, _ = pipeline.cluster(k, 'histogram')
+    pixels = pipeline.smooth().reshape((-1, 1)).astype(np.float64)
+    kmeans = KMeans(n_clusters=k, random_state=42, n_init=10, tol=0, max_iter=1000).fit(pixels)
+    np.testing.assert_allclose(np.sort(kmeans.cluster_centers_.ravel()), histogram_centers,
+                               atol=CENTER_TOLERANCE)
+
+
+@pytest.mark.parametrize('k', K_VALUES)
+def test_sklearn_mask_matches_baseline(film, k):
+    result = processing.analyze_mammo_image(film, k=k, cluster_method='sklearn')
+    np.testing.assert_array_equal(result['mask_img'], baseline_mask(film, k))
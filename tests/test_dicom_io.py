@@ -0,0 +1,114 @@
+"""DICOM读取: 文件头筛选、内存映射和窗宽窗位转换(使用phantom生成的DICOM文件)"""
+import os
+
+import numpy as np
+import pytest
+
+import dicom_io
+import phantom
+
+pytest.importorskip('pydicom')
+
+# 体模DICOM的存储格式: (参数名, save_dicom的关键字参数)
+VARIANTS = [
+    ('monochrome2', {}),
+    ('monochrome1', {'monochrome1': True}),
+    ('signed', {'signed': True}),
+    ('rle', {'rle': True}),
+    ('signed_rle', {'signed': True, 'rle': True}),
+    ('monochrome1_rle', {'monochrome1': True, 'rle': True}),
+]
+
+
+@pytest.fixture(scope='module')
+def film():
+    return phantom.make_phantom(256, 6, seed=1)[0]
+
+
+@pytest.fixture(scope='module')
+def dicom_files(film, tmp_path_factory):
+    directory = tmp_path_factory.mktemp('dicom')
+    paths = {}
+    for name, options in VARIANTS:
+        paths[name] = str(directory / f'{name}.dcm')
+        phantom.save_dicom(paths[name], film, **options)
+    return paths
+
+
+def test_scan_filters_on_header_only(film, tmp_path):
+    for view, laterality in (('CC', 'L'), ('CC', 'R'), ('MLO', 'L'), ('MLO', 'R')):
+        phantom.save_dicom(str(tmp_path / f'{view}_{laterality}.dcm'), film, view=view,
+                           laterality=laterality)
+    # 临床文件常无扩展名，按文件标记识别
+    phantom.save_dicom(str(tmp_path / 'noext'), film, view='MLO', laterality='L')
+    (tmp_path / 'notes.txt').write_text('not dicom')
+    # 截断像素数据: 只读文件头的扫描仍能识别，读取像素时失败
+    truncated = tmp_path / 'sub' / 'truncated.dcm'
+    truncated.parent.mkdir()
+    phantom.save_dicom(str(truncated), film, view='MLO', laterality='L')
+    data = truncated.read_bytes()
+    truncated.write_bytes(data[:len(data) - film.size])
+
+    headers = dicom_io.scan_directory(str(tmp_path), view='mlo', laterality='L')
+    assert [os.path.relpath(h['path'], tmp_path) for h in headers] == [
+        'MLO_L.dcm', 'noext', os.path.join('sub', 'truncated.dcm')]
+    assert all(h['modality'] == 'MG' and (h['rows'], h['columns']) == film.shape for h in headers)
+    assert len(dicom_io.scan_directory(str(tmp_path), recursive=False, view='MLO')) == 3
+    assert dicom_io.scan_directory(str(tmp_path), min_size=257) == []
+    with pytest.raises(Exception):
+        np.asarray(dicom_io.open_pixels(headers[-1])).sum()
+
+
+@pytest.mark.parametrize('name', ['monochrome2', 'monochrome1', 'signed'])
+def test_uncompressed_pixels_are_memory_mapped(dicom_files, name):
+    header = dicom_io.read_header(dicom_files[name])
+    assert header['pixel_offset'] is not None
+    pixels = dicom_io.open_pixels(header)
+    assert isinstance(pixels, np.memmap)
+    assert pixels.filename == os.path.abspath(dicom_files[name])
+
+
+@pytest.mark.parametrize('name', ['rle', 'signed_rle'])
+def test_compressed_pixels_fall_back_to_decoding(dicom_files, name):
+    header = dicom_io.read_header(dicom_files[name])
+    assert header['pixel_offset'] is None
+    pixels = dicom_io.open_pixels(header)
+    assert not isinstance(pixels, np.memmap)
+    # 解码后的实际值(符号扩展和重标定后)与未压缩文件相同
+    reference = dicom_io.read_header(dicom_files['monochrome2'])
+    np.testing.assert_array_equal(dicom_io.stored_value_lut(header)[pixels],
+                                  dicom_io.stored_value_lut(reference)[dicom_io.open_pixels(reference)])
+
+
+@pytest.mark.parametrize('name', [name for name, _ in VARIANTS])
+def test_window_to_uint8_recovers_film(film, dicom_files, name):
+    # 12位存储值为8位灰度左移4位加低位噪声，窗宽窗位覆盖全范围，转换后与原8位图像至多相差1
+    header = dicom_io.read_header(dicom_files[name])
+    if name.startswith('signed'):
+        assert header['signed'] and header['rescale_intercept'] == 2048
+    img = dicom_io.window_to_uint8(dicom_io.open_pixels(header), header)
+    assert img.dtype == np.uint8 and img.shape == film.shape
+    assert np.abs(img.astype(np.int16) - film).max() <= 1
+    # 各存储格式(含MONOCHROME1反相、符号和重标定、压缩)得到相同的结果
+    np.testing.assert_array_equal(img, dicom_io.read_dicom(dicom_files['monochrome2']))
+
+
+def test_window_to_uint8_explicit_window_and_value_range(tmp_path):
+    ramp = np.arange(4096, dtype=np.uint16).reshape(64, 64)
+    path = str(tmp_path / 'ramp.dcm')
+    dicom_io.write_dicom(path, ramp, bits_stored=12)
+    header = dicom_io.read_header(path)
+    pixels = dicom_io.open_pixels(header)
+
+    # 窗位1000、窗宽201: 按DICOM线性VOI，899.5及以下为0，1099.5以上为255，窗内单调递增
+    img = dicom_io.window_to_uint8(pixels, header, center=1000, width=201, chunk_pixels=100).ravel()
+    assert (img[:900] == 0).all() and (img[1100:] == 255).all()
+    assert (np.diff(img[900:1101].astype(np.int16)) >= 0).all()
+    assert img[1000] in (127, 128)
+
+    # 文件头没有窗宽窗位时按实际值范围映射
+    img = dicom_io.window_to_uint8(pixels, header).ravel()
+    assert img[0] == 0 and img[-1] == 255
+
+    out = np.empty(ramp.shape, dtype=np.uint8)
+    assert dicom_io.window_to_uint8(pixels, header, 1000, 201, out=out) is out
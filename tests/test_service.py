@@ -0,0 +1,105 @@
+"""分析服务: 查询参数解析、队列满时返回429、请求解析和端到端分析"""
+import asyncio
+import json
+
+import pytest
+
+import service
+
+
+def test_parse_params():
+    params, fmt = service.parse_params('k=4&lesion_is_bright=false&morph_kernel_size=7&format=bundle')
+    assert fmt == 'bundle'
+    assert params == {'k': 4, 'lesion_is_bright': False, 'morph_kernel_size': (7, 7)}
+    assert service.parse_params('') == ({}, 'json')
+
+
+@pytest.mark.parametrize('query', ['format=xml', 'color=red', 'k=three', 'crop_foreground=maybe',
+                                   'mask_pectoral=1'])
+def test_parse_params_rejects(query):
+    with pytest.raises(ValueError):
+        service.parse_params(query)
+
+
+def test_parse_args():
+    args = service.parse_args(['--workers', '2', '--queue-size', '3'])
+    assert (args.workers, args.queue_size, args.cache_dir) == (2, 3, None)
+    with pytest.raises(ValueError):
+        service.AnalysisService(1, queue_size=0)
+
+
+def test_rejects_when_queue_full():
+    """排队数达到上限后新请求立即返回429，不等待分析"""
+    async def scenario():
+        svc = service.AnalysisService(workers=1, queue_size=2)
+        # 不启动分发协程: 已接受的请求一直排队
+        svc._queue = asyncio.Queue(svc.queue_size)
+        waiting = [asyncio.create_task(svc.route('POST', '/analyze', b'image')) for _ in range(2)]
+        await asyncio.sleep(0)
+        status, _, body, headers = await svc.route('POST', '/analyze?k=3', b'image')
+        metrics = json.loads((await svc.route('GET', '/metrics', b''))[2])
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        return status, json.loads(body), headers, metrics
+
+    status, body, headers, metrics = asyncio.run(scenario())
+    assert status == 429
+    assert headers == {'Retry-After': str(service.RETRY_AFTER)}
+    assert 'error' in body
+    assert (metrics['accepted'], metrics['rejected'], metrics['queue_depth']) == (2, 1, 2)
+
+
+async def _raw_request(port, request):
+    reader, writer = await asyncio.open_connection(service.DEFAULT_HOST, port)
+    writer.write(request)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+@pytest.mark.parametrize('length, status', [('-5', b'400'), ('abc', b'400'), ('999999', b'413')])
+def test_rejects_invalid_content_length(length, status):
+    async def scenario():
+        svc = service.AnalysisService(workers=1, queue_size=1, max_upload=1000)
+        svc._queue = asyncio.Queue(1)
+        server = await asyncio.start_server(svc._handle_connection, service.DEFAULT_HOST, 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.wait_for(_raw_request(
+                port, f'POST /analyze HTTP/1.1\r\nContent-Length: {length}\r\n\r\n'.encode()), 10)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = asyncio.run(scenario())
+    assert response.split(b' ')[1] == status
+
+
+def test_analyze_end_to_end():
+    import cv2
+    import phantom
+
+    img = phantom.make_phantom(256, 6, seed=3)[0]
+    upload = cv2.imencode('.png', img)[1].tobytes()
+
+    async def scenario():
+        svc = service.AnalysisService(workers=1, queue_size=2)
+        server = await svc.start(service.DEFAULT_HOST, 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            ok = await _raw_request(port, b'POST /analyze?k=3 HTTP/1.1\r\nConnection: close\r\n'
+                                          b'Content-Length: %d\r\n\r\n' % len(upload) + upload)
+            bad = await _raw_request(port, b'POST /analyze HTTP/1.1\r\nConnection: close\r\n'
+                                           b'Content-Length: 5\r\n\r\nnopng')
+        finally:
+            await svc.close()
+        return ok, bad
+
+    ok, bad = asyncio.run(scenario())
+    assert ok.startswith(b'HTTP/1.1 200')
+    payload = json.loads(ok.split(b'\r\n\r\n', 1)[1])
+    assert service.decode_mask(payload['mask']).shape == img.shape
+    assert len(payload['lesions']) == payload['lesion_count']
+    assert bad.startswith(b'HTTP/1.1 400')
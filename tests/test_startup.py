@@ -0,0 +1,62 @@
+"""冷启动: 导入界面模块时不加载重型分析依赖，导入和主窗口显示耗时不超出预算"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('PyQt5')
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 启动时不应导入的重型模块(与 benchmark.HEAVY_MODULES 一致)
+HEAVY_MODULES = ('processing', 'sklearn', 'scipy', 'skimage')
+# 预算(秒)比 benchmark.py startup 的默认值宽松，留出测试机负载的余量
+IMPORT_BUDGET = 1.0
+WINDOW_BUDGET = 2.0
+REPEAT = 3
+
+_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+import gui
+imported = time.perf_counter()
+after_import = sorted(name for name in %r if name in sys.modules)
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv)
+window = gui.MammoAnalysisApp()
+window.show()
+after_window = sorted(name for name in %r if name in sys.modules)
+app.processEvents()
+ready = time.perf_counter()
+print(json.dumps({'import_s': imported - start, 'window_s': ready - start,
+                  'after_import': after_import, 'after_window': after_window}))
+sys.stdout.flush()
+# 后台预热线程仍在运行，直接退出
+os._exit(0)
+""" % (HEAVY_MODULES, HEAVY_MODULES)
+
+
+def _cold_start():
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    proc = subprocess.run([sys.executable, '-c', _SCRIPT], cwd=PACKAGE_DIR, env=env,
+                          capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+@pytest.fixture(scope='module')
+def runs():
+    return [_cold_start() for _ in range(REPEAT)]
+
+
+def test_no_heavy_modules_at_startup(runs):
+    for stats in runs:
+        assert stats['after_import'] == []
+        assert stats['after_window'] == []
+
+
+def test_startup_within_budget(runs):
+    assert min(stats['import_s'] for stats in runs) < IMPORT_BUDGET
+    assert min(stats['window_s'] for stats in runs) < WINDOW_BUDGET
@@ -0,0 +1,118 @@
+"""监视目录: 稳定等待、清单增量处理、参数变化重新分析和失败记录"""
+import os
+import time
+
+import cv2
+import pytest
+
+import export
+import phantom
+import watch
+
+PARAMS = {'k': 3}
+
+
+def _write_film(path, seed, age=60):
+    """写入体模图像，并把修改时间设为age秒前(视为已写完)"""
+    cv2.imwrite(str(path), phantom.make_phantom(128, 4, seed=seed)[0])
+    _age(path, age)
+
+
+def _age(path, age):
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def _run_once(incoming, output, params=PARAMS, settle=1.0):
+    watcher = watch.FolderWatcher(str(incoming), str(output), params, bundle=True, settle=settle)
+    watcher.run(once=True)
+    return watcher
+
+
+@pytest.fixture
+def incoming(tmp_path):
+    directory = tmp_path / 'incoming'
+    (directory / 'sub').mkdir(parents=True)
+    _write_film(directory / 'case1.png', 1)
+    _write_film(directory / 'case1.bmp', 2)
+    _write_film(directory / 'sub' / 'case2.png', 3)
+    return directory
+
+
+def _manifest(output):
+    manifest = watch.WatchManifest(os.path.join(str(output), watch.MANIFEST_NAME))
+    try:
+        return dict(manifest.entries)
+    finally:
+        manifest.close()
+
+
+def test_processes_new_files_once(incoming, tmp_path):
+    output = tmp_path / 'out'
+    watcher = _run_once(incoming, output)
+    assert watcher.counts == {'analyzed': 3, 'unchanged': 0, 'failed': 0}
+    entries = _manifest(output)
+    assert sorted(os.path.relpath(p, incoming) for p in entries) == [
+        'case1.bmp', 'case1.png', os.path.join('sub', 'case2.png')]
+    # 同名不同格式的输入各有输出，子目录结构保持不变
+    outputs = {entry['output'] for entry in entries.values()}
+    assert len(outputs) == 3 and all(os.path.exists(p) for p in outputs)
+    assert os.path.exists(os.path.join(str(output), 'sub', 'case2.png_analysis' + export.BUNDLE_SUFFIX))
+
+    # 重新启动: 清单中的文件无需处理
+    assert _run_once(incoming, output).counts == {'analyzed': 0, 'unchanged': 0, 'failed': 0}
+
+
+def test_touched_and_modified_files(incoming, tmp_path):
+    output = tmp_path / 'out'
+    _run_once(incoming, output)
+    # 只修改时间: 比较内容哈希后只更新清单
+    _age(incoming / 'case1.png', 30)
+    # 内容变化: 重新分析
+    _write_film(incoming / 'case1.bmp', 7, age=30)
+    assert _run_once(incoming, output).counts == {'analyzed': 1, 'unchanged': 1, 'failed': 0}
+    # 删除输出: 重新写出
+    os.remove(_manifest(output)[str(incoming / 'case1.png')]['output'])
+    assert _run_once(incoming, output).counts['analyzed'] == 1
+
+
+def test_params_change_reanalyzes(incoming, tmp_path):
+    output = tmp_path / 'out'
+    _run_once(incoming, output)
+    assert _run_once(incoming, output, {'k': 4}).counts['analyzed'] == 3
+    assert _run_once(incoming, output, {'k': 4}).counts['analyzed'] == 0
+
+
+def test_unsettled_files_wait(incoming, tmp_path):
+    output = tmp_path / 'out'
+    _write_film(incoming / 'fresh.png', 4, age=0)
+    (incoming / 'empty.png').write_bytes(b'')
+    _age(incoming / 'empty.png', 60)
+    watcher = watch.FolderWatcher(str(incoming), str(output), PARAMS, bundle=True, settle=30)
+    try:
+        assert watcher.poll() == 2
+        watcher.writer.wait()
+        watcher.collect_written()
+        assert watcher.counts['analyzed'] == 3
+        assert str(incoming / 'fresh.png') not in watcher.manifest.entries
+    finally:
+        watcher.close()
+
+
+def test_failed_files_not_retried_and_deleted_files_pruned(incoming, tmp_path):
+    output = tmp_path / 'out'
+    (incoming / 'broken.png').write_bytes(b'not an image')
+    _age(incoming / 'broken.png', 60)
+    assert _run_once(incoming, output).counts == {'analyzed': 3, 'unchanged': 0, 'failed': 1}
+    assert _manifest(output)[str(incoming / 'broken.png')]['status'] == 'error'
+    assert _run_once(incoming, output).counts['failed'] == 0
+
+    os.remove(incoming / 'sub' / 'case2.png')
+    _run_once(incoming, output)
+    assert str(incoming / 'sub' / 'case2.png') not in _manifest(output)
+
+
+def test_parse_args_rejects_mask_pectoral_without_crop(capsys):
+    with pytest.raises(SystemExit):
+        watch.parse_args(['in', '-o', 'out', '--mask-pectoral'])
+    assert '--crop-foreground' in capsys.readouterr().err
@@ -1,24 +1,71 @@
+import os
+import threading
+
 import cv2
 import numpy as np
 
+import dicom_io
+from diagnostics import stage as diagnostics_stage
+
 
-def read_image(file_path):
+def read_image(file_path, diagnostics=None):
     """
-    读取图像文件，支持常见格式
+    读取图像文件，支持常见格式和DICOM(12/16位MONOCHROME1/2)
 
     参数:
         file_path: 图像文件路径
+        diagnostics: 可选的diagnostics.Diagnostics对象，记录解码耗时
 
     返回:
         numpy数组: 灰度图像
     """
-    # 普通图像文件
-    img = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+    with diagnostics_stage(diagnostics, 'decode') as record:
+        if dicom_io.is_dicom_file(file_path):
+            # DICOM: 内存映射像素数据并按窗宽窗位分块转换为8位
+            img = dicom_io.read_dicom(file_path)
+        else:
+            # 普通图像文件
+            img = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+        if img is not None and record is not None:
+            record['pixels'] = img.size
     if img is None:
         raise ValueError(f"无法读取图像文件: {file_path}")
     return img
 
 
+def decode_image(data, diagnostics=None):
+    """
+    由内存中的文件内容解码灰度图像(如网络上传)，格式同read_image
+
+    参数:
+        data: 文件内容(bytes)
+        diagnostics: 可选的diagnostics.Diagnostics对象，记录解码耗时
+
+    返回:
+        numpy数组: 灰度图像
+    """
+    if data[128:132] == b'DICM':
+        # DICOM按文件读取(内存映射像素数据)，先写入临时文件
+        import tempfile
+
+        fd, path = tempfile.mkstemp(suffix='.dcm')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return read_image(path, diagnostics)
+        except Exception as e:
+            raise ValueError(f"无法解码DICOM图像: {e}")
+        finally:
+            os.remove(path)
+    with diagnostics_stage(diagnostics, 'decode') as record:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is not None and record is not None:
+            record['pixels'] = img.size
+    if img is None:
+        raise ValueError("无法解码图像数据")
+    return img
+
+
 def prepare_image_for_display(img):
     """
     准备图像用于在PyQt界面显示
@@ -42,4 +89,58 @@ def prepare_image_for_display(img):
         default_img = np.zeros((300, 300, 3), dtype=np.uint8)
         cv2.putText(default_img, "Invalid Image", (50, 150),
                     cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-        return default_img
\ No newline at end of file
+        return default_img
+
+
+class DisplayPyramid:
+    """
+    用于显示的多分辨率图像层级
+
+    第0级为原图，之后每级用INTER_AREA缩小一半，按需生成并缓存；
+    显示时先从不小于目标尺寸的最小层级缩放到目标尺寸，再对小图着色，
+    避免每次重绘都处理全分辨率图像。
+
+    参数:
+        img: 灰度或BGR图像(也可以是np.memmap)
+    """
+
+    def __init__(self, img):
+        self.levels = [img]
+        # 层级可能由后台线程预先生成，与界面线程的按需生成互斥
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def level(self, index):
+        """第index级图像(尺寸约为原图的1/2**index)，尚未生成时逐级缩小生成"""
+        with self._lock:
+            while len(self.levels) <= index:
+                level = np.ascontiguousarray(self.levels[-1])
+                self.levels.append(cv2.resize(level, (max(1, level.shape[1] // 2),
+                                                      max(1, level.shape[0] // 2)),
+                                              interpolation=cv2.INTER_AREA))
+            return self.levels[index]
+
+    def fit_size(self, max_width, max_height):
+        """保持宽高比缩放到不超过给定尺寸(不放大)，返回(宽, 高)"""
+        height, width = self.shape[:2]
+        scale = min(max_width / width, max_height / height, 1.0)
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def resize(self, width, height):
+        """缩放到指定尺寸(应不大于原图)"""
+        index = 0
+        level = self.levels[0]
+        while level.shape[1] // 2 >= width and level.shape[0] // 2 >= height:
+            index += 1
+            level = self.level(index)
+        if level.shape[1] == width and level.shape[0] == height:
+            return np.ascontiguousarray(level)
+        return cv2.resize(np.ascontiguousarray(level), (width, height), interpolation=cv2.INTER_AREA)
+
+
+def render_for_display(pyramid, max_width, max_height):
+    """先缩小到不超过给定尺寸，再转换为显示用的RGB图像"""
+    return prepare_image_for_display(pyramid.resize(*pyramid.fit_size(max_width, max_height)))
@@ -0,0 +1,282 @@
+"""
+基于图像金字塔分块显示的缩放/平移查看器
+
+原图和病灶掩码各自建立多分辨率金字塔(后台线程预先生成各层级)，按当前缩放比例
+选择层级，只渲染视口内可见的TILE_SIZE分块；分块QPixmap按视口尺寸限定数量缓存，
+因此内存占用和每帧耗时取决于视口大小而不是胶片尺寸。病灶边界框作为矢量图元叠加，
+任意缩放下线宽不变。
+"""
+import math
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PyQt5.QtWidgets import (QGraphicsView, QGraphicsScene, QGraphicsItem, QGraphicsRectItem,
+                             QGraphicsSimpleTextItem)
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QPen, QColor, QBrush
+from PyQt5.QtCore import Qt, QRectF, QThread
+
+import utils
+
+# 分块边长(金字塔层级像素)
+TILE_SIZE = 256
+# 最大放大倍数(屏幕像素/原图像素)
+MAX_ZOOM = 8.0
+# 滚轮每格的缩放倍数
+WHEEL_ZOOM_STEP = 1.25
+# 跳转到病灶时边界框四周保留的边距(相对边界框尺寸)
+LESION_MARGIN = 0.5
+# 病灶序号文字只在放大到该比例以上时显示，避免缩小时互相遮挡
+LABEL_MIN_ZOOM = 0.5
+# 缓存可容纳的视口分块数的倍数(当前层级、相邻层级及平移时新露出的分块)
+TILE_CACHE_FACTOR = 3
+
+
+def pyramid_depth(shape):
+    """金字塔最粗层级的序号：该层级不超过一个分块"""
+    return max(0, math.ceil(math.log2(max(shape[0], shape[1]) / TILE_SIZE)))
+
+
+class PyramidThread(QThread):
+    """后台预先生成金字塔的各层级，使首次缩小显示时无需等待整幅缩放"""
+
+    def __init__(self, pyramids):
+        super().__init__()
+        self.pyramids = pyramids
+
+    def run(self):
+        for pyramid in self.pyramids:
+            for index in range(1, pyramid_depth(pyramid.shape) + 1):
+                if self.isInterruptionRequested():
+                    return
+                pyramid.level(index)
+
+
+class TiledImageItem(QGraphicsItem):
+    """
+    按可见区域分块绘制的图像图元，场景坐标为原图像素坐标
+
+    参数:
+        pyramid: utils.DisplayPyramid，原图
+        mask_pyramid: 病灶掩码(0/255)的DisplayPyramid，为None时只显示原图
+    """
+
+    def __init__(self, pyramid, mask_pyramid=None):
+        super().__init__()
+        self.pyramid = pyramid
+        self.mask_pyramid = mask_pyramid
+        self.show_mask = True
+        self.depth = pyramid_depth(pyramid.shape)
+        self.tiles = OrderedDict()
+        self.cache_limit = 64
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        height, width = self.pyramid.shape[:2]
+        return QRectF(0, 0, width, height)
+
+    def set_show_mask(self, show):
+        """切换是否叠加病灶高亮(两种分块分别缓存)"""
+        if show != self.show_mask:
+            self.show_mask = show
+            self.update()
+
+    def level_for_scale(self, scale):
+        """选择分辨率最接近屏幕的层级(scale为屏幕像素/原图像素)，每帧处理的像素数约为视口的1~2倍"""
+        if scale <= 0:
+            return self.depth
+        return min(self.depth, max(0, int(math.floor(math.log2(1 / scale) + 0.5))))
+
+    def tile(self, index, row, col):
+        """第index级第(row, col)个分块的QPixmap，按LRU缓存"""
+        overlay = self.show_mask and self.mask_pyramid is not None
+        key = (overlay, index, row, col)
+        pixmap = self.tiles.get(key)
+        if pixmap is not None:
+            self.tiles.move_to_end(key)
+            return pixmap
+        rows = slice(row * TILE_SIZE, (row + 1) * TILE_SIZE)
+        cols = slice(col * TILE_SIZE, (col + 1) * TILE_SIZE)
+        block = np.ascontiguousarray(self.pyramid.level(index)[rows, cols])
+        if overlay:
+            # 与静态显示相同：按病灶覆盖比例混合到255
+            coverage = self.mask_pyramid.level(index)[rows, cols].astype(np.float32) * (1 / 255)
+            block = cv2.add(block, (255 - block.astype(np.float32)) * coverage, dtype=cv2.CV_8U)
+        img = utils.prepare_image_for_display(block)
+        h, w, ch = img.shape
+        pixmap = QPixmap.fromImage(QImage(img.data, w, h, ch * w, QImage.Format_RGB888))
+        self.tiles[key] = pixmap
+        while len(self.tiles) > self.cache_limit:
+            self.tiles.popitem(last=False)
+        return pixmap
+
+    def paint(self, painter, option, widget=None):
+        index = self.level_for_scale(painter.worldTransform().m11())
+        level_h, level_w = self.pyramid.level(index).shape[:2]
+        height, width = self.pyramid.shape[:2]
+        # 层级尺寸经逐级取整，按实际比例映射回原图坐标
+        sx, sy = width / level_w, height / level_h
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+        col0 = max(0, int(exposed.left() / sx) // TILE_SIZE)
+        col1 = min((level_w - 1) // TILE_SIZE, int(exposed.right() / sx) // TILE_SIZE)
+        row0 = max(0, int(exposed.top() / sy) // TILE_SIZE)
+        row1 = min((level_h - 1) // TILE_SIZE, int(exposed.bottom() / sy) // TILE_SIZE)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                pixmap = self.tile(index, row, col)
+                target = QRectF(col * TILE_SIZE * sx, row * TILE_SIZE * sy,
+                                pixmap.width() * sx, pixmap.height() * sy)
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
+
+class TileViewer(QGraphicsView):
+    """
+    可缩放/平移的图像查看器
+
+    滚轮缩放(以鼠标位置为中心)，拖动平移，双击恢复适应窗口
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setScene(QGraphicsScene(self))
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setResizeAnchor(QGraphicsView.AnchorViewCenter)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setBackgroundBrush(QBrush(QColor('#0d1117')))
+        self.image_item = None
+        self.lesion_items = []
+        self.label_items = []
+        self.pyramid_thread = None
+        self.fitted = True
+
+    def clear(self):
+        """清除显示内容并停止后台金字塔生成"""
+        self.stop_pyramid_thread()
+        self.scene().clear()
+        self.image_item = None
+        self.lesion_items = []
+        self.label_items = []
+
+    def stop_pyramid_thread(self):
+        if self.pyramid_thread is not None:
+            self.pyramid_thread.requestInterruption()
+            self.pyramid_thread.wait()
+            self.pyramid_thread = None
+
+    def set_image(self, pyramid, mask_pyramid=None, lesions=()):
+        """
+        显示图像(及可选的病灶高亮和边界框)
+
+        参数:
+            pyramid: 原图的utils.DisplayPyramid
+            mask_pyramid: 病灶掩码的DisplayPyramid
+            lesions: 病灶特征(含bounding_box)序列，按序号标注
+        """
+        same_image = self.image_item is not None and self.image_item.pyramid is pyramid
+        self.clear()
+        self.image_item = TiledImageItem(pyramid, mask_pyramid)
+        self.scene().addItem(self.image_item)
+        self.scene().setSceneRect(self.image_item.boundingRect())
+
+        pen = QPen(QColor(0, 255, 0), 2)
+        pen.setCosmetic(True)  # 线宽不随缩放变化
+        for i, lesion in enumerate(lesions):
+            y1, x1, y2, x2 = (int(v) for v in lesion['bounding_box'])
+            rect = QGraphicsRectItem(x1, y1, x2 - x1, y2 - y1, self.image_item)
+            rect.setPen(pen)
+            text = QGraphicsSimpleTextItem(f"nidus{i+1}", rect)
+            text.setBrush(QBrush(QColor(255, 255, 0)))
+            text.setFlag(QGraphicsItem.ItemIgnoresTransformations)
+            text.setPos(x1, y1)
+            self.lesion_items.append(rect)
+            self.label_items.append(text)
+
+        pyramids = [pyramid] + ([mask_pyramid] if mask_pyramid is not None else [])
+        self.pyramid_thread = PyramidThread(pyramids)
+        self.pyramid_thread.start()
+        self.update_cache_limit()
+        # 同一图像更新分析结果时保持当前缩放和位置
+        if not same_image or self.fitted:
+            self.fit()
+        else:
+            self.update_labels()
+
+    def set_show_annotations(self, show):
+        """切换病灶高亮和边界框的显示"""
+        if self.image_item is not None:
+            self.image_item.set_show_mask(show)
+        for item in self.lesion_items:
+            item.setVisible(show)
+        self.update_labels()
+
+    def update_labels(self):
+        """按当前缩放比例显示或隐藏病灶序号"""
+        visible = self.zoom_scale() >= LABEL_MIN_ZOOM
+        for item in self.label_items:
+            item.setVisible(visible)
+
+    def fit(self):
+        """缩放到完整显示图像"""
+        if self.image_item is not None:
+            self.fitInView(self.image_item.boundingRect(), Qt.KeepAspectRatio)
+            self.fitted = True
+            self.update_labels()
+
+    def show_lesion(self, index):
+        """缩放并居中显示第index个病灶的边界框"""
+        if not 0 <= index < len(self.lesion_items):
+            return
+        rect = self.lesion_items[index].rect()
+        margin = LESION_MARGIN * max(rect.width(), rect.height(), 1)
+        target = rect.adjusted(-margin, -margin, margin, margin)
+        self.fitInView(target, Qt.KeepAspectRatio)
+        self.limit_zoom()
+        self.centerOn(rect.center())
+        self.fitted = False
+        self.update_labels()
+
+    def zoom_scale(self):
+        return self.transform().m11()
+
+    def limit_zoom(self):
+        scale = self.zoom_scale()
+        if scale > MAX_ZOOM:
+            self.scale(MAX_ZOOM / scale, MAX_ZOOM / scale)
+
+    def wheelEvent(self, event):
+        if self.image_item is None:
+            return
+        factor = WHEEL_ZOOM_STEP ** (event.angleDelta().y() / 120)
+        rect = self.image_item.boundingRect()
+        # 不小于适应窗口的比例，不大于MAX_ZOOM
+        fit_scale = min(self.viewport().width() / rect.width(),
+                        self.viewport().height() / rect.height())
+        scale = self.zoom_scale()
+        target = min(MAX_ZOOM, max(fit_scale, scale * factor))
+        if target <= fit_scale:
+            self.fit()
+            return
+        self.scale(target / scale, target / scale)
+        self.fitted = False
+        self.update_labels()
+
+    def mouseDoubleClickEvent(self, event):
+        self.fit()
+
+    def update_cache_limit(self):
+        """分块缓存数量随视口尺寸调整"""
+        if self.image_item is None:
+            return
+        cols = self.viewport().width() // TILE_SIZE + 2
+        rows = self.viewport().height() // TILE_SIZE + 2
+        self.image_item.cache_limit = TILE_CACHE_FACTOR * rows * cols
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_cache_limit()
+        if self.fitted:
+            self.fit()
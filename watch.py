@@ -0,0 +1,402 @@
+"""
+监视目录并自动分析新到达的图像
+
+定时扫描监视目录(轮询，不依赖平台的文件系统通知，共享目录和网络盘同样适用)，
+文件大小和修改时间在连续两次扫描间不变且距最后修改超过稳定等待时间后视为写完，
+读取(utils.read_image)并分析(processing.analyze_mammo_image)，结果经 export.ExportWriter
+按界面保存相同的格式(目录格式或结果包)写入输出目录，子目录结构保持不变。
+
+处理记录保存在SQLite清单中(路径、大小、修改时间、文件内容哈希、参数)，结果写出完成后
+才记入清单。重新启动时只处理新增或变化的文件；大小或修改时间变化但内容哈希不变(如重新
+复制)时只更新清单；参数、流水线版本或输出格式变化时按新参数重新分析；读取或分析失败的
+文件在内容或参数变化前不再重试。
+
+用法示例:
+    python watch.py /data/incoming -o /data/analysis --interval 5
+    python watch.py /data/incoming -o /data/analysis --bundle --once
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Tuple
+
+import batch
+import export
+
+# 扫描间隔(秒)
+DEFAULT_INTERVAL = 2.0
+# 文件最后修改后至少经过该时间才视为写完(秒)
+DEFAULT_SETTLE = 2.0
+# 清单文件名(位于输出目录)
+MANIFEST_NAME = '.watch_manifest.sqlite'
+# 排队等待写出的结果数上限，写出跟不上分析时暂停分析(每个结果持有整幅原图)
+MAX_PENDING_WRITES = 4
+# 计算文件内容哈希时每次读取的字节数
+HASH_CHUNK = 1 << 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    output TEXT,
+    error TEXT,
+    processed_at TEXT NOT NULL
+);
+"""
+_COLUMNS = ('path', 'size', 'mtime_ns', 'content_hash', 'params', 'status', 'output', 'error',
+            'processed_at')
+
+
+def file_digest(path: str) -> str:
+    """文件内容(字节)的哈希"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def params_key(params: Dict, bundle: bool) -> str:
+    """参数的规范化JSON，含流水线版本和输出格式；与清单中记录的不同时需要重新分析"""
+    import cache
+    import processing
+
+    return json.dumps({'params': cache.normalize_params(params), 'version': processing.PIPELINE_VERSION,
+                       'output': 'bundle' if bundle else 'directory'}, sort_keys=True)
+
+
+class WatchManifest:
+    """
+    处理清单(SQLite)，全部记录同时保存在内存中，扫描时无需逐个查询
+
+    参数:
+        path: 清单文件路径
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+        self.entries = {row[0]: dict(zip(_COLUMNS, row))
+                        for row in self._conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM files")}
+
+    def get(self, path: str) -> Optional[Dict]:
+        return self.entries.get(path)
+
+    def put(self, entry: Dict) -> None:
+        """写入(替换)一条记录并立即提交"""
+        self.entries[entry['path']] = entry
+        with self._conn:
+            self._conn.execute(f"INSERT OR REPLACE INTO files ({', '.join(_COLUMNS)}) "
+                               f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+                               [entry[name] for name in _COLUMNS])
+
+    def remove(self, paths) -> None:
+        """删除已不存在的文件的记录(输出结果保留)"""
+        paths = [p for p in paths if p in self.entries]
+        for path in paths:
+            del self.entries[path]
+        if paths:
+            with self._conn:
+                self._conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class FolderWatcher:
+    """
+    监视目录的扫描与处理
+
+    参数:
+        watch_dir: 监视目录
+        output_dir: 输出目录(位于监视目录内时扫描跳过该目录)
+        params: 传给 processing.analyze_mammo_image 的关键字参数
+        bundle: True输出结果包，False输出目录格式(标注图像、报告和特征CSV)
+        settle: 稳定等待时间(秒)
+        recursive: 是否扫描子目录
+        manifest_path: 清单路径(默认为输出目录下的MANIFEST_NAME)
+        feature_store: 可选的store.FeatureStore，写出时同时写入特征库
+    """
+
+    def __init__(self, watch_dir: str, output_dir: str, params: Dict, bundle: bool = False,
+                 settle: float = DEFAULT_SETTLE, recursive: bool = True,
+                 manifest_path: Optional[str] = None, feature_store=None):
+        import processing
+
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.params = params
+        self.bundle = bundle
+        self.settle = settle
+        self.recursive = recursive
+        self.feature_store = feature_store
+        self.params_key = params_key(params, bundle)
+        self.manifest = WatchManifest(manifest_path or os.path.join(self.output_dir, MANIFEST_NAME))
+        self.workspace = processing.AnalysisWorkspace()
+        # 上次扫描时各文件的(大小, 修改时间)，用于判断文件是否仍在写入
+        self._last_seen = {}
+        # 本次扫描是否有目录无法访问(如网络盘暂时断开)，此时不清理清单
+        self._scan_failed = False
+        # 已提交写出、尚未记入清单的任务 -> 清单记录
+        self._writing = {}
+        self._finished = queue.Queue()
+        self.writer = export.ExportWriter(on_done=self._on_written, on_error=self._on_write_failed)
+        self.stop_event = threading.Event()
+        self.counts = {'analyzed': 0, 'unchanged': 0, 'failed': 0}
+
+    def _on_written(self, job, seconds):
+        self._finished.put((job, None))
+
+    def _on_write_failed(self, job, message):
+        self._finished.put((job, message))
+
+    def scan(self) -> Iterator[Tuple[str, os.stat_result]]:
+        """遍历监视目录中的图像文件(跳过隐藏文件、隐藏目录和输出目录)"""
+        self._scan_failed = False
+
+        def on_error(error):
+            self._scan_failed = True
+            print(f"无法扫描 {error.filename}: {error.strerror}", file=sys.stderr)
+
+        for root, dirs, files in os.walk(self.watch_dir, onerror=on_error):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.')
+                             and os.path.join(root, d) != self.output_dir)
+            for name in sorted(files):
+                if name.startswith('.') or not name.lower().endswith(batch.IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    # 扫描期间被移走或删除
+                    continue
+            if not self.recursive:
+                break
+
+    def output_path(self, path: str) -> str:
+        """
+        输入文件对应的输出路径(保持相对监视目录的子目录结构)
+
+        保留原扩展名(如case1.dcm_analysis)，同名不同格式的文件(case1.png与case1.dcm)
+        不会写到同一输出
+        """
+        relative = os.path.relpath(path, self.watch_dir)
+        if self.bundle:
+            return os.path.join(self.output_dir, relative + '_analysis' + export.BUNDLE_SUFFIX)
+        return os.path.join(self.output_dir, relative + '_analysis')
+
+    def _needs_update(self, path: str, stat: os.stat_result) -> bool:
+        """大小、修改时间、参数均与清单一致且输出仍在(失败的文件不要求输出)时无需处理"""
+        entry = self.manifest.get(path)
+        if entry is None or entry['params'] != self.params_key:
+            return True
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return True
+        return entry['status'] == 'ok' and not os.path.exists(entry['output'])
+
+    def _entry(self, path, stat, content_hash, status, output=None, error=None) -> Dict:
+        return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'content_hash': content_hash, 'params': self.params_key, 'status': status,
+                'output': output, 'error': error,
+                'processed_at': datetime.now().isoformat(timespec='seconds')}
+
+    def process(self, path: str, stat: os.stat_result) -> None:
+        """处理一个已写完的文件: 内容未变时只更新清单，否则分析并提交写出"""
+        import cache
+        import processing
+        import utils
+
+        try:
+            content_hash = file_digest(path)
+        except OSError as e:
+            print(f"无法读取 {path}: {e}", file=sys.stderr)
+            return
+        entry = self.manifest.get(path)
+        if (entry is not None and entry['content_hash'] == content_hash
+                and entry['params'] == self.params_key
+                and (entry['status'] != 'ok' or os.path.exists(entry['output']))):
+            # 内容未变(如重新复制或只修改了时间)，沿用上次的结果或失败记录
+            self.manifest.put(dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns))
+            self.counts['unchanged'] += 1
+            return
+
+        start = time.perf_counter()
+        try:
+            img = utils.read_image(path)
+            result = processing.analyze_mammo_image(
+                img, tile_size=processing.default_tile_size(img.shape), workspace=self.workspace,
+                **self.params)
+        except Exception as e:
+            self.manifest.put(self._entry(path, stat, content_hash, 'error', error=str(e)))
+            self.counts['failed'] += 1
+            print(f"分析失败 {path}: {e}", file=sys.stderr)
+            return
+        target = self.output_path(path)
+        job = export.ExportJob(export.snapshot_result(result), target, self.bundle,
+                               export.analysis_report(result), params=self.params,
+                               image_path=path, image_digest=cache.image_digest(img),
+                               feature_store=self.feature_store)
+        self._writing[job] = self._entry(path, stat, content_hash, 'ok', output=target)
+        self.writer.submit(job)
+        print(f"已分析 {path}: {result['lesion_count']} 个病灶, "
+              f"{time.perf_counter() - start:.2f} s", file=sys.stderr)
+        if self.writer.pending > MAX_PENDING_WRITES:
+            self.writer.wait()
+        self.collect_written()
+
+    def collect_written(self) -> None:
+        """把已写出完成的结果记入清单"""
+        while True:
+            try:
+                job, error = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            entry = self._writing.pop(job)
+            if error is None:
+                self.manifest.put(entry)
+                self.counts['analyzed'] += 1
+            else:
+                # 写出失败不记入清单，下次扫描重新处理
+                self.counts['failed'] += 1
+                print(f"写出失败 {job.target}: {error}", file=sys.stderr)
+
+    def poll(self) -> int:
+        """
+        扫描一次并处理已写完的新增或变化文件
+
+        返回:
+            int: 仍在写入(尚未稳定)、留待下次扫描的文件数
+        """
+        self.collect_written()
+        # 已分析、正在后台写出的文件写完后才记入清单，期间不再重复处理
+        writing = {entry['path'] for entry in self._writing.values()}
+        seen = {}
+        ready = []
+        waiting = 0
+        now = time.time()
+        for path, stat in self.scan():
+            seen[path] = (stat.st_size, stat.st_mtime_ns)
+            if path in writing or not self._needs_update(path, stat):
+                continue
+            previous = self._last_seen.get(path)
+            if (stat.st_size == 0 or now - stat.st_mtime < self.settle
+                    or (previous is not None and previous != seen[path])):
+                waiting += 1
+            else:
+                ready.append((path, stat))
+        self._last_seen = seen
+        if not self._scan_failed:
+            self.manifest.remove([p for p in self.manifest.entries if p not in seen])
+
+        for path, stat in ready:
+            if self.stop_event.is_set():
+                break
+            self.process(path, stat)
+        self.collect_written()
+        return waiting
+
+    def run(self, interval: float = DEFAULT_INTERVAL, once: bool = False) -> None:
+        """循环扫描直到stop_event被设置；once为True时只扫描一次"""
+        try:
+            while True:
+                waiting = self.poll()
+                if once:
+                    if waiting:
+                        print(f"{waiting} 个文件仍在写入，未处理", file=sys.stderr)
+                    break
+                if self.stop_event.wait(interval):
+                    break
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self.writer.close()
+        self.collect_written()
+        self.manifest.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="监视目录，自动分析新到达的乳腺钼靶图像")
+    parser.add_argument('watch_dir', help="监视目录")
+    parser.add_argument('-o', '--output', required=True, help="输出目录(清单也保存在此)")
+    parser.add_argument('--bundle', action='store_true', help="输出结果包(默认输出目录格式)")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help="扫描间隔(秒)")
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE,
+                        help="文件最后修改后至少经过该时间才处理(秒)")
+    parser.add_argument('--once', action='store_true', help="只扫描处理一次后退出")
+    parser.add_argument('--manifest', help=f"清单路径(默认为输出目录下的{MANIFEST_NAME})")
+    parser.add_argument('--no-recursive', action='store_true', help="不扫描子目录")
+    parser.add_argument('--threads', type=int, default=None, help="分析线程数上限(默认不限制)")
+    parser.add_argument('--store', help="同时将图像摘要和病灶特征写入该SQLite特征库")
+    parser.add_argument('-k', type=int, default=3, help="聚类数量")
+    parser.add_argument('--dark-lesion', action='store_true', help="病灶表现为较暗区域")
+    parser.add_argument('--morph-kernel-size', type=int, default=5, help="形态学操作核大小")
+    parser.add_argument('--min-lesion-size', type=int, default=100, help="最小病灶面积(像素)")
+    parser.add_argument('--crop-foreground', action='store_true', help="只分析乳房区域(裁剪背景)")
+    parser.add_argument('--mask-pectoral', action='store_true',
+                        help="与--crop-foreground同时使用，胸大肌区按背景处理")
+    args = parser.parse_args(argv)
+    if args.mask_pectoral and not args.crop_foreground:
+        parser.error("--mask-pectoral 需与 --crop-foreground 同时使用")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.watch_dir):
+        print(f"错误: 监视目录不存在: {args.watch_dir}", file=sys.stderr)
+        return 1
+    if args.threads:
+        batch.limit_threads(args.threads)
+    params = {
+        'k': args.k,
+        'lesion_is_bright': not args.dark_lesion,
+        'morph_kernel_size': (args.morph_kernel_size, args.morph_kernel_size),
+        'min_lesion_size': args.min_lesion_size,
+    }
+    if args.crop_foreground:
+        params['crop_foreground'] = True
+        params['mask_pectoral'] = args.mask_pectoral
+
+    feature_store = None
+    if args.store:
+        import store
+
+        feature_store = store.FeatureStore(args.store)
+    watcher = FolderWatcher(args.watch_dir, args.output, params, args.bundle, args.settle,
+                            not args.no_recursive, args.manifest, feature_store)
+    # SIGTERM与Ctrl+C一样在当前文件处理完后停止，已提交的结果写完再退出
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop_event.set())
+    print(f"正在监视 {watcher.watch_dir}，结果输出至 {watcher.output_dir}", file=sys.stderr)
+    try:
+        watcher.run(args.interval, args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if feature_store is not None:
+            feature_store.close()
+    counts = watcher.counts
+    print(f"已停止: 分析 {counts['analyzed']} 个, 内容未变 {counts['unchanged']} 个, "
+          f"失败 {counts['failed']} 个", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""
+分析工作进程池
+
+交互分析在常驻的工作进程中运行，分析中的Python循环(连通域过滤、特征表构建等)不再与
+界面线程争用GIL。图像经multiprocessing.shared_memory传给工作进程，每张图像只复制一次；
+工作进程按共享内存名保留最近几张图像的分析流水线，同一图像修改参数时只重算受影响的阶段。
+分析得到的位压缩掩码同样经共享内存传回，只有查找表、病灶特征表等小数组经管道传递。
+
+连续提交时以最新请求为准: 排队中的旧请求直接丢弃，正在运行的旧请求在下一个进度检查点取消。
+工作进程崩溃时请求以错误结束(界面进程不受影响)，下次提交时自动重建进程池。
+"""
+import multiprocessing as mp
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from diagnostics import Diagnostics, stage as diagnostics_stage
+from result import AnalysisResult
+
+# 默认工作进程数: 交互分析同一时刻只运行一个请求，单个进程可保证流水线中间结果被复用；
+# 设为0时界面在自身进程的线程中分析
+DEFAULT_WORKERS = int(os.environ.get('MAMMO_ANALYSIS_WORKERS', 1))
+# 每个工作进程保留分析流水线(含中间结果)的图像数
+PIPELINES_PER_WORKER = 2
+# 进度报告的阶段名(按序号存入共享数组)
+PROGRESS_STAGES = ('enhance', 'smooth', 'histogram', 'cluster', 'mask', 'morphology',
+                   'filter', 'features', 'done')
+
+# 工作进程状态: 最新请求编号(请求取消的依据)、进度[请求编号, 阶段序号, 百分比]、
+# 共享内存名 -> (SharedMemory, AnalysisPipeline)
+_latest_request = None
+_progress = None
+_pipelines = OrderedDict()
+
+
+class SharedImage:
+    """
+    放入共享内存的图像，由创建方调用close释放
+
+    参数:
+        img: 图像数组(复制一次到共享内存)；结果对象按引用使用该数组作为原图
+    """
+
+    def __init__(self, img: np.ndarray):
+        self.img = img
+        img = np.ascontiguousarray(img)
+        self.shape = img.shape
+        self.dtype = img.dtype.str
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+        np.ndarray(self.shape, img.dtype, buffer=self._shm.buf)[...] = img
+
+    @property
+    def descriptor(self) -> Tuple:
+        """工作进程据此附加到共享内存: (名称, 形状, dtype)"""
+        return self._shm.name, self.shape, self.dtype
+
+    def close(self) -> None:
+        """释放共享内存；已附加的工作进程在关闭前仍可读取"""
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def _array_to_shared(array: np.ndarray) -> Tuple:
+    """把数组复制到新的共享内存，由接收方释放"""
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    try:
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    finally:
+        shm.close()
+    return shm.name, array.shape, array.dtype.str
+
+
+def _array_from_shared(descriptor: Tuple) -> np.ndarray:
+    """从共享内存取回数组并释放共享内存"""
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _init_worker(latest_request, progress):
+    global _latest_request, _progress
+    _latest_request = latest_request
+    _progress = progress
+
+
+def _warm_up():
+    """预先导入分析模块并预热(进程池创建后提交)"""
+    import processing
+
+    processing.warm_up()
+
+
+def _pipeline_for(descriptor: Tuple):
+    """附加到图像的共享内存，同一图像复用已有的分析流水线"""
+    import processing
+
+    name, shape, dtype = descriptor
+    entry = _pipelines.get(name)
+    if entry is None:
+        shm = shared_memory.SharedMemory(name=name)
+        img = np.ndarray(shape, dtype, buffer=shm.buf)
+        img.flags.writeable = False
+        entry = (shm, processing.AnalysisPipeline(img))
+        _pipelines[name] = entry
+        while len(_pipelines) > PIPELINES_PER_WORKER:
+            old_shm, old_pipeline = _pipelines.popitem(last=False)[1]
+            old_pipeline.clear()
+            old_pipeline.img = None
+            old_shm.close()
+    _pipelines.move_to_end(name)
+    return entry[1]
+
+
+def _analyze_in_worker(request_id, descriptor, params, cache_dir, digest, trace_memory,
+                       preview=False):
+    """
+    工作进程中执行一次分析(大尺寸图像自动分块)；请求已过期时返回None
+
+    preview为True时返回粗到细模式的降采样预览(不写入缓存)，最终结果已缓存时直接返回最终结果
+    """
+    import cache
+    import processing
+
+    def on_progress(stage, percent):
+        if _latest_request.value != request_id:
+            return True
+        _progress[:] = [request_id, PROGRESS_STAGES.index(stage), percent]
+        return False
+
+    if _latest_request.value != request_id:
+        return None
+    pipeline = _pipeline_for(descriptor)
+    img = pipeline.img
+    if digest is None:
+        digest = cache.image_digest(img)
+    key = cache.make_key(digest, params)
+    analysis_cache = cache.AnalysisCache(cache_dir)
+    diagnostics = None if trace_memory is None else Diagnostics(trace_memory)
+    try:
+        with diagnostics_stage(diagnostics, 'cache_lookup') as record:
+            result = analysis_cache.get(key, img)
+            if record is not None:
+                record['hit'] = result is not None
+        cache_hit = result is not None
+        if result is None and preview:
+            try:
+                result = pipeline.preview(progress_callback=on_progress, diagnostics=diagnostics,
+                                          **params)
+            except processing.AnalysisCancelled:
+                return None
+        elif result is None:
+            try:
+                result = pipeline.run(tile_size=processing.default_tile_size(img.shape),
+                                      progress_callback=on_progress, diagnostics=diagnostics,
+                                      **params)
+            except processing.AnalysisCancelled:
+                return None
+            analysis_cache.put(key, result)
+    finally:
+        if diagnostics is not None:
+            diagnostics.close()
+    arrays = result.to_arrays()
+    mask_bits = _array_to_shared(arrays.pop('mask_bits'))
+    return {'digest': digest, 'key': key, 'cache_hit': cache_hit, 'mask_bits': mask_bits,
+            'arrays': arrays, 'diagnostics': diagnostics, 'preview': preview and not cache_hit}
+
+
+class AnalysisRequest:
+    """
+    提交给工作进程池的一次分析请求
+
+    属性:
+        request_id: 请求编号(递增)
+        image: 请求使用的SharedImage
+        params: 分析参数
+        preview: 是否只请求粗到细模式的降采样预览
+        image_digest: 图像像素哈希(可由工作进程计算后填入)
+        cache_key: 结果缓存键(完成后填入)
+        cache_hit: 是否命中结果缓存(完成后填入)
+        submitted_at: 提交时刻(time.perf_counter)
+    """
+
+    __slots__ = ('request_id', 'image', 'params', 'preview', 'image_digest', 'diagnostics',
+                 'callback', 'cache_key', 'cache_hit', 'submitted_at', 'future')
+
+    def __init__(self, request_id, image, params, image_digest, diagnostics, callback,
+                 preview=False):
+        self.request_id = request_id
+        self.image = image
+        self.params = params
+        self.preview = preview
+        self.image_digest = image_digest
+        self.diagnostics = diagnostics
+        self.callback = callback
+        self.cache_key = None
+        self.cache_hit = False
+        self.submitted_at = time.perf_counter()
+        self.future = None
+
+
+class AnalysisWorkerPool:
+    """
+    常驻分析进程池(以最新请求为准)
+
+    参数:
+        workers: 工作进程数
+        cache_dir: 工作进程使用的结果缓存目录(与界面进程共享)
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, cache_dir: Optional[str] = None):
+        self.workers = max(1, workers)
+        self.cache_dir = cache_dir
+        # spawn: 不复制界面进程的Qt状态和线程
+        self._ctx = mp.get_context('spawn')
+        self._latest_request = self._ctx.Value('q', 0, lock=False)
+        self._progress = self._ctx.Array('d', 3, lock=False)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._next_id = 0
+        self._running = None
+        self._queued = None
+        self.crashes = 0
+
+    def start(self) -> None:
+        """创建工作进程并在后台预热(可在界面显示后提前调用)"""
+        with self._lock:
+            self._ensure_executor()
+
+    def _ensure_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=self._ctx,
+                                                 initializer=_init_worker,
+                                                 initargs=(self._latest_request, self._progress))
+            for _ in range(self.workers):
+                self._executor.submit(_warm_up)
+        return self._executor
+
+    def submit(self, image: SharedImage, params: Dict, callback: Callable,
+               image_digest: Optional[str] = None, diagnostics=None,
+               preview: bool = False) -> AnalysisRequest:
+        """
+        提交分析请求，立即返回
+
+        之前提交的请求随即过期: 排队中的不再运行，运行中的在下一个检查点取消。
+
+        参数:
+            image: 图像所在的SharedImage(调用方在请求结束前不应关闭)
+            params: 传给AnalysisPipeline.run的分析参数
+            callback: callback(request, status, payload)，在后台线程中调用；
+                status为'done'(payload为AnalysisResult)、'preview'(payload为预览的
+                AnalysisResult)、'cancelled'(payload为None)或'error'(payload为错误信息)
+            image_digest: 预先计算的图像哈希，省略时由工作进程计算
+            diagnostics: 可选的Diagnostics，工作进程中的逐阶段记录在完成后追加到其中
+            preview: 为True时只计算粗到细模式(params含coarse_factor)的降采样预览；
+                最终结果已缓存时以'done'返回最终结果
+        """
+        with self._lock:
+            self._next_id += 1
+            request = AnalysisRequest(self._next_id, image, params, image_digest, diagnostics,
+                                      callback, preview)
+            self._latest_request.value = request.request_id
+            replaced, self._queued = self._queued, None
+            if self._running is None:
+                started = self._start(request)
+            else:
+                self._queued = request
+                started = False
+        if replaced is not None:
+            replaced.callback(replaced, 'cancelled', None)
+        if started:
+            self._watch(request)
+        return request
+
+    def cancel(self) -> None:
+        """取消全部请求(运行中的在下一个检查点停止)"""
+        with self._lock:
+            self._next_id += 1
+            self._latest_request.value = self._next_id
+            replaced, self._queued = self._queued, None
+        if replaced is not None:
+            replaced.callback(replaced, 'cancelled', None)
+
+    def is_current(self, request: AnalysisRequest) -> bool:
+        return self._latest_request.value == request.request_id
+
+    def progress(self, request: AnalysisRequest) -> Optional[Tuple[str, float]]:
+        """请求的最新进度(阶段名, 百分比)，尚无进度时返回None"""
+        request_id, stage, percent = self._progress[:]
+        if int(request_id) != request.request_id:
+            return None
+        return PROGRESS_STAGES[int(stage)], percent
+
+    def _start(self, request) -> bool:
+        """把请求交给进程池，成功返回True(调用方持有self._lock，释放后再调用_watch)"""
+        args = (request.request_id, request.image.descriptor, request.params, self.cache_dir,
+                request.image_digest,
+                None if request.diagnostics is None else request.diagnostics.trace_memory,
+                request.preview)
+        try:
+            try:
+                request.future = self._ensure_executor().submit(_analyze_in_worker, *args)
+            except BrokenProcessPool:
+                # 工作进程在空闲时退出，重建进程池后重试一次
+                self.crashes += 1
+                self._executor = None
+                request.future = self._ensure_executor().submit(_analyze_in_worker, *args)
+        except (BrokenProcessPool, RuntimeError, OSError) as e:
+            self._executor = None
+            threading.Thread(target=request.callback, args=(request, 'error', f"无法启动分析进程: {e}"),
+                             daemon=True).start()
+            return False
+        self._running = request
+        return True
+
+    def _watch(self, request):
+        # 已完成的future会在当前线程立即回调，因此不能在持有锁时调用
+        request.future.add_done_callback(lambda future: self._on_done(request, future))
+
+    def _on_done(self, request, future):
+        """请求结束(在进程池的管理线程中调用)"""
+        status, payload = 'cancelled', None
+        try:
+            output = future.result()
+        except BrokenProcessPool:
+            self.crashes += 1
+            with self._lock:
+                executor, self._executor = self._executor, None
+            if executor is not None:
+                executor.shutdown(wait=False)
+            status, payload = 'error', "分析进程意外退出(可能是内存不足或底层库崩溃)，下次分析时将重新启动"
+        except Exception as e:
+            status, payload = 'error', str(e)
+        else:
+            if output is not None and not self.is_current(request):
+                # 完成时已有更新的请求，只释放传回掩码的共享内存
+                _array_from_shared(output['mask_bits'])
+            elif output is not None:
+                diagnostics = request.diagnostics
+                if diagnostics is not None:
+                    diagnostics.extend(output['diagnostics'])
+                with diagnostics_stage(diagnostics, 'result_transfer'):
+                    arrays = output['arrays']
+                    arrays['mask_bits'] = _array_from_shared(output['mask_bits'])
+                    result = AnalysisResult.from_arrays(request.image.img, arrays)
+                result.diagnostics = diagnostics
+                request.image_digest = output['digest']
+                request.cache_key = output['key']
+                request.cache_hit = output['cache_hit']
+                status, payload = ('preview' if output['preview'] else 'done'), result
+        with self._lock:
+            self._running = None
+            queued, self._queued = self._queued, None
+            started = queued is not None and self._start(queued)
+        if started:
+            self._watch(queued)
+        request.callback(request, status, payload)
+
+    def close(self) -> None:
+        """取消全部请求并结束工作进程"""
+        self.cancel()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+